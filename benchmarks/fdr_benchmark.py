@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+
+"""
+Time the in-process FDR correction of a line's specimens, batched into one call, against r_padjust.R (if R is
+installed) run on each specimen in turn
+
+Usage
+-----
+With lama installed (pip install -e .)
+$ python benchmarks/fdr_benchmark.py --specimens 8 --points 1000000
+"""
+
+import argparse
+import shutil
+import time
+
+import numpy as np
+
+from lama.stats.standard_stats import stats_objects
+from lama.tests.test_multiple_testing import _pvals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the FDR correction')
+    parser.add_argument('-s', '--specimens', dest='specimens', type=int, default=8,
+                        help='Number of specimens to correct')
+    parser.add_argument('-p', '--points', dest='points', type=int, default=1_000_000,
+                        help='Number of p-values (voxels) per specimen')
+    args = parser.parse_args()
+
+    p = _pvals((args.specimens, args.points)).astype(np.float32)
+
+    start = time.perf_counter()
+    stats_objects.fdr(p)
+    msg = f'{p.shape[0]} x {p.shape[1]} p-values. numpy: {time.perf_counter() - start:.2f}s'
+
+    if shutil.which('Rscript'):
+        start = time.perf_counter()
+        for row in p:
+            stats_objects.fdr_r(row)
+        msg += f', R: {time.perf_counter() - start:.2f}s'
+
+    print(msg)
+
+
+if __name__ == '__main__':
+    main()
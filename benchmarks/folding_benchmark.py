@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+
+"""
+Time the vectorised B-spline unfolding against the original per-control-point implementation, on the grid of a 28um
+embryo volume with a final grid spacing of 8 voxels
+
+Usage
+-----
+With lama installed (pip install -e .)
+$ python benchmarks/folding_benchmark.py
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from lama.elastix import folding
+from lama.elastix.transform_parameters import TransformParameterFile
+from lama.tests.test_folding import TP, GRID_SIZE, GRID_SPACING, _loop_condition_1, _loop_correct
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the B-spline unfolding')
+    parser.add_argument('-d', '--displacement', dest='displacement', type=float, default=2.0,
+                        help='Standard deviation of the control point displacements, in voxels')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    coefs = rng.normal(0, args.displacement, (int(np.prod(GRID_SIZE)), 3))
+    scaled = coefs / GRID_SPACING
+
+    start = time.perf_counter()
+    bad = ~(_loop_condition_1(scaled) | folding.condition_2(scaled))
+    _loop_correct(scaled[bad])
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bad = ~folding.is_injective(scaled)
+    folding.correct(scaled[bad])
+    vectorised_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tp_path = Path(tmp_dir) / 'TransformParameters.0.txt'
+        tp_path.write_text(TP.format(n=coefs.size, grid_size=' '.join(map(str, GRID_SIZE)),
+                                     grid_spacing=' '.join(map(str, GRID_SPACING))))
+        tp = TransformParameterFile.read(tp_path)
+        tp.coefficients = coefs
+        tp.write()
+
+        start = time.perf_counter()
+        folding.unfold_bsplines(tp_path, iterative=True)
+        total_time = time.perf_counter() - start
+
+    print(f'{len(coefs)} control points, {bad.sum()} corrected. loop: {loop_time:.3f}s, '
+          f'vectorised: {vectorised_time:.4f}s, unfold_bsplines including parsing: {total_time:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+"""
+Time the numpy linear model engine against lmFast.R (if R is installed) on a chunk of a typical voxel-wise analysis,
+and the rank-one update of the specimen-level fits against refitting each specimen with the wild types
+
+Usage
+-----
+With lama installed (pip install -e .)
+$ python benchmarks/linear_model_benchmark.py --points 200000
+"""
+
+import argparse
+import shutil
+import time
+
+import numpy as np
+
+from lama.stats import linear_model
+from lama.tests.test_linear_model import _line_data, NUM_WT, NUM_MUT
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the linear model engines')
+    parser.add_argument('-p', '--points', dest='points', type=int, default=200_000,
+                        help='Number of data points (voxels) to fit')
+    args = parser.parse_args()
+
+    data, info = _line_data(args.points)
+
+    start = time.perf_counter()
+    linear_model.lm_numpy(data, info)
+    numpy_time = time.perf_counter() - start
+    msg = f'{data.shape[1]} points, {NUM_WT} wild types and {NUM_MUT} mutants. numpy: {numpy_time:.2f}s'
+
+    if shutil.which('Rscript'):
+        start = time.perf_counter()
+        linear_model.lm_r(data, info)
+        msg += f', R: {time.perf_counter() - start:.2f}s'
+
+    print(msg)
+
+    y = np.abs(data)
+    groups = info[['genotype', 'staging']]
+    wt, mut = slice(0, NUM_WT), slice(NUM_WT, None)
+
+    start = time.perf_counter()
+    linear_model._fit_specimens(y[wt], groups.iloc[wt], y[mut], groups.iloc[mut])
+    update_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(NUM_MUT):
+        rows = list(range(NUM_WT)) + [NUM_WT + i]
+        linear_model._fit_genotype(y[rows], groups.iloc[rows])
+    refit_time = time.perf_counter() - start
+
+    print(f'{NUM_MUT} specimen-level fits. rank-one update: {update_time:.2f}s, refitting: {refit_time:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
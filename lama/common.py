@@ -36,6 +36,7 @@ from lama.img_processing import read_minc
 from lama.elastix import RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR
 import lama
 INDV_REG_METADATA = 'reg_metadata.yaml'
+REG_CHECKSUM_FILE = 'reg_checksum.md5'  # Written when a registration completes. Used to resume runs
 
 LOG_FILE = 'LAMA.log'
 DEFAULT_VOXEL_SIZE = 28.0
@@ -582,38 +583,20 @@ def get_inputs_from_file_list(file_list_path, config_dir):
     return filtered_paths
 
 
-def average(img_paths: List[Path]) -> sitk.Image:
+def average(img_paths: List[Path], **kwargs) -> sitk.Image:
     """
-    Make a mean itensity volume given a list of volume paths
+    Make a mean itensity volume given a list of volume paths.
+    The volumes are summed as floats and the mean is returned in the dtype of the inputs.
+    kwargs are passed to lama.img_processing.averaging.mean
 
     Returns
     -------
     Mean volume
 
     """
-    img_paths = list(map(str, img_paths))
+    from lama.img_processing import averaging  # Local import as averaging is in img_processing, which common imports from
 
-    # sum all images together
-    first = LoadImage(img_paths[0])
-
-    # Get the direction from the first image.
-    direction_cos = first.direction
-
-    summed = sitk.GetArrayFromImage(sitk.ReadImage(img_paths[0]))
-
-    for image in img_paths[1:]:  # Ommit the first as that is in 'summed'
-        np_array = sitk.GetArrayFromImage(sitk.ReadImage(image))
-        try:
-            summed += np_array
-        except ValueError as e:
-            print(("Numpy can't average this volume {0}".format(image)))
-
-    # Now make average
-    summed //= len(img_paths)
-    avg_img = sitk.GetImageFromArray(summed)
-    avg_img.SetDirection(direction_cos)
-
-    return avg_img
+    return averaging.mean(img_paths, **kwargs)
 
 #
 # def rebuid_subsamlped_output(array, shape, chunk_size):
@@ -6,6 +6,9 @@ Generate jacobians and deformation fields from a LAMA registration run
 """
 
 from lama import common
+from lama.elastix import process_runner, transform_engine
+from lama.elastix.process_runner import stdout_log_path
+from lama.elastix.transform_parameters import TransformParameterFile
 from logzero import logger as logging
 import os
 import sys
@@ -13,16 +16,24 @@ import subprocess
 from pathlib import Path
 from typing import Union, Dict, List
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import SimpleITK as sitk
 import numpy as np
+import pandas as pd
 from lama.registration_pipeline.validate_config import LamaConfig
+from lama.elastix.elastix_registration import split_threads
 
 ELX_TFORM_NAME = 'TransformParameters.0.txt'
 ELX_TFORM_NAME_RESOLUTION = 'TransformParameters.0.R{}.txt'  # resoltion number goes in '{}'
 TRANSFORMIX_LOG = 'transformix.log'
+NEG_JAC_SUMMARY_FILE = 'negative_jacobians.csv'
+# neg_jac_path is the image of the negative jacobian values (others set to 0). Only made if there is folding
+NEG_JAC_SUMMARY_COLUMNS = ['deformation_id', 'specimen_id', 'jac_min', 'jac_max', 'num_neg_voxels', 'summed_neg_jac',
+                           'neg_jac_path']
 
 
-def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Union[None, np.array]:
+def make_deformations_at_different_scales(config: Union[LamaConfig, dict],
+                                          threads: int = None) -> Union[None, pd.DataFrame]:
     """
     Generate jacobian determinants and optionaly defromation vectors
 
@@ -31,6 +42,8 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
     config:
         LamaConfig object if running from other lama module
         Path to config file if running this module independently
+    threads
+        The thread budget to share between the jobs. Defaults to config['threads']
 
     Notes
     -----
@@ -49,9 +62,13 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
 
     affine_192_to_10 = [ "affine", "deformable_192_to_10"]
 
+    Every specimen in every set is a separate job. config['max_parallel_registrations'] jobs are run at once, sharing
+    config['threads'] between them.
+
     Returns
     -------
-    jacobian array if there are any negative values
+    A summary of the jacobians with a row per specimen per deformation set. See NEG_JAC_SUMMARY_COLUMNS
+    None if no deformations are configured
     """
 
     if isinstance(config, (str, Path)):
@@ -68,6 +85,8 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
     write_raw_jacobians = config ['write_raw_jacobians']
     write_log_jacobians = config['write_log_jacobians']
 
+    jobs = []
+
     for deformation_id, stage_info in config['generate_deformation_fields'].items():
         reg_stage_dirs: List[Path] = []
 
@@ -100,13 +119,65 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
         log_jacobians_scale_dir = log_jacobians_dir / deformation_id
         log_jacobians_scale_dir.mkdir()
 
-        neg_jac_arr = _generate_deformation_fields(reg_stage_dirs, resolutions, deformation_scale_dir, jacobians_scale_dir,
-                                                   log_jacobians_scale_dir, write_vectors, write_raw_jacobians, write_log_jacobians,
-                                                   threads=config['threads'], filetype=config['filetype'])
-        return neg_jac_arr
+        for specimen_path in _specimen_dirs(reg_stage_dirs[0]):
+            jobs.append(dict(deformation_id=deformation_id,
+                             specimen_id=specimen_path.name,
+                             registration_dirs=reg_stage_dirs,
+                             resolutions=resolutions,
+                             deformation_dir=deformation_scale_dir,
+                             jacobian_dir=jacobians_scale_dir,
+                             log_jacobians_dir=log_jacobians_scale_dir))
+
+    logging.info(f'### Generating deformation files for {len(jobs)} specimen/deformation sets ###')
+
+    num_parallel = max(1, min(config['max_parallel_registrations'], len(jobs)))
+    threads = split_threads(config['threads'] if threads is None else threads, num_parallel)
+
+    def run_job(job):
+        return _generate_deformation_fields(**job, write_vectors=write_vectors,
+                                            write_raw_jacobians=write_raw_jacobians,
+                                            write_log_jacobians=write_log_jacobians,
+                                            threads=threads, filetype=config['filetype'],
+                                            engine=config['deformation_engine'])
+
+    results = []
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.exception(f"Deformations failed for {job['specimen_id']} ({job['deformation_id']})")
+                failed.append(f"{job['specimen_id']} ({job['deformation_id']}): {e}")
+
+    if failed:
+        raise RuntimeError('Generating deformations failed for:\n' + '\n'.join(failed))
+
+    summary = pd.DataFrame(results, columns=NEG_JAC_SUMMARY_COLUMNS)
+    summary.sort_values(['deformation_id', 'specimen_id'], inplace=True)
+    summary.to_csv(deformation_dir / NEG_JAC_SUMMARY_FILE, index=False)
+
+    folded = summary[summary.num_neg_voxels > 0]
+    if len(folded):
+        logging.warning(f'{len(folded)} specimen/deformation sets have negative jacobians. '
+                        f'See {deformation_dir / NEG_JAC_SUMMARY_FILE}')
+
+    logging.info('Finished generating deformation fields')
+
+    return summary
 
 
-def _generate_deformation_fields(registration_dirs: List,
+def _specimen_dirs(reg_dir: Path) -> List[Path]:
+    return sorted([x for x in reg_dir.iterdir() if x.is_dir()])
+
+
+def _generate_deformation_fields(specimen_id: str,
+                                 deformation_id: str,
+                                 registration_dirs: List,
                                  resolutions: List,
                                  deformation_dir: Path,
                                  jacobian_dir: Path,
@@ -116,64 +187,63 @@ def _generate_deformation_fields(registration_dirs: List,
                                  write_log_jacobians: bool,
                                  threads=None,
                                  filetype='nrrd',
-                                 jacmat=False):
+                                 jacmat=False,
+                                 engine='transformix') -> Dict:
     """
-    Run transformix on the specified registration stage to generate deformation fields and spatial jacobians
-    """
-    logging.info('### Generating deformation files ###')
-
-    specimen_list = [x for x in registration_dirs[0].iterdir() if (registration_dirs[0] / x).is_dir()]
+    Run transformix (or the in-process transform engine) on the specified registration stages for one specimen to
+    generate deformation fields and spatial jacobians
 
-    # if len(specimen_list) < 1:
-    #     logging.warn('Can't find any )
-
-    for specimen_path in specimen_list:
-        specimen_id = specimen_path.name
-        temp_transform_files_dir = deformation_dir / specimen_id
-        temp_transform_files_dir.mkdir(exist_ok=True)
-
-        transform_params = []
-        # Get the transform parameters for the subsequent registrations
+    Returns
+    -------
+    The specimen's row of the negative jacobian summary
+    """
+    temp_transform_files_dir = deformation_dir / specimen_id
+    temp_transform_files_dir.mkdir(exist_ok=True)
 
-        if len(resolutions) == 0:  # Use the whole stages by using the joint transform file
+    transform_params = []
+    # Get the transform parameters for the subsequent registrations
 
-            for reg_dir in registration_dirs:
-                single_reg_dir = reg_dir / specimen_id
-                elastix_tform_file = single_reg_dir / ELX_TFORM_NAME  # Transform file in the registration directory
+    if len(resolutions) == 0:  # Use the whole stages by using the joint transform file
 
-                if not os.path.isfile(elastix_tform_file):
-                    raise FileNotFoundError(f"Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
+        for reg_dir in registration_dirs:
+            single_reg_dir = reg_dir / specimen_id
+            elastix_tform_file = single_reg_dir / ELX_TFORM_NAME  # Transform file in the registration directory
 
-                # Create a new path to copy the transform file to. Then it's in the same forlder as the jacobians etc
-                temp_transform_file = temp_transform_files_dir / f'{reg_dir.name}_{specimen_id}_{elastix_tform_file.name}'
+            if not os.path.isfile(elastix_tform_file):
+                raise FileNotFoundError(f"Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
 
-                shutil.copy(elastix_tform_file, temp_transform_file)
-                transform_params.append(temp_transform_file)
-            _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
+            # Create a new path to copy the transform file to. Then it's in the same forlder as the jacobians etc
+            temp_transform_file = temp_transform_files_dir / f'{reg_dir.name}_{specimen_id}_{elastix_tform_file.name}'
 
-        else:
-            # The resolutdeformation_dirion paramter files are numbered from 0 but the config counts from 1
-            for i in resolutions:
-                i -= 1
-                single_reg_dir = registration_dirs[0] / specimen_id
-                elastix_tform_file = single_reg_dir / ELX_TFORM_NAME_RESOLUTION.format(i)
+            shutil.copy(elastix_tform_file, temp_transform_file)
+            transform_params.append(temp_transform_file)
+        _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
 
-                if not os.path.isfile(elastix_tform_file):
-                    raise FileNotFoundError(f"### Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
+    else:
+        # The resolutdeformation_dirion paramter files are numbered from 0 but the config counts from 1
+        for i in resolutions:
+            i -= 1
+            single_reg_dir = registration_dirs[0] / specimen_id
+            elastix_tform_file = single_reg_dir / ELX_TFORM_NAME_RESOLUTION.format(i)
 
-                temp_transform_file = temp_transform_files_dir / (registration_dirs[0].name + '_' + elastix_tform_file.name)
+            if not os.path.isfile(elastix_tform_file):
+                raise FileNotFoundError(f"### Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
 
-                shutil.copy(elastix_tform_file, temp_transform_file)
-                transform_params.append(temp_transform_file)
+            temp_transform_file = temp_transform_files_dir / (registration_dirs[0].name + '_' + elastix_tform_file.name)
 
-            _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
+            shutil.copy(elastix_tform_file, temp_transform_file)
+            transform_params.append(temp_transform_file)
 
-        # Copy the tp files into the temp directory and then modify to add initail transform
+        _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
 
-        # pass in the last tp file [-1] as the other tp files are internally referenced withinn this file
-        neg_jac_array = _get_deformations(transform_params[-1], deformation_dir, jacobian_dir, log_jacobians_dir, filetype, specimen_id,
-                                          threads, jacmat, write_vectors, write_raw_jacobians, write_log_jacobians)
-        return neg_jac_array
+    # pass in the last tp file [-1] as the other tp files are internally referenced withinn this file
+    # transformix writes to the specimen's own directory so that concurrent jobs don't overwrite each others output
+    summary = _get_deformations(transform_params[-1], deformation_dir, jacobian_dir, log_jacobians_dir, filetype,
+                                specimen_id, threads, jacmat, write_vectors, write_raw_jacobians, write_log_jacobians,
+                                transformix_out_dir=temp_transform_files_dir, engine=engine,
+                                deformation_id=deformation_id)
+    summary['deformation_id'] = deformation_id
+    return summary
 
 
 def _chain_tforms(tforms: List):
@@ -186,20 +256,9 @@ def _chain_tforms(tforms: List):
         return
 
     for i, tp in enumerate(tforms[1:]):
-        initial_tp = tforms[i]
-
-        with open(tp, 'r') as fh:
-            lines = []
-            for line in fh:
-                if line.startswith('(InitialTransformParameterFileName'):
-                    continue
-                lines.append(line)
-
-        previous_tp_str = '(InitialTransformParameterFileName "{}")'.format(initial_tp)
-        lines.insert(0, previous_tp_str + '\n')
-        with open(tp, 'w') as wh:
-            for line in lines:
-                wh.write(line)
+        tp_file = TransformParameterFile.read(tp)
+        tp_file.initial_transform = tforms[i]
+        tp_file.write()
 
 
 def _get_deformations(tform: Path,
@@ -212,17 +271,108 @@ def _get_deformations(tform: Path,
                       make_jacmat: bool,
                       write_vectors: bool = False,
                       write_raw_jacobians: bool = False,
-                      write_log_jacobians: bool = True) -> Union[None, np.array]:
+                      write_log_jacobians: bool = True,
+                      transformix_out_dir: Path = None,
+                      engine: str = 'transformix',
+                      deformation_id: str = None) -> Dict:
     """
     Generate spatial jacobians and optionally deformation files.
 
+    Parameters
+    ----------
+    transformix_out_dir
+        Where transformix writes its output before it is renamed. Defaults to deformation_dir
+    engine
+        'transformix' or 'numpy'. 'numpy' evaluates the transforms in-process with transform_engine and falls back to
+        transformix for transforms it does not support or if the full jacobian matrix is needed
+    deformation_id
+        Added to the name of the negative jacobian image, which is written to the directory shared by all the
+        deformation sets
+
     Returns
     -------
-    the jacobian array if there are any values < 0
+    A summary of the jacobian. See NEG_JAC_SUMMARY_COLUMNS
     """
+    if transformix_out_dir is None:
+        transformix_out_dir = deformation_dir
 
+    new_jac = jacobian_dir / (specimen_id + '.' + filetype)
+
+    jac_arr = None
+    if engine == 'numpy' and not make_jacmat:
+        try:
+            def_img, jac_img = transform_engine.deformation_and_jacobian(tform, displacement=write_vectors)
+        except NotImplementedError as e:
+            logging.warning(f'{specimen_id}: {e}. Using transformix')
+        else:
+            if write_vectors:
+                sitk.WriteImage(def_img, str(deformation_dir / (specimen_id + '.' + filetype)), True)
+            sitk.WriteImage(jac_img, str(new_jac), True)
+            jac_arr = sitk.GetArrayFromImage(jac_img)
+
+    if jac_arr is None:
+        _run_transformix(tform, deformation_dir, jacobian_dir, filetype, specimen_id, threads, make_jacmat,
+                         write_vectors, transformix_out_dir)
+        jac_arr = sitk.GetArrayFromImage(sitk.ReadImage(str(new_jac)))
+
+    # test if there has been any folding in the jacobians
+    jac_min = jac_arr.min()
+    jac_max = jac_arr.max()
+    logging.info("{} spatial jacobian, min:{}, max:{}".format(specimen_id, jac_min, jac_max))
+
+    neg = jac_arr <= 0
+    summary = {'specimen_id': specimen_id,
+               'jac_min': float(jac_min),
+               'jac_max': float(jac_max),
+               'num_neg_voxels': int(neg.sum()),
+               'summed_neg_jac': float(jac_arr[neg].sum()),
+               'neg_jac_path': None}
+
+    if jac_min <= 0:
+        logging.warning(
+            "The jacobian determinant for {} has negative values. You may need to add a penalty term to the later registration stages".format(
+                specimen_id))
+        # Highlight the regions folding
+        jac_neg = np.copy(jac_arr)
+        jac_neg[jac_arr > 0] = 0
+        neg_jac_name = f'ERROR_NEGATIVE_JACOBIANS_{specimen_id}'
+        if deformation_id:
+            neg_jac_name += f'_{deformation_id}'
+        log_jac_path = log_jacobians_dir.parent / f'{neg_jac_name}.{filetype}'
+        common.write_array(jac_neg, log_jac_path)
+        summary['neg_jac_path'] = str(log_jac_path)
+        if write_log_jacobians:
+            jac_arr[jac_arr <= 0] = 1 # make zero and negative jac values equal 1, which is no change
+            #natural log transform jacobians
+            log_jac = np.log(jac_arr)
+            log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
+            common.write_array(log_jac, log_jac_path)
+        #else write_raw_jacobians:
+        else:
+            new_jac.unlink()
+    else:
+        log_jac = np.log(jac_arr)
+        log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
+        common.write_array(log_jac, log_jac_path)
+
+    return summary
+
+
+def _run_transformix(tform: Path,
+                     deformation_dir: Path,
+                     jacobian_dir: Path,
+                     filetype: str,
+                     specimen_id: str,
+                     threads: int,
+                     make_jacmat,
+                     write_vectors: bool,
+                     transformix_out_dir: Path):
+    """
+    Run transformix to make the spatial jacobian (and optionally deformation field and full jacobian matrix) and move
+    the outputs to their final locations
+    """
     cmd = ['transformix',
-           '-out', str(deformation_dir),
+           '-out', str(transformix_out_dir),
            '-tp', str(tform),
            '-jac', 'all'
            ]
@@ -235,75 +385,36 @@ def _get_deformations(tform: Path,
         cmd.extend(['-threads', str(threads)])
 
     try:
-        subprocess.check_output(cmd)
+        process_runner.run(cmd, log_file=stdout_log_path(cmd, transformix_out_dir))
 
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         logging.exception('transformix failed')
         logging.exception(e)
         # raise subprocess.CalledProcessError(f'### Transformix failed ###\nError message: {e}\nelastix command:{cmd}')
         raise ValueError
-    else:
-        deformation_out = deformation_dir / f'deformationField.{filetype}'
-        jacobian_out = deformation_dir / f'spatialJacobian.{filetype}'
-
-        # rename and move output
-        if write_vectors:
-            new_def = deformation_dir / (specimen_id + '.' + filetype)
-            shutil.move(deformation_out, new_def)
 
-        new_jac = jacobian_dir / (specimen_id + '.' + filetype)
-
-        try:
-            shutil.move(jacobian_out, new_jac)
-        except IOError:
-            #  Bit of a hack. If trasforms conatain subtransforms from pairwise, elastix is unable to generate
-            # deformation fields. So try with itk
-            def_img = sitk.ReadImage(new_def)
-            jac_img = sitk.DisplacementFieldJacobianDeterminant(def_img)
-            sitk.WriteImage(jac_img, new_jac)
-
-        # if we have full jacobian matrix, rename and remove that
-        if make_jacmat:
-            make_jacmat.mkdir()
-            jacmat_file = deformation_dir / f'fullSpatialJacobian.{filetype}'  # The name given by elastix
-            jacmat_new = make_jacmat / (specimen_id + '.' + filetype)           # New informative name
-            shutil.move(jacmat_file, jacmat_new)
-
-        # test if there has been any folding in the jacobians
-        jac_img = sitk.ReadImage(str(new_jac))
-        jac_arr = sitk.GetArrayFromImage(jac_img)
-        jac_min = jac_arr.min()
-        jac_max = jac_arr.max()
-        logging.info("{} spatial jacobian, min:{}, max:{}".format(specimen_id, jac_min, jac_max))
-
-        if jac_min <= 0:
-            logging.warning(
-                "The jacobian determinant for {} has negative values. You may need to add a penalty term to the later registration stages".format(
-                    specimen_id))
-            # Highlight the regions folding
-            jac_neg = np.copy(jac_arr)
-            jac_neg[jac_arr > 0] = 0
-            log_jac_path = log_jacobians_dir.parent / ('ERROR_NEGATIVE_JACOBIANS_' + specimen_id + '.' + filetype)
-            common.write_array(jac_neg, log_jac_path)
-            if write_log_jacobians:
-                jac_arr[jac_arr <= 0] = 1 # make zero and negative jac values equal 1, which is no change
-                #natural log transform jacobians
-                log_jac = np.log(jac_arr)
-                log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
-                common.write_array(log_jac, log_jac_path)
-            #else write_raw_jacobians:
-            else:
-                new_jac.unlink()
-        else:
-            log_jac = np.log(jac_arr)
-            log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
-            common.write_array(log_jac, log_jac_path)
-
-
-    logging.info('Finished generating deformation fields')
-
-    if jac_min <=0:
-        return jac_arr
+    deformation_out = transformix_out_dir / f'deformationField.{filetype}'
+    jacobian_out = transformix_out_dir / f'spatialJacobian.{filetype}'
 
+    # rename and move output
+    if write_vectors:
+        new_def = deformation_dir / (specimen_id + '.' + filetype)
+        shutil.move(deformation_out, new_def)
 
+    new_jac = jacobian_dir / (specimen_id + '.' + filetype)
 
+    try:
+        shutil.move(jacobian_out, new_jac)
+    except IOError:
+        #  Bit of a hack. If trasforms conatain subtransforms from pairwise, elastix is unable to generate
+        # deformation fields. So try with itk
+        def_img = sitk.ReadImage(new_def)
+        jac_img = sitk.DisplacementFieldJacobianDeterminant(def_img)
+        sitk.WriteImage(jac_img, new_jac)
+
+    # if we have full jacobian matrix, rename and remove that
+    if make_jacmat:
+        make_jacmat.mkdir()
+        jacmat_file = transformix_out_dir / f'fullSpatialJacobian.{filetype}'  # The name given by elastix
+        jacmat_new = make_jacmat / (specimen_id + '.' + filetype)           # New informative name
+        shutil.move(jacmat_file, jacmat_new)
@@ -1,15 +1,20 @@
 from logzero import logger as logging
 from os.path import join, isdir, splitext, basename, relpath
-import subprocess
 import os
 import shutil
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import List
 import yaml
-import SimpleITK as sitk
 
 from lama.elastix.folding import unfold_bsplines
+from lama.elastix.transform_parameters import TransformParameterFile
 from lama import common
+from lama.img_processing import averaging
+from lama.elastix import process_runner
+from lama.elastix.process_runner import stdout_log_path
+from lama.utilities.config_checksum import registration_checksum
 from lama.elastix import ELX_TRANSFORM_NAME, RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR
 
 RESOLUTION_TP_PREFIX = 'TransformParameters.0.R'
@@ -50,6 +55,11 @@ class ElastixRegistration(object):
         self.filetype = filetype
         self.threads = threads
         self.rename_output = True  # Bodge for pairwise reg, or we end up filling all the disks
+        # How many elastix processes to run at once. The thread budget is split between them
+        self.max_parallel_registrations = 1
+        # How make_average builds the average. See lama.img_processing.averaging.AVERAGE_METHODS
+        self.average_method = 'mean'
+        self.average_trim = 0.1
 
 
     def make_average(self, out_path):
@@ -60,9 +70,7 @@ class ElastixRegistration(object):
         vols = common.get_file_paths(self.stagedir, ignore_folders=[RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR])
         #logging.info("making average from following volumes\n {}".format('\n'.join(vols)))
 
-        average = common.average(vols)
-
-        sitk.WriteImage(average, out_path, True)
+        averaging.write_average(vols, out_path, self.average_method, trim=self.average_trim)
 
 
 class TargetBasedRegistration(ElastixRegistration):
@@ -70,6 +78,10 @@ class TargetBasedRegistration(ElastixRegistration):
         super(TargetBasedRegistration, self).__init__(*args)
         self.fixed = None
         self.fix_folding = False
+        # If True, reuse a complete result from a previous run if the inputs and parameters have not changed
+        self.resume = False
+        # Name of each specimen's output directory. Defaults to the moving image name
+        self.output_dir_name = None
 
     def set_target(self, target):
         self.fixed = target
@@ -84,59 +96,137 @@ class TargetBasedRegistration(ElastixRegistration):
         if len(moving_imgs) < 1:
             raise common.LamaDataException("No volumes in {}".format(self.movdir))
 
-        for mov in moving_imgs:
-            mov_basename = mov.stem
-            outdir = self.stagedir / mov_basename
-            outdir.mkdir(parents=True)
+        num_parallel = min(self.max_parallel_registrations, len(moving_imgs))
+
+        if num_parallel <= 1:
+            for mov in moving_imgs:
+                self._register(mov, self.threads)
+            return
+
+        self._run_parallel(moving_imgs, num_parallel)
+
+    def _run_parallel(self, moving_imgs: List[Path], num_parallel: int):
+        """
+        Run several elastix processes at once, each with a share of the thread budget.
+        A failed specimen does not stop the other in-flight registrations. Failures are collected and raised once all
+        the jobs have finished
+        """
+        threads_per_job = split_threads(self.threads, num_parallel)
 
-            cmd = {'mov': str(mov),
-                   'fixed': str(self.fixed),
-                   'outdir': str(outdir),
-                   'elxparam_file': str(self.elxparam_file),
-                   'threads': self.threads,
-                   'fixed': str(self.fixed)}
-            if self.fixed_mask is not None:
-                cmd['fixed_mask'] = str(self.fixed_mask)
+        logging.info(f'Running {num_parallel} registrations in parallel with {threads_per_job} threads each')
 
-            run_elastix(cmd)
+        failed = []
 
-            # Rename the registered output.
-            if self.rename_output:
-                elx_outfile = outdir / f'result.0.{self.filetype}'
-                new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+        with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+            jobs = {pool.submit(self._register, mov, threads_per_job): mov for mov in moving_imgs}
 
+            for job in as_completed(jobs):
+                mov = jobs[job]
                 try:
-                    shutil.move(elx_outfile, new_out_name)
-                except IOError:
-                    logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
-                    raise
-
-                move_intemediate_volumes(outdir)
-
-            # add registration metadata
-            reg_metadata_path = outdir / common.INDV_REG_METADATA
-            fixed_vol_relative = relpath(self.fixed, outdir)
-            reg_metadata = {'fixed_vol': fixed_vol_relative}
-
-            with open(reg_metadata_path, 'w') as fh:
-                fh.write(yaml.dump(reg_metadata, default_flow_style=False))
-
-            if self.fix_folding:
-                # Remove any folds folds in the Bsplines, overwtite inplace
-                tform_param_file = outdir / ELX_TRANSFORM_NAME
-                unfold_bsplines(tform_param_file, tform_param_file)
-
-                # Retransform the moving image with corrected tform file
-                cmd = [
-                    'transformix',
-                    '-in', str(mov),
-                    '-out', str(outdir),
-                    '-tp', tform_param_file
-                ]
-                subprocess.call(cmd)
-                unfolded_moving_img = outdir / 'result.nrrd'
-                new_out_name.unlink()
-                shutil.move(unfolded_moving_img, new_out_name)
+                    job.result()
+                except Exception as e:
+                    logging.exception(f'Registration of {mov.stem} failed: {e}')
+                    failed.append(mov.stem)
+
+        if failed:
+            raise common.RegistrationException(f'Registration failed for the following specimens: {", ".join(failed)}')
+
+    def _register(self, mov: Path, threads: int):
+        """
+        Register a single moving image to the target and write the output into stagedir/<moving image name>, or
+        stagedir/<output_dir_name> if set
+        """
+        mov_basename = mov.stem
+        outdir = self.stagedir / (self.output_dir_name or mov_basename)
+
+        if self.resume:
+            checksum = self._checksum(mov)
+            if self._is_complete(outdir, mov_basename, checksum):
+                logging.info(f'{mov_basename}: reusing registration from previous run in {outdir}')
+                return
+            shutil.rmtree(outdir, ignore_errors=True)  # Partial or out of date result
+
+        outdir.mkdir(parents=True)
+
+        cmd = {'mov': str(mov),
+               'fixed': str(self.fixed),
+               'outdir': str(outdir),
+               'elxparam_file': str(self.elxparam_file),
+               'threads': threads,
+               'fixed': str(self.fixed)}
+        if self.fixed_mask is not None:
+            cmd['fixed_mask'] = str(self.fixed_mask)
+
+        run_elastix(cmd)
+
+        # Rename the registered output.
+        if self.rename_output:
+            elx_outfile = outdir / f'result.0.{self.filetype}'
+            new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+
+            try:
+                shutil.move(elx_outfile, new_out_name)
+            except IOError:
+                logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
+                raise
+
+            move_intemediate_volumes(outdir)
+
+        # add registration metadata
+        reg_metadata_path = outdir / common.INDV_REG_METADATA
+        fixed_vol_relative = relpath(self.fixed, outdir)
+        reg_metadata = {'fixed_vol': fixed_vol_relative}
+
+        with open(reg_metadata_path, 'w') as fh:
+            fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+
+        if self.fix_folding:
+            # Remove any folds folds in the Bsplines, overwtite inplace
+            tform_param_file = outdir / ELX_TRANSFORM_NAME
+            unfold_bsplines(tform_param_file, tform_param_file, iterative=True)
+
+            # Retransform the moving image with corrected tform file
+            cmd = [
+                'transformix',
+                '-in', str(mov),
+                '-out', str(outdir),
+                '-tp', tform_param_file
+            ]
+            process_runner.run(cmd, log_file=stdout_log_path(cmd, outdir), check=False)
+            unfolded_moving_img = outdir / 'result.nrrd'
+            new_out_name.unlink()
+            shutil.move(unfolded_moving_img, new_out_name)
+
+        if self.resume:
+            # Written last, so its presence marks the registration as complete
+            with open(outdir / common.REG_CHECKSUM_FILE, 'w') as fh:
+                fh.write(checksum)
+
+    def _checksum(self, mov: Path) -> str:
+        with open(self.elxparam_file, 'r') as fh:
+            elx_params = fh.read()
+        return registration_checksum(mov, self.fixed, self.fixed_mask, elx_params, fix_folding=self.fix_folding,
+                                     rename_output=self.rename_output)
+
+    def _is_complete(self, outdir: Path, mov_basename: str, checksum: str) -> bool:
+        """
+        Check whether outdir contains a complete registration made from the same inputs and parameters
+        """
+        checksum_file = outdir / common.REG_CHECKSUM_FILE
+        if not checksum_file.is_file():
+            return False
+
+        with open(checksum_file, 'r') as fh:
+            if fh.read().strip() != checksum:
+                return False
+
+        if not (outdir / ELX_TRANSFORM_NAME).is_file():
+            return False
+
+        if self.rename_output and not (outdir / f'{mov_basename}.{self.filetype}').is_file():
+            return False
+
+        return True
 
 
 class PairwiseBasedRegistration(ElastixRegistration):
@@ -219,18 +309,13 @@ class PairwiseBasedRegistration(ElastixRegistration):
         template = tp_files[0]
         mean_tp_file = join(out_dir, tp_out_name)
 
-        with open(template, 'r') as tf, open(mean_tp_file, 'w') as outf:
-            for line in tf:
-                if line.startswith('(Transform '):
-                    line = '(Transform "WeightedCombinationTransform")\n'
-                if line.startswith('(NumberOfParameters'):
-                    line = '(NumberOfParameters {})\n'.format(len(tp_files))
-                elif line.startswith('(TransformParameters'):
-                    tfparms_str = str('1 ' * len(tp_files)).strip()
-                    line = '(TransformParameters {})\n'.format(tfparms_str)
-                outf.write(line)
-            outf.write('(SubTransforms {})\n'.format(' '.join('"{0}"'.format(x) for x in tp_files)))
-            outf.write('(NormalizeCombinationWeights "true")\n')
+        mean_tp = TransformParameterFile.read(template)
+        mean_tp['Transform'] = 'WeightedCombinationTransform'
+        mean_tp['NumberOfParameters'] = len(tp_files)
+        mean_tp.parameters = [1] * len(tp_files)
+        mean_tp['SubTransforms'] = [str(x) for x in tp_files]
+        mean_tp['NormalizeCombinationWeights'] = 'true'
+        mean_tp.write(mean_tp_file)
 
         cmd = ['transformix',
                '-in', fixed_vol,
@@ -238,7 +323,7 @@ class PairwiseBasedRegistration(ElastixRegistration):
                '-out', out_dir,
                ]
         try:
-            subprocess.check_output(cmd)
+            process_runner.run(cmd, log_file=stdout_log_path(cmd, out_dir))
         except Exception as e:  # Can't seem to log CalledProcessError
             logging.warn('transformix failed {}'.format(', '.join(cmd)))
             raise RuntimeError('### Transformix failed creating average ###\nelastix command:{}'.format(cmd))
@@ -250,6 +335,16 @@ class PairwiseBasedRegistration(ElastixRegistration):
             shutil.move(elx_outfile, new_out_name)
 
 
+def split_threads(threads: int, num_jobs: int) -> int:
+    """
+    Share a thread budget between a number of concurrent jobs. Each job gets at least one thread.
+    If threads is None (elastix default of all cores) the cpu count is used as the budget
+    """
+    if not threads:
+        threads = os.cpu_count()
+    return max(1, int(threads) // max(1, num_jobs))
+
+
 def run_elastix(args):
     cmd = ['elastix',
            '-f', args['fixed'],
@@ -265,10 +360,11 @@ def run_elastix(args):
         cmd.extend(['-fMask', args['fixed_mask']])
 
     try:
-        a = subprocess.check_output(cmd)
+        result = process_runner.run(cmd, log_file=stdout_log_path(cmd, args['outdir']))
     except Exception as e:  # can't seem to log CalledProcessError
-        logging.exception('registration falied:\n\ncommand: {}\n\n error:{}'.format(cmd, e.output))
+        logging.exception('registration falied:\n\ncommand: {}\n\n error:{}'.format(cmd, getattr(e, 'output', e)))
         raise
+    logging.debug(f"elastix took {result.duration:.0f}s, peak memory {result.peak_rss / 1e9:.2f}GB")
 
 
 def move_intemediate_volumes(reg_outdir: Path):
@@ -1,17 +1,21 @@
 from pathlib import Path
-import tempfile
 import os
 import subprocess
 from collections import defaultdict
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import join, abspath, isfile
 from typing import Union, List, Dict
 
 from logzero import logger as logging
 import yaml
+import pandas as pd
 
 from lama import common
 from lama.common import cfg_load
+from lama.elastix import process_runner, scheduler, invert_fields
+from lama.elastix.process_runner import stdout_log_path
+from lama.elastix.elastix_registration import split_threads
+from lama.elastix.transform_parameters import TransformParameterFile
 from lama.registration_pipeline.validate_config import LamaConfig
 
 from lama.elastix import (ELX_TRANSFORM_NAME, ELX_PARAM_PREFIX, PROPAGATE_LABEL_TRANFORM,
@@ -36,6 +40,8 @@ IMAGE_REPLACEMENTS = {
 
 }
 
+INVERSE_CONSISTENCY_CSV = 'inverse_consistency.csv'
+
 
 def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
                                       clobber=True, new_log:bool=False):
@@ -52,13 +58,14 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
 
     new_log:
         Whether to create a new log file. If called from another module, logging may happen there
-    """
-    common.test_installation('elastix')
 
+    If the config has label_propagation: invert_field, the transforms are inverted numerically (see invert_fields)
+    rather than with elastix, and the inverse-consistency error of each is written to inverse_consistency.csv
+    """
     if isinstance(config, (Path, str)):
         config = LamaConfig(config)
 
-    threads = str(config['threads'])
+    threads = config['threads']
 
     if new_log:
         common.init_logging(config / 'invert_transforms.log')
@@ -120,21 +127,15 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
                 'image_transform_file': PROPAGATE_IMAGE_TRANSFORM,
                 'label_transform_file': PROPAGATE_LABEL_TRANFORM,
                 'clobber': clobber,
-                'threads': threads
+                'threads': None  # Set by the scheduler
             }
 
             jobs.append(job)
 
-    # By putting each inverison job (a single job per registration stage) we can speed things up a bit
-    # If we can get multithreded inversion in elastix we can remove this python multithreading
-    pool = Pool(8)
-    try:
-        pool.map(_invert_transform_parameters, jobs)
-
-    except KeyboardInterrupt:
-        print('terminating inversion')
-        pool.terminate()
-        pool.join()
+    if config['label_propagation'] == 'invert_field':
+        _batch_invert_fields(jobs, threads, inv_outdir / INVERSE_CONSISTENCY_CSV)
+    else:
+        _batch_invert_elastix(jobs, threads, config['max_parallel_registrations'])
 
     # TODO: Should we replace the need for this invert.yaml?
     reg_dir = Path(os.path.relpath(reg_stage_dir, inv_outdir))
@@ -146,6 +147,75 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
         yf.write(yaml.dump(dict(stages_to_invert), default_flow_style=False))
 
 
+def _batch_invert_elastix(jobs: List[Dict], threads: int, max_parallel_registrations: int):
+    """
+    Run the elastix inversions from a pool sized for the number of cores and the job lengths, longest jobs first
+    """
+    common.test_installation('elastix')
+
+    # The forward registrations shared the threads between max_parallel_registrations jobs
+    reg_threads = split_threads(threads, max_parallel_registrations)
+    durations = scheduler.estimate_durations([Path(job['transform_file']).parent for job in jobs], reg_threads)
+    plan = scheduler.plan_jobs(durations, int(threads) if threads else os.cpu_count())
+
+    logging.info(f'Inverting {len(jobs)} transforms, {plan.processes} at a time with {plan.threads} threads each')
+
+    with ThreadPoolExecutor(max_workers=plan.processes) as pool:
+        for i in plan.order:
+            jobs[i]['threads'] = str(plan.threads)
+        futures = [pool.submit(_invert_transform_parameters, jobs[i]) for i in plan.order]
+        for future in as_completed(futures):
+            future.result()
+
+
+def _batch_invert_fields(jobs: List[Dict], threads: int, report_path: Path):
+    """
+    Invert the transforms numerically, one at a time as each uses all the threads. Write the inverse-consistency
+    error of each specimen and stage to report_path
+    """
+    logging.info(f'Inverting {len(jobs)} transforms numerically')
+
+    rows = []
+    for job in jobs:
+        row = _invert_field(job, threads)
+        if row:
+            rows.append(row)
+
+    if rows:
+        pd.DataFrame(rows).to_csv(report_path, index=False)
+
+
+def _invert_field(args: Dict, threads: int) -> Union[Dict, None]:
+    """
+    Make the inverted transform parameter files for a single specimen and stage with invert_fields
+
+    Returns
+    -------
+    The inverse-consistency error report, or None if skipped
+    """
+    outdir = Path(args['specimen_stage_inversion_dir'])
+    image_transform_param_path = outdir / args['image_transform_file']
+    label_transform_param_path = outdir / args['label_transform_file']
+
+    if not args['clobber'] and label_transform_param_path.is_file() and image_transform_param_path.is_file():
+        logging.info(f'skipping {outdir} as noclobber is True and inverted parameter files exist')
+        return None
+
+    tp, report = invert_fields.invert_transform_file(args['transform_file'], outdir, threads)
+
+    for path, replacements in [(image_transform_param_path, args['image_replacements']),
+                               (label_transform_param_path, args['label_replacements'])]:
+        for name, value in replacements.items():
+            tp[name] = int(value) if value.isdigit() else value
+        tp.write(path)
+
+    if report['max_error'] > invert_fields.DEFAULT_TOLERANCE * min(tp['Spacing']):
+        logging.warning(f'{outdir}: inverse did not fully converge. '
+                        f'Max inverse-consistency error {report["max_error"]:.3g} after {report["iterations"]} iterations')
+
+    return {'specimen': outdir.name, 'stage': outdir.parent.name, **report}
+
+
 def _invert_transform_parameters(args: Dict):
     """
     Generate a single inverted elastix transform parameter file. This can then be used to invert labels, masks etc.
@@ -272,7 +342,7 @@ def invert_elastix_transform_parameters(fixed: Path, tform_file: Path, param: Pa
 
 
     try:
-        subprocess.check_output(cmd)
+        process_runner.run(cmd, log_file=stdout_log_path(cmd, outdir))
     except (Exception, subprocess.CalledProcessError) as e:
         msg = f'Inverting transform file failed. cmd: {cmd}\n{str(e)}:'
         logging.error(msg)
@@ -292,24 +362,12 @@ def _modify_inverted_tform_file(elx_tform_file: Path, newfile_name: str=None):
     elx_tform_file: str
         path to elastix transform file
     newfile_mame: str
-        path to save modified transform file
+        path to save modified transform file. If None, elx_tform_file is overwritten
     """
-
-    if not newfile_name:  # Write to temporary file before overwriting
-        new_file = tempfile.NamedTemporaryFile().name
-    else:
-        new_file = newfile_name
-
     try:
-
-        with open(new_file, "w+") as new_tform_param_fh,  open(elx_tform_file, "r") as tform_param_fh:
-
-            for line in tform_param_fh:
-                if line.startswith('(InitialTransformParameterFileName'):
-                    line = '(InitialTransformParameterFileName "NoInitialTransform")\n'
-                new_tform_param_fh.write(line)
-            new_tform_param_fh.close()
-            tform_param_fh.close()
+        tp = TransformParameterFile.read(elx_tform_file)
+        tp.initial_transform = None
+        tp.write(newfile_name or elx_tform_file)
 
     except IOError:
         logging.warning("Error reading or writing transform files {}".format(elx_tform_file))
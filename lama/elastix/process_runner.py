@@ -0,0 +1,271 @@
+"""
+Run elastix and transformix (or any other command line tool) from a shared asyncio event loop.
+
+Compared to subprocess.check_output this
+    * streams the tool's stdout to a log file rather than buffering it all in memory
+    * limits how many tools run at once across every thread of the process
+    * can kill and retry a run that exceeds a wall-clock timeout
+    * returns a ProcessResult with the exit code, duration and peak memory of the run
+
+The runner owns one event loop in a background thread. Synchronous callers (all of LAMA at the moment) submit to it
+with run(), which blocks the calling thread only. Code with its own event loop can make its own ProcessRunner and
+await ProcessRunner.run_async() directly.
+
+Examples
+--------
+    from lama.elastix import process_runner
+
+    result = process_runner.run(['transformix', '-tp', tp, '-out', outdir, '-jac', 'all'],
+                                log_file=outdir / 'transformix_stdout.log')
+    logging.info(f'took {result.duration:.0f}s, peak memory {result.peak_rss / 1e9:.1f}GB')
+
+    # Limit concurrency and set a timeout for all runs. Usually done once from the config
+    process_runner.configure(max_concurrent=4, timeout=3600, retries=1)
+"""
+
+import asyncio
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Union, Optional
+
+from logzero import logger as logging
+import psutil
+
+# How many lines of output to keep in memory for error messages
+OUTPUT_TAIL_LINES = 50
+OUTPUT_TAIL_CHUNKS = 4
+STREAM_CHUNK_SIZE = 2 ** 16
+
+
+@dataclass
+class ProcessResult:
+    cmd: List[str]
+    returncode: int
+    duration: float  # Wall-clock seconds of the final attempt
+    peak_rss: int  # Bytes. Sum over the process and its children, sampled every poll_interval
+    attempts: int
+    timed_out: bool
+    log_file: Optional[Path]
+    output_tail: str  # The last OUTPUT_TAIL_LINES lines of output
+
+
+def stdout_log_path(cmd: List, outdir: Union[str, Path]) -> Path:
+    """
+    Get the standard per-job stdout log name for a tool. eg. outdir/elastix_stdout.log
+    """
+    return Path(outdir) / f'{Path(str(cmd[0])).name}_stdout.log'
+
+
+class ProcessRunner:
+    def __init__(self, max_concurrent: int = None, timeout: float = None, retries: int = 0,
+                 poll_interval: float = 1.0):
+        """
+        Parameters
+        ----------
+        max_concurrent
+            The maximum number of processes run at once by this runner. None for no limit
+        timeout
+            Default wall-clock timeout in seconds for each attempt. None for no timeout
+        retries
+            Default number of times to retry a run that times out
+        poll_interval
+            Seconds between memory samples
+        """
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.retries = retries
+        self.poll_interval = poll_interval
+
+        self._loop = None
+        self._semaphore = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Start the background event loop if needed. A forked child (eg. from multiprocessing.Pool) does not inherit
+        the loop thread, so the loop is recreated if the pid has changed
+        """
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._semaphore = None
+                thread = threading.Thread(target=self._loop.run_forever, daemon=True, name='process_runner')
+                thread.start()
+            return self._loop
+
+    def run(self, cmd: List, log_file: Union[str, Path] = None, timeout: float = None, retries: int = None,
+            check: bool = True, cwd: Union[str, Path] = None) -> ProcessResult:
+        """
+        Run a command and block until it finishes.
+
+        Raises
+        ------
+        subprocess.CalledProcessError if check and the command fails. The output attribute has the tail of the output
+        subprocess.TimeoutExpired if check and every attempt timed out
+        """
+        future = asyncio.run_coroutine_threadsafe(self.run_async(cmd, log_file, timeout, retries, cwd),
+                                                  self._get_loop())
+        result = future.result()
+
+        if check:
+            if result.timed_out:
+                raise subprocess.TimeoutExpired(result.cmd, timeout if timeout is not None else self.timeout,
+                                                output=result.output_tail)
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, result.cmd, output=result.output_tail)
+
+        return result
+
+    async def run_async(self, cmd: List, log_file: Union[str, Path] = None, timeout: float = None,
+                        retries: int = None, cwd: Union[str, Path] = None) -> ProcessResult:
+        """
+        Run a command, retrying if it times out. Does not raise if the command fails; check the returned
+        ProcessResult.
+        """
+        cmd = [str(x) for x in cmd]
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        log_file = Path(log_file) if log_file else None
+
+        if self._semaphore is None and self.max_concurrent:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        attempt = 0
+        while True:
+            attempt += 1
+
+            if self._semaphore:
+                async with self._semaphore:
+                    result = await self._run_once(cmd, log_file, timeout, cwd)
+            else:
+                result = await self._run_once(cmd, log_file, timeout, cwd)
+
+            result.attempts = attempt
+
+            if result.timed_out and attempt <= retries:
+                logging.warning(f'{cmd[0]} timed out after {timeout}s. Retrying ({attempt}/{retries})')
+                continue
+
+            return result
+
+    async def _run_once(self, cmd: List[str], log_file: Optional[Path], timeout: Optional[float],
+                        cwd) -> ProcessResult:
+        start = time.time()
+        tail = deque(maxlen=OUTPUT_TAIL_CHUNKS)
+
+        log_fh = None
+        if log_file:
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+            log_fh = open(log_file, 'ab')
+
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.STDOUT, cwd=cwd)
+        except Exception:
+            if log_fh:
+                log_fh.close()
+            raise
+
+        peak_rss = 0
+        timed_out = False
+
+        async def stream_output():
+            # Read in chunks rather than lines so a very long line can't overrun the stream buffer
+            while True:
+                chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                tail.append(chunk)
+                if log_fh:
+                    log_fh.write(chunk)
+
+        async def sample_memory():
+            nonlocal peak_rss
+            while True:
+                peak_rss = max(peak_rss, _tree_rss(proc.pid))
+                await asyncio.sleep(self.poll_interval)
+
+        streamer = asyncio.ensure_future(stream_output())
+        sampler = asyncio.ensure_future(sample_memory())
+
+        try:
+            await asyncio.wait_for(asyncio.shield(streamer), timeout)
+            await proc.wait()
+        except asyncio.TimeoutError:
+            timed_out = True
+            _kill_tree(proc.pid)
+            await proc.wait()
+            await streamer
+        finally:
+            sampler.cancel()
+            if log_fh:
+                log_fh.close()
+
+        return ProcessResult(cmd=cmd,
+                             returncode=proc.returncode,
+                             duration=time.time() - start,
+                             peak_rss=peak_rss,
+                             attempts=1,
+                             timed_out=timed_out,
+                             log_file=log_file,
+                             output_tail=_last_lines(b''.join(tail)))
+
+
+def _last_lines(output: bytes) -> str:
+    return '\n'.join(output.decode(errors='replace').splitlines()[-OUTPUT_TAIL_LINES:])
+
+
+def _tree_rss(pid: int) -> int:
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for p in procs:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+def _kill_tree(pid: int):
+    try:
+        proc = psutil.Process(pid)
+        procs = proc.children(recursive=True) + [proc]
+    except psutil.NoSuchProcess:
+        return
+    for p in procs:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+# The runner shared by all the elastix/transformix calls in LAMA
+_runner = ProcessRunner()
+
+
+def configure(max_concurrent: int = None, timeout: float = None, retries: int = 0):
+    """
+    Set the concurrency limit, default timeout and retries of the shared runner. Call before any processes are run
+    """
+    _runner.max_concurrent = max_concurrent
+    _runner.timeout = timeout
+    _runner.retries = retries
+    _runner._semaphore = None
+
+
+def run(cmd: List, log_file: Union[str, Path] = None, **kwargs) -> ProcessResult:
+    """
+    Run a command with the shared runner. See ProcessRunner.run
+    """
+    return _runner.run(cmd, log_file, **kwargs)
@@ -40,21 +40,35 @@ will be 256. It seems that if this is larger than the input image dimensions, th
 from pathlib import Path
 from typing import List
 import os
-import subprocess
 from os.path import join
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from logzero import logger as logging
 import yaml
+import SimpleITK as sitk
+import numpy as np
 
 from lama import common
 from lama.common import cfg_load
+from lama.elastix import process_runner, transform_engine
+from lama.elastix.process_runner import stdout_log_path
+from lama.elastix.transform_parameters import TransformParameterFile
+from lama.elastix.elastix_registration import split_threads
 from lama.elastix import (PROPAGATE_LABEL_TRANFORM, PROPAGATE_IMAGE_TRANSFORM, ELX_PARAM_PREFIX, TRANSFORMIX_OUT,
                           ELX_TRANSFORM_NAME, ELX_INVERTED_POINTS_NAME, PROPAGATE_CONFIG)
 
 
+PROPAGATION_BACKENDS = ('transformix', 'sitk')
+PROPAGATION_DONE = 'propagation.done'
+PACKED_LABELS_NAME = 'packed_labels_and_mask.nrrd'
+
+# Smallest first. The dtypes a packed label map can have and their elastix ResultImagePixelType
+PACKED_PIXEL_TYPES = [(np.uint8, 'unsigned char'), (np.uint16, 'unsigned short'), (np.uint32, 'unsigned int')]
+
+
 class Propagate(object):
-    def __init__(self, config_path: Path, invertable, outdir, threads=None, noclobber=False):
+    def __init__(self, config_path: Path, invertable, outdir, threads=None, noclobber=False, backend='transformix'):
         """
         Inverts a series of volumes. A yaml config file specifies the order of inverted transform parameters
         to use. This config file should be in the root of the directory containing these inverted tform dirs.
@@ -78,12 +92,20 @@ class Propagate(object):
                 If path to object (eg. labelmap) invert that instead
         noclobber: bool
             if True do not overwrite already inverted labels
+        backend
+            'transformix' or 'sitk'. 'sitk' resamples in-process with SimpleITK where the transforms allow it and
+            falls back to transformix otherwise
 
         """
 
         self.noclobber = noclobber
 
-        common.test_installation('transformix')
+        if backend not in PROPAGATION_BACKENDS:
+            raise ValueError(f'propagation backend should be one of {PROPAGATION_BACKENDS}')
+        self.backend = backend
+
+        if backend == 'transformix':
+            common.test_installation('transformix')
 
         self.config = cfg_load(config_path)
 
@@ -96,34 +118,46 @@ class Propagate(object):
 
         self.elx_param_prefix = ELX_PARAM_PREFIX
         self.PROPAGATION_TFORM_NAME = None  # Set in subclasses
+        self.tform_replacements = {}  # Extra transform parameters to set in the propagation transform files
         self.last_invert_dir = None # I thik this is used as a way to find volumes to do organ vol calculation on
 
-    def run(self):
+    def run(self, max_parallel: int = 1):
         """
+        Propagate the invertable onto every specimen
 
+        Parameters
+        ----------
+        max_parallel
+            How many specimens to propagate at once. self.threads is shared between them
         """
-        # temp_tform_dir = Path('/home/neil/Desktop/t/test_propagarte/temp')
-        done_file = self.out_dir / 'propagation.done'
-
-        common.touch(done_file)
+        run_propagations([self], max_parallel, self.threads)
 
-        vol_ids = os.listdir(self._transform_dirs()[0])
-
-        logging.info('propagating volumes')
-
-        for i, id_ in enumerate(vol_ids):
+    def jobs(self) -> List[dict]:
+        """
+        The propagation jobs of this object. One per specimen
+        """
+        vol_ids = sorted(os.listdir(self._transform_dirs()[0]))
+        return [{'propagator': self, 'id': id_, 'outdir': self.out_dir / id_} for id_ in vol_ids]
 
-            prop_out_dir: Path = self.out_dir / id_  # create a folder with vol_id in case we have multiple vols to do
-            prop_out_dir.mkdir(exist_ok=True)
+    def run_job(self, job: dict, threads=None):
+        """
+        Propagate onto one specimen
+        """
+        prop_out_dir: Path = job['outdir']  # create a folder with vol_id in case we have multiple vols to do
+        prop_out_dir.mkdir(exist_ok=True)
 
-            tform_root = self.config_dir
-            init_tform = chain_tforms(tform_root, prop_out_dir, self.PROPAGATION_TFORM_NAME, self.config)
+        tform_root = self.config_dir
+        init_tform = chain_tforms(tform_root, prop_out_dir, self.PROPAGATION_TFORM_NAME, self.config, job['id'],
+                                  self.tform_replacements)
 
-            propagated = self._propagate(self.invertables, init_tform, prop_out_dir, self.threads)
+        return self._propagate(self.invertables, init_tform, prop_out_dir, threads)
 
-            if not propagated: # If inversion failed or there is nocobber, will get None
-                continue
+    def output_dirs(self) -> List[Path]:
+        return [self.out_dir]
 
+    def mark_done(self):
+        for out_dir in self.output_dirs():
+            common.touch(out_dir / PROPAGATION_DONE)
         self.last_invert_dir = self.out_dir
 
     def _propagate(self):
@@ -139,6 +173,9 @@ class Propagate(object):
 
 class PropagateLabelMap(Propagate):
 
+    # Used by the sitk backend
+    INTERPOLATOR = sitk.sitkNearestNeighbor
+
     def __init__(self, *args, **kwargs):
         super(PropagateLabelMap, self).__init__(*args, **kwargs)
         self.PROPAGATION_TFORM_NAME = PROPAGATE_LABEL_TRANFORM
@@ -184,6 +221,16 @@ class PropagateLabelMap(Propagate):
         # 2: where the folder exists but the final output file does not exist
         #     return None
 
+        if self.backend == 'sitk':
+            try:
+                img = transform_engine.resample(labelmap, tform, self.INTERPOLATOR, threads)
+            except NotImplementedError as e:
+                logging.warning(f'{e}. Propagating {id_} with transformix')
+            else:
+                compress = TransformParameterFile.read(tform).get('CompressResultImage', ['false'])[0] == 'true'
+                sitk.WriteImage(img, str(new_output_name), compress)
+                return new_output_name
+
         cmd = [
             'transformix',
             '-in', str(labelmap),
@@ -194,7 +241,7 @@ class PropagateLabelMap(Propagate):
         if threads:
             cmd.extend(['-threads', str(threads)])
         try:
-            subprocess.check_output(cmd)
+            process_runner.run(cmd, log_file=stdout_log_path(cmd, outdir))
         except Exception as e:
             logging.exception('{}\ntransformix failed propagating labelmap: {}'.format(e, labelmap))
             raise
@@ -213,11 +260,94 @@ class PropagateHeatmap(PropagateLabelMap):
     """
     This class behaves the same as InvertLabelap but uses a different transform parameter file
     """
+    INTERPOLATOR = sitk.sitkLinear
+
     def __init__(self, *args, **kwargs):
         super(PropagateHeatmap, self).__init__(*args, **kwargs)
         self.invert_transform_name = PROPAGATE_IMAGE_TRANSFORM
         self.PROPAGATION_TFORM_NAME = PROPAGATE_IMAGE_TRANSFORM
 
+class PropagatePackedLabelMap(PropagateLabelMap):
+    """
+    Propagate a label map and a mask in a single pass.
+
+    The mask is packed into the bit above the highest label (eg. labels 1-100 and the mask as 128), the packed map is
+    propagated with nearest neighbour interpolation like a normal label map, and each result is split back into the
+    label map (in out_dir) and the mask (in mask_outdir)
+    """
+    def __init__(self, config_path: Path, label_map: Path, mask: Path, outdir: Path, mask_outdir: Path, *args,
+                 **kwargs):
+        packed_path = config_path.parent / PACKED_LABELS_NAME
+        self.mask_bit, self.label_pixel_id, pixel_type = pack_mask(label_map, mask, packed_path)
+
+        super(PropagatePackedLabelMap, self).__init__(config_path, packed_path, outdir, *args, **kwargs)
+
+        self.mask_outdir = mask_outdir
+        common.mkdir_if_not_exists(self.mask_outdir)
+        self.tform_replacements['ResultImagePixelType'] = pixel_type
+
+    def output_dirs(self) -> List[Path]:
+        return [self.out_dir, self.mask_outdir]
+
+    def run_job(self, job: dict, threads=None):
+        packed = super(PropagatePackedLabelMap, self).run_job(job, threads)
+
+        mask_dir = self.mask_outdir / job['id']
+        mask_dir.mkdir(exist_ok=True)
+        unpack_mask(packed, self.mask_bit, self.label_pixel_id, packed, mask_dir / Path(packed).name)
+        return packed
+
+
+def pack_mask(label_map: Path, mask: Path, out_path: Path):
+    """
+    Write a label map with the mask packed into the bit above its highest label
+
+    Returns
+    -------
+    The mask bit, the SimpleITK pixel ID of the label map and the elastix ResultImagePixelType to propagate with
+    """
+    labels = sitk.ReadImage(str(label_map))
+    label_arr = sitk.GetArrayFromImage(labels)
+    mask_arr = sitk.GetArrayFromImage(sitk.ReadImage(str(mask)))
+
+    if label_arr.shape != mask_arr.shape:
+        raise ValueError(f'The label map {label_map} and mask {mask} have different shapes')
+    if label_arr.min() < 0:
+        raise ValueError('Cannot pack a mask into a label map with negative labels')
+
+    mask_bit = int(label_arr.max()).bit_length()
+
+    for dtype, pixel_type in PACKED_PIXEL_TYPES:
+        if mask_bit < np.iinfo(dtype).bits:
+            break
+    else:
+        raise ValueError(f'Labels up to {label_arr.max()} are too large to pack a mask into')
+
+    packed = label_arr.astype(dtype) | ((mask_arr != 0).astype(dtype) << mask_bit)
+
+    packed_img = sitk.GetImageFromArray(packed)
+    packed_img.CopyInformation(labels)
+    sitk.WriteImage(packed_img, str(out_path), True)
+
+    return mask_bit, labels.GetPixelID(), pixel_type
+
+
+def unpack_mask(packed_path: Path, mask_bit: int, label_pixel_id: int, label_out: Path, mask_out: Path):
+    """
+    Split a propagated packed label map back into the label map and the mask
+    """
+    packed = sitk.ReadImage(str(packed_path))
+    arr = sitk.GetArrayFromImage(packed)
+
+    mask = ((arr >> mask_bit) & 1).astype(np.uint8)
+    labels = arr & ((1 << mask_bit) - 1)
+
+    for out_arr, pixel_id, out_path in [(mask, sitk.sitkUInt8, mask_out), (labels, label_pixel_id, label_out)]:
+        img = sitk.Cast(sitk.GetImageFromArray(out_arr), pixel_id)
+        img.CopyInformation(packed)
+        sitk.WriteImage(img, str(out_path), True)
+
+
 class PropagateMeshes(Propagate):
 
     def __init__(self, config_path, invertable, outdir, threads=None):
@@ -274,7 +404,7 @@ class PropagateMeshes(Propagate):
         if threads:
             cmd.extend(['-threads', str(threads)])
         try:
-            subprocess.check_output(cmd)
+            process_runner.run(cmd, log_file=stdout_log_path(cmd, outdir))
         except Exception as e:
             logging.exception('transformix failed with this command: {}\nerror message:'.format(cmd), exc_info=True)
             raise
@@ -370,7 +500,7 @@ class PropagateSingleVol(Propagate):
         if threads:
             cmd.extend(['-threads', str(threads)])
         try:
-            subprocess.check_output(cmd)
+            process_runner.run(cmd, log_file=stdout_log_path(cmd, outdir))
         except Exception as e:
             logging.exception('transformix failed propagating volume: {} Is transformix installed?. Error: {}'.format(volume, e))
             raise
@@ -384,7 +514,88 @@ class PropagateSingleVol(Propagate):
             return new_img_path
 
 
-def chain_tforms(root_dir: Path, new_tform_dir, tform_name, config):
+def run_propagations(propagators: List[Propagate], max_parallel: int = 1, threads: int = None):
+    """
+    Run the propagation of every (specimen, invertable) pair of the propagators from one bounded pool, so that for
+    example the stats mask and label map of all specimens are propagated together.
+
+    Each propagator's propagation.done file is written once all the jobs have finished, if all of its own specimens
+    were propagated successfully
+
+    Parameters
+    ----------
+    propagators
+        eg. [PropagateLabelMap(config, mask, ...), PropagateLabelMap(config, labels, ...)]
+    max_parallel
+        The maximum number of propagations to run at once
+    threads
+        The thread budget shared by the concurrent propagations. None for all cpus
+
+    Raises
+    ------
+    RuntimeError if any of the propagations failed, after all the others have finished
+    """
+    # A marker left by a previous run would mark this one finished if it fails
+    for propagator in propagators:
+        for out_dir in propagator.output_dirs():
+            done_file = out_dir / PROPAGATION_DONE
+            if done_file.is_file():
+                done_file.unlink()
+
+    jobs = [job for p in propagators for job in p.jobs()]
+
+    num_parallel = max(1, min(max_parallel or 1, len(jobs)))
+    job_threads = split_threads(threads, num_parallel)
+
+    logging.info(f'propagating volumes: {len(jobs)} jobs, {num_parallel} at a time with {job_threads} threads each')
+
+    failed = []
+    failed_propagators = set()
+
+    with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+        futures = {pool.submit(job['propagator'].run_job, job, job_threads): job for job in jobs}
+
+        for i, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            propagator = job['propagator']
+            try:
+                future.result()
+            except Exception as e:
+                logging.exception(f"Propagating {propagator.invertables} onto {job['id']} failed")
+                failed.append(f"{job['id']} ({propagator.invertables}): {e}")
+                failed_propagators.add(propagator)
+            else:
+                logging.info(f"propagated {Path(str(propagator.invertables)).name} onto {job['id']} "
+                             f"({i}/{len(jobs)})")
+
+    for propagator in propagators:
+        if propagator not in failed_propagators:
+            propagator.mark_done()
+
+    if failed:
+        raise RuntimeError('Propagation failed for:\n' + '\n'.join(failed))
+
+
+def chain_tforms(root_dir: Path, new_tform_dir, tform_name, config, specimen_id: str = None,
+                 replacements: dict = None):
+    """
+    Copy the propagation transform of each stage to new_tform_dir and link them with InitialTransformParameterFileName
+
+    Parameters
+    ----------
+    specimen_id
+        The specimen whose transforms to chain. If None, the first transform found in each stage directory is used
+    replacements
+        Extra parameters to set in each transform file. eg. {'ResultImagePixelType': 'unsigned short'}
+
+    Returns
+    -------
+    The transform file of the first stage, to give to transformix
+
+    Raises
+    ------
+    FileNotFoundError if specimen_id is given and a stage has no transform for it
+    """
 
     #label_replacements = {
     #    'FinalBSplineInterpolationOrder': '0',
@@ -405,9 +616,13 @@ def chain_tforms(root_dir: Path, new_tform_dir, tform_name, config):
     # stages = stages[::-1]
     for i, stage in enumerate(stages):
         stage_dir = root_dir / stage
-        tform_file = next(stage_dir.glob(f'**/{tform_name}'))
-        new_tform_file = new_tform_dir /  f'{stage}_{tform_file.name}'
-        shutil.copyfile(tform_file, new_tform_file)
+        if specimen_id:
+            tform_file = stage_dir / specimen_id / tform_name
+            if not tform_file.is_file():
+                raise FileNotFoundError(f'Cannot find the {stage} propagation transform for {specimen_id}: {tform_file}')
+        else:
+            # Legacy: a single specimen in each stage directory
+            tform_file = next(stage_dir.glob(f'**/{tform_name}'))
 
         if i + 1 < len(stages):
             init_tform = new_tform_dir /  f'{stages[i+1]}_{tform_file.name}'
@@ -421,17 +636,14 @@ def chain_tforms(root_dir: Path, new_tform_dir, tform_name, config):
         if i == 0:
             file_for_transformix = new_tform_path
 
-        with open(tform_file, 'r') as fh, open(new_tform_path, 'w') as nfh:
-
-            for line in fh:
-                #
-                if line.startswith('(InitialTransformParameterFileName') and init_tform:
-                    line = f'(InitialTransformParameterFileName "{str(init_tform)}")\n'
-                else:
-                    for param in label_replacements:
-                        if line.startswith(f'({param}'):
-                            line = f'({param} {label_replacements[param]})\n'
-
-                nfh.write(line)
+        tp = TransformParameterFile.read(tform_file)
+        if init_tform:
+            tp.initial_transform = init_tform
+        for param, value in label_replacements.items():
+            if param in tp:
+                tp[param] = value
+        for param, value in (replacements or {}).items():
+            tp[param] = value
+        tp.write(new_tform_path)
 
     return file_for_transformix
@@ -44,8 +44,8 @@ Example structure of output folder generated by this module
 """
 
 from pathlib import Path
-from os.path import join
-from typing import Union, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Union, Dict, List
 import os
 import shutil
 
@@ -56,23 +56,39 @@ from lama import common
 from lama.registration_pipeline.validate_config import LamaConfig
 from lama.registration_pipeline import run_lama
 from lama.paths import LamaSpecimenData
-from lama.elastix.elastix_registration import move_intemediate_volumes
 
 from lama.elastix import (ELX_TRANSFORM_NAME, ELX_PARAM_PREFIX, PROPAGATE_LABEL_TRANFORM,
                           PROPAGATE_IMAGE_TRANSFORM, PROPAGATE_CONFIG)
 from lama.elastix.invert_transforms import (LABEL_REPLACEMENTS, IMAGE_REPLACEMENTS,
                                             )
-from lama.elastix.elastix_registration import TargetBasedRegistration
+from lama.elastix.elastix_registration import TargetBasedRegistration, split_threads
 
+# Files kept in each specimen's stage directory once its reverse registration has finished
+TO_KEEP = [PROPAGATE_LABEL_TRANFORM, 'elastix.log', PROPAGATE_IMAGE_TRANSFORM]
 
-def reverse_registration(config: Union[str, LamaConfig]):
+
+def reverse_registration(config: Union[str, LamaConfig], threads: int = None,
+                         elastix_stage_parameters: Dict[str, str] = None):
+    """
+    Register the population average to each specimen through all the registration stages.
+
+    The specimens are independent, so up to config['max_parallel_registrations'] of them are registered at once,
+    sharing the thread budget as the forward registrations do. Each specimen moves on to its next stage as soon as
+    its previous stage has finished
+
+    Parameters
+    ----------
+    threads
+        The thread budget to share between the specimens. Defaults to config['threads']
+    elastix_stage_parameters
+        The output of run_lama.generate_elx_parameters. Pass it in when running alongside other stages, as
+        generating it modifies the config
+    """
     common.test_installation('elastix')
 
     if isinstance(config, (Path, str)):
         config = LamaConfig(Path(config))
 
-    # threads = str(config['threads'])
-
     inv_outdir = config.mkdir('inverted_transforms')
 
     # Set the fixed volume to be the rigidly-aligned volume from the forward registration
@@ -84,45 +100,118 @@ def reverse_registration(config: Union[str, LamaConfig]):
     # Get the fixed and moving images. They are flipped compared to the forward registration
     moving_vol = config['fixed_volume']
 
-    # Do the forward registration for each image (usually just one image if using the jobrunner script)
-    for fixed_vol in fixed_vol_paths:
-        run_registration_schedule(config, fixed_vol, moving_vol, inv_outdir)
+    # The elastix parameter files are shared by all the specimens
+    elxparam_paths = write_stage_parameters(config, inv_outdir, elastix_stage_parameters)
+
+    num_parallel = max(1, min(config['max_parallel_registrations'], len(fixed_vol_paths)))
+    threads = split_threads(config['threads'] if threads is None else threads, num_parallel)
+
+    logging.info(f'### Reverse registration of {len(fixed_vol_paths)} specimens, {num_parallel} at a time '
+                 f'using {threads} threads each ###')
+
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+        jobs = {pool.submit(run_registration_schedule, config, fixed_vol, moving_vol, inv_outdir, threads,
+                            elxparam_paths): fixed_vol for fixed_vol in fixed_vol_paths}
+
+        for job in as_completed(jobs):
+            fixed_vol = jobs[job]
+            try:
+                job.result()
+            except Exception as e:
+                logging.exception(f'Reverse registration of {fixed_vol.stem} failed: {e}')
+                failed.append(fixed_vol.stem)
+            else:
+                logging.info(f'{fixed_vol.stem}: reverse registration finished')
+
+    for elxparam_path in elxparam_paths.values():
+        os.remove(elxparam_path)
+
+    if failed:
+        raise common.RegistrationException(f'Reverse registration failed for the following specimens: '
+                                           f'{", ".join(failed)}')
+
+    logging.info("### Reverse registration finished ###")
+
+    d = {'label_propagation_order': list(elxparam_paths.keys())}
+    with open(inv_outdir / PROPAGATE_CONFIG, 'w') as fh:
+        yaml.dump(d, fh)
+
+
+def write_stage_parameters(config: LamaConfig, outdir: Path,
+                           elastix_stage_parameters: Dict[str, str] = None) -> Dict[str, Path]:
+    """
+    Make the stage output directories and write the elastix parameter file for each stage into them
+
+    Returns
+    -------
+    stage_id: parameter file path, in registration order
+    """
+    if elastix_stage_parameters is None:
+        elastix_stage_parameters = run_lama.generate_elx_parameters(config)
+
+    elxparam_paths = {}
 
+    for reg_stage in config['registration_stage_params']:
+        stage_id = reg_stage['stage_id']
+        stage_dir = outdir / stage_id
+        stage_dir.mkdir(exist_ok=True)
+
+        elxparam_path = stage_dir / f'{ELX_PARAM_PREFIX}{stage_id}.txt'
 
-def run_registration_schedule(config: LamaConfig, fixed_vol, moving_vol: Path, outdir: Path) -> Path:
+        with open(elxparam_path, 'w') as fh:
+            fh.write(elastix_stage_parameters[stage_id])
+
+        elxparam_paths[stage_id] = elxparam_path
+
+    return elxparam_paths
+
+
+def run_registration_schedule(config: LamaConfig, fixed_vol: Path, moving_vol: Path, outdir: Path,
+                              threads: int = None, elxparam_paths: Dict[str, Path] = None) -> List[Path]:
     """
-    Run the registrations specified in the config file, but flip the moving and fixed images
+    Run the registrations specified in the config file for a single specimen, but flip the moving and fixed images
+
+    Parameters
+    ----------
+    config
+    fixed_vol
+        The specimen
+    moving_vol
+        The population average
+    outdir
+        The inverted transforms directory
+    threads
+        Threads for each elastix call. Defaults to config['threads']
+    elxparam_paths
+        The parameter file for each stage, from write_stage_parameters. If None, they are written and removed
+        afterwards
 
     Returns
     -------
-    The path to the final registrered images
+    The specimen's output directory for each stage
     """
     # egp = {'WriteResultImage': 'false',   # We only need the tform files not the images
     #        'WriteResultImageAfterEachResolution': 'true'}
 
-    elastix_stage_parameters = run_lama.generate_elx_parameters(config)
+    remove_params = elxparam_paths is None
+    if remove_params:
+        elxparam_paths = write_stage_parameters(config, outdir)
+
+    if threads is None:
+        threads = config['threads']
 
-    # Set the moving volume dir and the fixed image for the first stage
-    #  Set the fixed volume up for the first stage. This will checnge each stage if doing population average
-    stage_ids = []
     stage_spec_dirs = []
 
-    for i, reg_stage in enumerate(config['registration_stage_params']):
+    for stage_id, elxparam_path in elxparam_paths.items():
 
-        #  Make the stage output dir
-        stage_id = reg_stage['stage_id']
-        stage_ids.append(stage_id)
         stage_dir = outdir / stage_id
-        stage_dir.mkdir(exist_ok=True)
 
-        logging.info("### Reverse registration - current registration step: {} ###".format(stage_id))
+        logging.info(f"{fixed_vol.stem}: reverse registration step {stage_id}")
 
-        # Make the elastix parameter file for this stage
-        elxparam = elastix_stage_parameters[stage_id]
-        elxparam_path = join(stage_dir, ELX_PARAM_PREFIX + stage_id + '.txt')
-
-        with open(elxparam_path, 'w') as fh:
-            fh.write(elxparam)
+        # Remove any output from a previous run
+        shutil.rmtree(stage_dir / fixed_vol.stem, ignore_errors=True)
 
         # maybe we should add fixed mask
         fixed_mask = None
@@ -132,12 +221,15 @@ def run_registration_schedule(config: LamaConfig, fixed_vol, moving_vol: Path, o
                                  moving_vol,
                                  stage_dir,
                                  config['filetype'],
-                                 config['threads'],
+                                 threads,
                                  fixed_mask
                                  )
 
         registrator.set_target(fixed_vol)
 
+        # The moving image is the same for every specimen, so name the output directory after the fixed image
+        registrator.output_dir_name = fixed_vol.stem
+
         # issues/133: switch off fix folding for label propagation until fixed
         registrator.fix_folding = False
 
@@ -147,42 +239,32 @@ def run_registration_schedule(config: LamaConfig, fixed_vol, moving_vol: Path, o
         #         registrator.fix_folding = True
 
         registrator.run()  # Do the registrations for a single stage
-        os.remove(elxparam_path)
 
-        # As the stage output diretory is named as the moving image, but in this case we want it named the same as the
-        # fixed image
-        stage_spec_dir = next(stage_dir.glob(f'*{moving_vol.stem}'))
         new_stage_spec_dir = stage_dir / fixed_vol.stem
-        stage_spec_dir.rename(new_stage_spec_dir)
-
         stage_spec_dirs.append(new_stage_spec_dir)
 
         moving_vol = new_stage_spec_dir / moving_vol.name
 
-        src_tform_file = stage_dir / fixed_vol.stem / ELX_TRANSFORM_NAME
-        label_tform_file = stage_dir / fixed_vol.stem / PROPAGATE_LABEL_TRANFORM
-        image_tform_file = stage_dir / fixed_vol.stem / PROPAGATE_IMAGE_TRANSFORM
+        src_tform_file = new_stage_spec_dir / ELX_TRANSFORM_NAME
+        label_tform_file = new_stage_spec_dir / PROPAGATE_LABEL_TRANFORM
+        image_tform_file = new_stage_spec_dir / PROPAGATE_IMAGE_TRANSFORM
         modify_elx_parameter_file(src_tform_file, label_tform_file, LABEL_REPLACEMENTS)
         modify_elx_parameter_file(src_tform_file, image_tform_file, IMAGE_REPLACEMENTS)
 
-        # move_intemediate_volumes(stage_dir)
-
-    logging.info("### Reverse registration finished ###")
+    if remove_params:
+        for elxparam_path in elxparam_paths.values():
+            os.remove(elxparam_path)
 
     # Now delete everything we don't need
-    to_keep = [PROPAGATE_LABEL_TRANFORM, 'elastix.log', PROPAGATE_IMAGE_TRANSFORM]
-
     for s in stage_spec_dirs:
         for f in s.iterdir():
-            if f.name not in to_keep:
+            if f.name not in TO_KEEP:
                 try:
                     shutil.rmtree(f)
                 except NotADirectoryError:
                     f.unlink()
 
-    d = {'label_propagation_order': stage_ids}
-    with open(outdir / PROPAGATE_CONFIG, 'w') as fh:
-        yaml.dump(d, fh)
+    return stage_spec_dirs
 
 
 def modify_elx_parameter_file(elx_param_file: Path, newfile_name: str, replacements: Dict):
@@ -0,0 +1,183 @@
+"""
+Choose how many elastix jobs to run at once, and with how many threads each, for a batch of jobs of different lengths.
+
+Each job's run time on t threads is modelled with Amdahl's law, t_job = duration * ((1 - p) + p / t), where duration is
+the single-thread time and p the parallel fraction of elastix. For every possible number of concurrent processes
+the thread budget is split evenly, the jobs are list-scheduled longest first (LPT) and the makespan is simulated.
+The plan with the shortest makespan is used.
+
+Job durations come from the elastix logs of the forward registrations the jobs derive from (inverting a transform
+takes roughly as long as making it). When there is no log, a relative weight for the transform type is used.
+
+Examples
+--------
+    durations = estimate_durations(specimen_stage_dirs, threads=4)
+    plan = plan_jobs(durations, cores=16)
+    with ThreadPoolExecutor(plan.processes) as pool:
+        for i in plan.order:
+            pool.submit(run, jobs[i], threads=plan.threads)
+"""
+
+import heapq
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Sequence, Union
+
+from lama.elastix.transform_parameters import TransformParameterFile
+
+# Proportion of an elastix run that scales with threads. Registration is dominated by the metric computation, which
+# is multithreaded, but the image pyramids, resampling and i/o are not
+DEFAULT_PARALLEL_FRACTION = 0.8
+
+# Relative run time of each transform type when there is no elastix log to go on
+TRANSFORM_WEIGHTS = {
+    'EulerTransform': 1.0,
+    'SimilarityTransform': 1.0,
+    'AffineTransform': 1.5,
+    'BSplineTransform': 10.0
+}
+DEFAULT_TRANSFORM_WEIGHT = 5.0
+
+ELASTIX_LOGS = ('elastix.log', 'elastix_stdout.log')
+
+# eg. "Total time elapsed: 1h 2m 3.4s." or older versions "Total time elapsed: 12.3 s."
+_TOTAL_TIME_RE = re.compile(r'Total time elapsed:\s*(.+?)\.?\s*$', re.MULTILINE)
+_DHMS_RE = re.compile(r'([\d.]+)\s*([dhms])')
+_UNIT_SECONDS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+
+@dataclass
+class Plan:
+    processes: int  # Number of jobs to run at once
+    threads: int  # Threads per job
+    order: List[int]  # Indices of the jobs, longest first
+    makespan: float  # Estimated total run time, in the units of the durations
+
+
+def parse_elastix_time(log: Union[str, Path]) -> Union[float, None]:
+    """
+    Get the total run time in seconds from an elastix log, or None if it can't be found
+    """
+    try:
+        text = Path(log).read_text(errors='replace')
+    except OSError:
+        return None
+
+    matches = _TOTAL_TIME_RE.findall(text)
+    if not matches:
+        return None
+
+    parts = _DHMS_RE.findall(matches[-1])
+    if not parts:
+        return None
+    return sum(float(value) * _UNIT_SECONDS[unit] for value, unit in parts)
+
+
+def estimate_duration(reg_dir: Path, threads: int = None, parallel_fraction: float = DEFAULT_PARALLEL_FRACTION
+                      ) -> float:
+    """
+    Estimate the single-thread run time of an elastix job from a registration output directory
+
+    Parameters
+    ----------
+    reg_dir
+        A specimen's registration directory for one stage. Contains the elastix log and TransformParameters file
+    threads
+        The number of threads the registration was run with. Used to convert the measured time to single-thread time
+    parallel_fraction
+        See module docstring
+
+    Returns
+    -------
+    Seconds if measured from a log, otherwise the weight of the transform type
+    """
+    reg_dir = Path(reg_dir)
+    seconds = _logged_duration(reg_dir, threads, parallel_fraction)
+    return seconds if seconds is not None else _transform_weight(reg_dir)
+
+
+def _logged_duration(reg_dir: Path, threads, parallel_fraction) -> Union[float, None]:
+    for name in ELASTIX_LOGS:
+        seconds = parse_elastix_time(reg_dir / name)
+        if seconds:
+            if threads:
+                seconds /= (1 - parallel_fraction) + parallel_fraction / int(threads)
+            return seconds
+    return None
+
+
+def _transform_weight(reg_dir: Path) -> float:
+    try:
+        transform = TransformParameterFile.read(reg_dir / 'TransformParameters.0.txt').transform
+    except (OSError, KeyError):
+        return DEFAULT_TRANSFORM_WEIGHT
+    return TRANSFORM_WEIGHTS.get(transform, DEFAULT_TRANSFORM_WEIGHT)
+
+
+def estimate_durations(reg_dirs: Sequence[Path], threads: int = None,
+                       parallel_fraction: float = DEFAULT_PARALLEL_FRACTION) -> List[float]:
+    """
+    Estimate the single-thread run times of a batch of jobs. Where only some of the jobs have elastix logs, the
+    transform type weights of the others are converted to seconds using the measured jobs, so all the estimates are
+    on the same scale
+    """
+    measured = []
+    weights = []
+    for reg_dir in reg_dirs:
+        seconds = _logged_duration(Path(reg_dir), threads, parallel_fraction)
+        measured.append(seconds)
+        weights.append(_transform_weight(Path(reg_dir)))
+
+    pairs = [(m, w) for m, w in zip(measured, weights) if m is not None]
+    seconds_per_weight = sum(m for m, _ in pairs) / sum(w for _, w in pairs) if pairs else 1.0
+
+    return [m if m is not None else w * seconds_per_weight for m, w in zip(measured, weights)]
+
+
+def lpt_makespan(durations: Sequence[float], workers: int) -> float:
+    """
+    The makespan of running the jobs longest first, each on the next free worker
+    """
+    loads = [0.0] * max(1, workers)
+    for d in sorted(durations, reverse=True):
+        heapq.heapreplace(loads, loads[0] + d)
+    return max(loads)
+
+
+def plan_jobs(durations: Sequence[float], cores: int, max_processes: int = None,
+              parallel_fraction: float = DEFAULT_PARALLEL_FRACTION) -> Plan:
+    """
+    Choose the number of concurrent processes and threads per process that minimises the estimated makespan
+
+    Parameters
+    ----------
+    durations
+        The single-thread duration (or relative weight) of each job
+    cores
+        The thread budget to share between concurrent jobs
+    max_processes
+        Optional upper limit on concurrent jobs, eg. for memory
+    parallel_fraction
+        See module docstring
+    """
+    cores = max(1, int(cores))
+    n = len(durations)
+    order = sorted(range(n), key=lambda i: durations[i], reverse=True)
+
+    if n == 0:
+        return Plan(1, cores, [], 0.0)
+
+    limit = min(n, cores, max_processes or n)
+
+    best = None
+    for processes in range(1, limit + 1):
+        threads = cores // processes
+        time_scale = (1 - parallel_fraction) + parallel_fraction / threads
+        makespan = lpt_makespan([d * time_scale for d in durations], processes)
+
+        # Only use more processes if it is a real improvement
+        if best is None or makespan < best.makespan * (1 - 1e-6):
+            best = Plan(processes, threads, order, makespan)
+
+    return best
@@ -0,0 +1,550 @@
+"""
+Evaluate elastix transforms in-process.
+
+Computes the displacement field and the spatial jacobian determinant of an elastix TransformParameters file (and its
+chain of InitialTransformParameterFileName files) with numpy, as transformix -def all -jac all would, but without
+launching transformix or writing and re-reading the volumes.
+
+Supported transforms are EulerTransform, SimilarityTransform, AffineTransform, BSplineTransform and
+DeformationFieldTransform (3D). Anything else raises NotImplementedError so the caller can fall back to transformix.
+
+Chains can also be converted to a SimpleITK composite transform (TransformChain.to_sitk) and images resampled with it
+in-process (resample), which is used to propagate label maps and heatmaps without transformix.
+
+Conventions (as elastix/ITK)
+----------------------------
+* Transforms map points in the fixed image space to the moving image space
+* A file with an initial transform and HowToCombineTransforms "Compose" is T(x) = T_current(T_initial(x)).
+  With "Add" it is T(x) = T_initial(x) + T_current(x) - x
+* The output grid (Size, Spacing, Origin, Direction) is taken from the outermost transform file
+* Direction is stored row-major, as it is in the parameter files
+* Displacement is T(x) - x in physical units. The jacobian determinant is det(dT/dx)
+
+The volume is processed in z-slabs so memory is bounded by the slab size, and results are float32.
+
+Examples
+--------
+    disp, jac = deformation_and_jacobian(Path('TransformParameters.0.txt'))
+    sitk.WriteImage(jac, 'spatialJacobian.nrrd')
+"""
+
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+import SimpleITK as sitk
+
+from lama.elastix.transform_parameters import TransformParameterFile
+
+# Roughly how many points to evaluate at once. Memory is ~ 200 bytes per point
+DEFAULT_BLOCK_POINTS = 2 ** 20
+
+LINEAR_TRANSFORMS = ('EulerTransform', 'SimilarityTransform', 'AffineTransform')
+
+
+class Transform:
+    """
+    A single elastix transform. Subclasses implement transform(), which maps (n, 3) physical points and returns the
+    mapped points and the (n, 3, 3) spatial jacobian at each point
+    """
+    def transform(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+    def to_sitk(self) -> sitk.Transform:
+        raise NotImplementedError
+
+
+class MatrixTransform(Transform):
+    """
+    T(x) = A(x - c) + c + t. Euler, Similarity and Affine transforms are all of this form
+    """
+    def __init__(self, matrix: np.ndarray, center: np.ndarray, translation: np.ndarray):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+        self.translation = np.asarray(translation, dtype=np.float64)
+
+    def transform(self, points):
+        mapped = (points - self.center) @ self.matrix.T + self.center + self.translation
+        jac = np.broadcast_to(self.matrix, (len(points), 3, 3))
+        return mapped, jac
+
+    def to_sitk(self) -> sitk.Transform:
+        return sitk.AffineTransform(self.matrix.ravel().tolist(), self.translation.tolist(), self.center.tolist())
+
+    @classmethod
+    def from_params(cls, params: TransformParameterFile) -> 'MatrixTransform':
+        name = params['Transform'][0]
+        p = params.parameters
+        center = np.array(params.get('CenterOfRotationPoint', [0, 0, 0]), dtype=np.float64)
+
+        if name == 'EulerTransform':
+            compute_zyx = str(params.get('ComputeZYX', ['false'])[0]).lower() == 'true'
+            matrix = euler_matrix(p[:3], compute_zyx)
+            translation = p[3:6]
+        elif name == 'SimilarityTransform':
+            matrix = versor_matrix(p[:3]) * p[6]
+            translation = p[3:6]
+        elif name == 'AffineTransform':
+            matrix = p[:9].reshape(3, 3)
+            translation = p[9:12]
+        else:
+            raise NotImplementedError(f'{name} is not a matrix transform')
+
+        return cls(matrix, center, translation)
+
+
+def euler_matrix(angles, compute_zyx: bool = False) -> np.ndarray:
+    """
+    Rotation matrix for ITK's Euler3DTransform. Angles are about x, y and z in radians
+    """
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+
+    if compute_zyx:
+        return rz @ ry @ rx
+    return rz @ rx @ ry
+
+
+def versor_matrix(v) -> np.ndarray:
+    """
+    Rotation matrix of a versor (the vector part of a unit quaternion) as used by ITK's Similarity3DTransform
+    """
+    x, y, z = v
+    w = np.sqrt(max(0.0, 1.0 - (x * x + y * y + z * z)))
+
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]
+    ])
+
+
+def bspline3(u: np.ndarray) -> np.ndarray:
+    """
+    Cubic B-spline kernel
+    """
+    a = np.abs(u)
+    return np.where(a < 1, (4 - 6 * a ** 2 + 3 * a ** 3) / 6,
+                    np.where(a < 2, (2 - a) ** 3 / 6, 0.0))
+
+
+def bspline3_derivative(u: np.ndarray) -> np.ndarray:
+    a = np.abs(u)
+    s = np.sign(u)
+    return np.where(a < 1, s * (-12 * a + 9 * a ** 2) / 6,
+                    np.where(a < 2, -s * (2 - a) ** 2 / 2, 0.0))
+
+
+class BSplineTransform(Transform):
+    """
+    Cubic B-spline transform. T(x) = x + sum_k c_k B(g(x) - k), where g(x) is the continuous index of x in the
+    control point grid. Points outside the valid region of the grid are not moved
+    """
+    def __init__(self, coefficients: np.ndarray, grid_size, grid_origin, grid_spacing, grid_direction, grid_index=None):
+        """
+        Parameters
+        ----------
+        coefficients
+            (3, nz, ny, nx) displacement coefficients for x, y and z
+        grid_size, grid_origin, grid_spacing
+            x, y, z order
+        grid_direction
+            3x3 direction matrix
+        """
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.grid_size = np.asarray(grid_size, dtype=np.int64)
+        self.grid_origin = np.asarray(grid_origin, dtype=np.float64)
+        self.grid_spacing = np.asarray(grid_spacing, dtype=np.float64)
+        self.grid_direction = np.asarray(grid_direction, dtype=np.float64)
+        self.grid_index = np.zeros(3, np.int64) if grid_index is None else np.asarray(grid_index, dtype=np.int64)
+
+        # Maps physical offsets from the origin to continuous grid indices
+        self.physical_to_index = np.linalg.inv(self.grid_direction @ np.diag(self.grid_spacing))
+
+        # As ITK's BSplineBaseTransform::InsideValidRegion for spline order 3
+        self.valid_begin = self.grid_index + 1
+        self.valid_end = self.grid_index + self.grid_size - 2
+
+    def to_sitk(self) -> sitk.Transform:
+        # ITK's coefficient grid has no start index, so move the origin to the first control point instead
+        origin = self.grid_origin + self.grid_direction @ (self.grid_spacing * self.grid_index)
+        tform = sitk.BSplineTransform(3, 3)
+        tform.SetFixedParameters(self.grid_size.tolist() + origin.tolist() + self.grid_spacing.tolist() +
+                                 self.grid_direction.ravel().tolist())
+        tform.SetParameters(self.coefficients.ravel().tolist())
+        return tform
+
+    @classmethod
+    def from_params(cls, params: TransformParameterFile) -> 'BSplineTransform':
+        order = int(params.get('BSplineTransformSplineOrder', [3])[0])
+        if order != 3:
+            raise NotImplementedError(f'Only cubic B-splines are supported, not order {order}')
+
+        grid_size = [int(x) for x in params['GridSize']]
+        n = int(np.prod(grid_size))
+        p = params.parameters
+
+        if p.size != 3 * n:
+            raise ValueError(f'Expected {3 * n} B-spline parameters for grid size {grid_size}, got {p.size}')
+
+        # Parameters are all the x coefficients, then y, then z, each with x varying fastest
+        coefficients = p.reshape(3, grid_size[2], grid_size[1], grid_size[0])
+        direction = np.array(params.get('GridDirection', [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=np.float64).reshape(3, 3)
+
+        return cls(coefficients, grid_size, params['GridOrigin'], params['GridSpacing'], direction,
+                   params.get('GridIndex'))
+
+    def transform(self, points):
+        n = len(points)
+        cindex = (points - self.grid_origin) @ self.physical_to_index.T
+
+        inside = np.all((cindex >= self.valid_begin) & (cindex < self.valid_end), axis=1)
+
+        # Support of the cubic kernel is 4 control points per axis starting at floor(c) - 1
+        start = np.floor(cindex).astype(np.int64) - 1
+        local = start - self.grid_index
+
+        # Weights and their derivatives for the 4 control points on each axis: (n, 3, 4)
+        offsets = cindex[:, :, None] - (start[:, :, None] + np.arange(4))
+        w = bspline3(offsets)
+        dw = bspline3_derivative(offsets)
+
+        disp = np.zeros((n, 3))
+        dcoef = np.zeros((n, 3, 3))  # d displacement_i / d cindex_j
+
+        sz, sy, sx = self.coefficients.shape[1:]
+        ix_all = np.clip(local[:, 0, None] + np.arange(4), 0, sx - 1)
+        iy_all = np.clip(local[:, 1, None] + np.arange(4), 0, sy - 1)
+        iz_all = np.clip(local[:, 2, None] + np.arange(4), 0, sz - 1)
+
+        for c in range(4):
+            for b in range(4):
+                wyz = w[:, 1, b] * w[:, 2, c]
+                for a in range(4):
+                    coef = self.coefficients[:, iz_all[:, c], iy_all[:, b], ix_all[:, a]].T  # (n, 3)
+
+                    weight = w[:, 0, a] * wyz
+                    disp += coef * weight[:, None]
+
+                    dweights = np.stack([dw[:, 0, a] * w[:, 1, b] * w[:, 2, c],
+                                         w[:, 0, a] * dw[:, 1, b] * w[:, 2, c],
+                                         w[:, 0, a] * w[:, 1, b] * dw[:, 2, c]], axis=1)
+                    dcoef += coef[:, :, None] * dweights[:, None, :]
+
+        disp[~inside] = 0
+        dcoef[~inside] = 0
+
+        jac = np.eye(3) + dcoef @ self.physical_to_index
+        return points + disp, jac
+
+
+class DisplacementFieldTransform(Transform):
+    """
+    T(x) = x + u(x), with u linearly interpolated from a displacement field image. As ITK, points more than half a
+    voxel outside the field are not moved
+    """
+    def __init__(self, field: sitk.Image):
+        self.image = field
+        self.field = sitk.GetArrayFromImage(field)  # (nz, ny, nx, 3)
+        self.origin = np.array(field.GetOrigin())
+        direction = np.array(field.GetDirection()).reshape(3, 3)
+        self.physical_to_index = np.linalg.inv(direction @ np.diag(field.GetSpacing()))
+
+    def transform(self, points):
+        cindex = (points - self.origin) @ self.physical_to_index.T
+        disp, dfield = interpolate_field(self.field, cindex, derivative=True)
+        jac = np.eye(3) + dfield @ self.physical_to_index
+        return points + disp, jac
+
+    def to_sitk(self) -> sitk.Transform:
+        # The SimpleITK transform takes ownership of the image it is given, so give it a copy
+        tform = sitk.DisplacementFieldTransform(sitk.Cast(self.image, sitk.sitkVectorFloat64))
+        tform.SetInterpolator(sitk.sitkLinear)
+        return tform
+
+    @classmethod
+    def from_params(cls, params: TransformParameterFile) -> 'DisplacementFieldTransform':
+        order = int(params.get('DeformationFieldInterpolationOrder', [0])[0])
+        if order != 1:
+            raise NotImplementedError(f'Only linear interpolation of deformation fields is supported, not order {order}')
+
+        field_path = Path(params['DeformationFieldFileName'][0])
+        if not field_path.is_absolute() and not field_path.is_file() and params.path:
+            field_path = params.path.parent / field_path
+
+        return cls(sitk.ReadImage(str(field_path)))
+
+
+def interpolate_field(field: np.ndarray, cindex: np.ndarray, derivative: bool = False
+                      ) -> Tuple[np.ndarray, Union[np.ndarray, None]]:
+    """
+    Linearly interpolate a (nz, ny, nx, c) array at (n, 3) continuous x, y, z indices, as ITK's displacement field
+    transform does: indices within half a voxel of the array are clamped to its edge and beyond that the value is zero
+
+    Returns
+    -------
+    The (n, c) values and, if derivative, their (n, c, 3) derivatives with respect to the index
+    """
+    n = len(cindex)
+    shape = np.array(field.shape[2::-1])  # nx, ny, nz
+    inside = np.all((cindex >= -0.5) & (cindex < shape - 0.5), axis=1)
+
+    clamped = np.clip(cindex, 0, shape - 1)
+    i0 = np.minimum(np.floor(clamped).astype(np.int64), np.maximum(shape - 2, 0))
+    i1 = np.minimum(i0 + 1, shape - 1)
+    frac = clamped - i0
+
+    # Index of each corner into the flattened array is the lower corner plus an offset on each axis
+    strides = np.array([1, shape[0], shape[0] * shape[1]])
+    base = i0 @ strides
+    step = (i1 - i0) * strides
+    flat = field.reshape(-1, field.shape[-1])
+
+    # Weights of the lower and upper neighbours on each axis, and their derivatives
+    w = [(1 - frac[:, axis], frac[:, axis]) for axis in range(3)]
+    dw = (-1.0, 1.0)
+
+    values = np.zeros((n, field.shape[-1]))
+    dvalues = np.zeros((n, field.shape[-1], 3)) if derivative else None
+
+    for c in range(2):
+        for b in range(2):
+            wyz = w[1][b] * w[2][c]
+            offset = base + b * step[:, 1] + c * step[:, 2]
+            for a in range(2):
+                v = np.take(flat, offset + a * step[:, 0], axis=0)
+                values += v * (w[0][a] * wyz)[:, None]
+
+                if derivative:
+                    dvalues[:, :, 0] += v * (dw[a] * wyz)[:, None]
+                    dvalues[:, :, 1] += v * (w[0][a] * dw[b] * w[2][c])[:, None]
+                    dvalues[:, :, 2] += v * (w[0][a] * w[1][b] * dw[c])[:, None]
+
+    values[~inside] = 0
+    if derivative:
+        dvalues[~inside] = 0
+        # Clamped indices don't move the value
+        dvalues *= (clamped == cindex)[:, None, :]
+
+    return values, dvalues
+
+
+class TransformChain:
+    """
+    A transform parameter file and its initial transforms
+    """
+    def __init__(self, transform: Transform, initial: 'TransformChain' = None, combine: str = 'Compose'):
+        if combine not in ('Compose', 'Add'):
+            raise NotImplementedError(f'HowToCombineTransforms {combine} is not supported')
+        self.transform = transform
+        self.initial = initial
+        self.combine = combine
+
+    def transform_points(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self.initial is None:
+            return self.transform.transform(points)
+
+        init_points, init_jac = self.initial.transform_points(points)
+
+        if self.combine == 'Compose':
+            mapped, jac = self.transform.transform(init_points)
+            return mapped, jac @ init_jac
+
+        # Add
+        mapped, jac = self.transform.transform(points)
+        return init_points + mapped - points, init_jac + jac - np.eye(3)
+
+
+    def to_sitk(self) -> sitk.CompositeTransform:
+        """
+        The equivalent SimpleITK transform. Only chains combined with "Compose" can be converted
+        """
+        composite = sitk.CompositeTransform(3)
+        chain = self
+        while chain:
+            if chain.initial and chain.combine != 'Compose':
+                raise NotImplementedError(f'HowToCombineTransforms {chain.combine} cannot be converted to SimpleITK')
+            # A composite transform applies the last added transform first, so add from the outermost inwards
+            composite.AddTransform(chain.transform.to_sitk())
+            chain = chain.initial
+        return composite
+
+
+def load_transform(params: TransformParameterFile) -> Transform:
+    name = params['Transform'][0]
+    if name in LINEAR_TRANSFORMS:
+        return MatrixTransform.from_params(params)
+    if name == 'BSplineTransform':
+        return BSplineTransform.from_params(params)
+    if name == 'DeformationFieldTransform':
+        return DisplacementFieldTransform.from_params(params)
+    raise NotImplementedError(f'{name} is not supported by the transform engine')
+
+
+def load_transform_chain(tp_path: Path) -> TransformChain:
+    """
+    Load a transform parameter file and follow its InitialTransformParameterFileName entries
+    """
+    tp_path = Path(tp_path)
+    params = TransformParameterFile.read(tp_path)
+
+    if int(params.get('FixedImageDimension', [3])[0]) != 3:
+        raise NotImplementedError('Only 3D transforms are supported')
+
+    initial = None
+    if params.initial_transform:
+        initial = load_transform_chain(params.initial_transform)
+
+    combine = params.get('HowToCombineTransforms', ['Compose'])[0]
+
+    return TransformChain(load_transform(params), initial, combine)
+
+
+def output_grid(tp_path: Path) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the size, spacing, origin and direction (3x3) of the grid transformix would resample onto
+    """
+    params = TransformParameterFile.read(tp_path)
+    size = np.array(params['Size'], dtype=np.int64)
+    spacing = np.array(params['Spacing'], dtype=np.float64)
+    origin = np.array(params['Origin'], dtype=np.float64)
+    direction = np.array(params.get('Direction', [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=np.float64).reshape(3, 3)
+    return size, spacing, origin, direction
+
+
+def grid_points(size, spacing, origin, direction, z0: int, z1: int) -> np.ndarray:
+    """
+    Physical positions of the voxels in slices z0 to z1 of a grid, as an (n, 3) array with x varying fastest
+    """
+    nx, ny = size[:2]
+    iz, iy, ix = np.mgrid[z0:z1, 0:ny, 0:nx]
+    idx = np.stack([ix, iy, iz], axis=-1).reshape(-1, 3)
+    return idx @ (direction @ np.diag(spacing)).T + origin
+
+
+def jacobian_determinant(jac: np.ndarray) -> np.ndarray:
+    """
+    Determinants of a (n, 3, 3) stack of matrices
+    """
+    return (jac[:, 0, 0] * (jac[:, 1, 1] * jac[:, 2, 2] - jac[:, 1, 2] * jac[:, 2, 1]) -
+            jac[:, 0, 1] * (jac[:, 1, 0] * jac[:, 2, 2] - jac[:, 1, 2] * jac[:, 2, 0]) +
+            jac[:, 0, 2] * (jac[:, 1, 0] * jac[:, 2, 1] - jac[:, 1, 1] * jac[:, 2, 0]))
+
+
+def deformation_and_jacobian(tp_path: Path, displacement: bool = True, jacobian: bool = True,
+                             block_points: int = DEFAULT_BLOCK_POINTS) -> Tuple[Union[sitk.Image, None],
+                                                                                Union[sitk.Image, None]]:
+    """
+    Compute the displacement field and jacobian determinant of a transform parameter file over its output grid
+
+    Parameters
+    ----------
+    tp_path
+        The outermost transform parameter file of the chain
+    displacement, jacobian
+        Which outputs to make
+    block_points
+        Approximate number of points to evaluate at once. Whole z-slices are always used
+
+    Returns
+    -------
+    The float32 displacement (vector) image and jacobian determinant image. None for any not requested
+    """
+    chain = load_transform_chain(tp_path)
+    size, spacing, origin, direction = output_grid(tp_path)
+    nx, ny, nz = size
+
+    disp_arr = np.zeros((nz, ny, nx, 3), dtype=np.float32) if displacement else None
+    jac_arr = np.zeros((nz, ny, nx), dtype=np.float32) if jacobian else None
+
+    slab = max(1, int(block_points // (nx * ny)))
+
+    for z0 in range(0, nz, slab):
+        z1 = min(z0 + slab, nz)
+
+        points = grid_points(size, spacing, origin, direction, z0, z1)
+
+        mapped, jac = chain.transform_points(points)
+
+        if displacement:
+            disp_arr[z0:z1] = (mapped - points).reshape(z1 - z0, ny, nx, 3)
+        if jacobian:
+            jac_arr[z0:z1] = jacobian_determinant(jac).reshape(z1 - z0, ny, nx)
+
+    def to_image(arr, is_vector):
+        img = sitk.GetImageFromArray(arr, isVector=is_vector)
+        img.SetSpacing(spacing.tolist())
+        img.SetOrigin(origin.tolist())
+        img.SetDirection(direction.ravel().tolist())
+        return img
+
+    disp_img = to_image(disp_arr, True) if displacement else None
+    jac_img = to_image(jac_arr, False) if jacobian else None
+
+    return disp_img, jac_img
+
+
+# elastix ResultImagePixelType names
+SITK_PIXEL_TYPES = {
+    'char': sitk.sitkInt8,
+    'unsigned char': sitk.sitkUInt8,
+    'short': sitk.sitkInt16,
+    'unsigned short': sitk.sitkUInt16,
+    'int': sitk.sitkInt32,
+    'unsigned int': sitk.sitkUInt32,
+    'long': sitk.sitkInt64,
+    'unsigned long': sitk.sitkUInt64,
+    'float': sitk.sitkFloat32,
+    'double': sitk.sitkFloat64
+}
+
+
+def resample(image: Union[sitk.Image, Path, str], tp_path: Path, interpolator=sitk.sitkNearestNeighbor,
+             threads: int = None) -> sitk.Image:
+    """
+    Transform an image as transformix would, using SimpleITK. The output grid, default pixel value and output pixel
+    type are taken from the transform parameter file
+
+    Parameters
+    ----------
+    image
+        The image (or path to it) to transform
+    tp_path
+        The outermost transform parameter file of the chain
+    interpolator
+        SimpleITK interpolator. Nearest neighbour for label maps and masks
+    threads
+        Number of threads for the resampling. None for the SimpleITK default
+
+    Raises
+    ------
+    NotImplementedError if the transforms cannot be converted to SimpleITK
+    """
+    if not isinstance(image, sitk.Image):
+        image = sitk.ReadImage(str(image))
+
+    params = TransformParameterFile.read(tp_path)
+    size, spacing, origin, direction = output_grid(tp_path)
+
+    pixel_type = params.get('ResultImagePixelType', [None])[0]
+    if pixel_type is not None and pixel_type not in SITK_PIXEL_TYPES:
+        raise NotImplementedError(f'ResultImagePixelType {pixel_type} is not supported')
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetTransform(load_transform_chain(tp_path).to_sitk())
+    resampler.SetInterpolator(interpolator)
+    resampler.SetSize(size.tolist())
+    resampler.SetOutputSpacing(spacing.tolist())
+    resampler.SetOutputOrigin(origin.tolist())
+    resampler.SetOutputDirection(direction.ravel().tolist())
+    resampler.SetDefaultPixelValue(float(params.get('DefaultPixelValue', [0])[0]))
+    if pixel_type:
+        resampler.SetOutputPixelType(SITK_PIXEL_TYPES[pixel_type])
+    if threads:
+        resampler.SetNumberOfThreads(int(threads))
+
+    return resampler.Execute(image)
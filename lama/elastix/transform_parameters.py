@@ -0,0 +1,286 @@
+"""
+Read, modify and write elastix TransformParameters files.
+
+The (TransformParameters ...) line of a BSpline transform can hold millions of values. It is parsed with numpy in
+one go and the parsed parameters (and their text) are cached by path and modification time, so reading the same file from several
+places (unfolding, deformations, propagation) only parses it once. Lines that are not changed are written back
+exactly as they were read.
+
+Examples
+--------
+    tp = TransformParameterFile.read('TransformParameters.0.txt')
+    tp['Transform']  # ['BSplineTransform']
+    tp['GridSpacing']  # [8.0, 8.0, 8.0]
+    tp.coefficients  # (n control points, 3) array for a BSpline transform
+    tp.initial_transform = 'affine/TransformParameters.0.txt'
+    tp['ResultImagePixelType'] = 'unsigned char'
+    tp.write('new_tp.txt')
+"""
+
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+import numpy as np
+
+PARAMETERS_KEY = 'TransformParameters'
+INITIAL_TRANSFORM_KEY = 'InitialTransformParameterFileName'
+NO_INITIAL_TRANSFORM = 'NoInitialTransform'
+
+# Decimal places used when writing modified transform parameters
+PARAMETER_PRECISION = 6
+
+# Number of parsed files to keep
+CACHE_SIZE = 32
+
+_ENTRY_RE = re.compile(r'^\((\w+)\s*(.*?)\)\s*$')
+_TOKEN_RE = re.compile(r'"[^"]*"|\S+')
+
+_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class TransformParameterFile:
+    """
+    An elastix transform parameter file.
+
+    Values are accessed by parameter name and are always lists. Quoted values are strings, others are ints or floats.
+    The transform parameters themselves are a float64 numpy array in `parameters`, which can be modified in place.
+    Unmodified parameters are written back exactly as they were read
+    """
+
+    def __init__(self, lines: List[str], parameters_text: str = None, parameters: np.ndarray = None,
+                 path: Path = None):
+        """
+        Use TransformParameterFile.read() rather than making these directly
+
+        Parameters
+        ----------
+        lines
+            The lines of the file, without the TransformParameters line
+        parameters_text
+            The unparsed transform parameters
+        parameters
+            The parsed transform parameters
+        path
+            The file the parameters were read from
+        """
+        self.path = path
+        self._lines = []  # Either a parameter name or a line that is not a parameter (comments etc.)
+        self._values: Dict[str, str] = {}  # Parameter name: unparsed value text
+
+        for line in lines:
+            match = _ENTRY_RE.match(line.strip())
+            if match:
+                name, text = match.groups()
+                if name not in self._values:
+                    self._lines.append(name)
+                self._values[name] = text
+            else:
+                self._lines.append(line.rstrip('\n'))
+
+        if parameters is not None or parameters_text is not None:
+            if PARAMETERS_KEY not in self._values:
+                self._lines.append(PARAMETERS_KEY)
+            self._values[PARAMETERS_KEY] = None
+
+        self._parameters_text = parameters_text
+        self._parameters = parameters
+        self._text_parameters = None  # The values of _parameters_text, to check for in-place modification
+
+    @classmethod
+    def read(cls, path: Union[str, Path]) -> 'TransformParameterFile':
+        """
+        Read a transform parameter file, or get it from the cache if the file has not changed since it was last read.
+        The returned object can be modified without affecting the cache
+        """
+        path = Path(path)
+        stat = os.stat(path)
+        key = str(path.resolve())
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with _cache_lock:
+            cached = _cache.get(key)
+            if cached and cached[0] == stamp:
+                _cache.move_to_end(key)
+                _, lines, parameters_text, parameters = cached
+                tp = cls(lines, parameters_text=parameters_text, parameters=parameters.copy(), path=path)
+                # The cached parameters are never modified, so unmodified parameters are written back as their text
+                tp._text_parameters = parameters
+                return tp
+
+        lines = []
+        parameters_text = None
+        with open(path, 'r') as fh:
+            for line in fh:
+                if line.startswith(f'({PARAMETERS_KEY} '):
+                    parameters_text = line.strip()[len(PARAMETERS_KEY) + 2: -1]
+                    # Keep the position of the parameters line
+                    lines.append(f'({PARAMETERS_KEY})')
+                else:
+                    lines.append(line)
+
+        tp = cls(lines, parameters_text=parameters_text, path=path)
+
+        if parameters_text is not None:
+            parameters = tp.parameters
+            with _cache_lock:
+                _cache[key] = (stamp, lines, parameters_text, parameters.copy())
+                _cache.move_to_end(key)
+                while len(_cache) > CACHE_SIZE:
+                    _cache.popitem(last=False)
+
+        return tp
+
+    @property
+    def parameters(self) -> np.ndarray:
+        if self._parameters is None:
+            if self._parameters_text is None:
+                raise KeyError(PARAMETERS_KEY)
+            self._text_parameters = np.array(self._parameters_text.split(), dtype=np.float64)
+            self._parameters = self._text_parameters.copy()
+        return self._parameters
+
+    @parameters.setter
+    def parameters(self, values):
+        self._parameters = np.asarray(values, dtype=np.float64).ravel()
+        self._parameters_text = None
+        if PARAMETERS_KEY not in self._values:
+            self._lines.append(PARAMETERS_KEY)
+            self._values[PARAMETERS_KEY] = None
+
+    @property
+    def transform(self) -> str:
+        return self['Transform'][0]
+
+    @property
+    def coefficients(self) -> np.ndarray:
+        """
+        The parameters of a BSpline transform as an (n control points, 3) array. The file stores all the x
+        coefficients, then all the y, then all the z
+        """
+        return self.parameters.reshape(3, -1).T
+
+    @coefficients.setter
+    def coefficients(self, coefs: np.ndarray):
+        self.parameters = np.asarray(coefs).T.ravel()
+
+    @property
+    def initial_transform(self) -> Union[Path, None]:
+        """
+        The initial transform file or None. Relative paths are resolved against the directory of this file
+        """
+        name = self.get(INITIAL_TRANSFORM_KEY, [NO_INITIAL_TRANSFORM])[0]
+        if name == NO_INITIAL_TRANSFORM:
+            return None
+        init = Path(name)
+        if not init.is_absolute() and not init.is_file() and self.path:
+            init = self.path.parent / init
+        return init
+
+    @initial_transform.setter
+    def initial_transform(self, path: Union[str, Path, None]):
+        self[INITIAL_TRANSFORM_KEY] = str(path) if path else NO_INITIAL_TRANSFORM
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._values
+
+    def __getitem__(self, name: str) -> List:
+        if name == PARAMETERS_KEY:
+            return self.parameters.tolist()
+        return [_parse_token(t) for t in _TOKEN_RE.findall(self._values[name])]
+
+    def __setitem__(self, name: str, value: Any):
+        """
+        Set a parameter. Strings are quoted when written, numbers are not. Lists are written space-separated
+        """
+        if name == PARAMETERS_KEY:
+            self.parameters = value
+            return
+        if not isinstance(value, (list, tuple, np.ndarray)):
+            value = [value]
+        if name not in self._values:
+            self._lines.append(name)
+        self._values[name] = ' '.join(_format_value(v) for v in value)
+
+    def __delitem__(self, name: str):
+        del self._values[name]
+        self._lines.remove(name)
+        if name == PARAMETERS_KEY:
+            self._parameters = self._parameters_text = None
+
+    def get(self, name: str, default=None) -> List:
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        return [x for x in self._lines if x in self._values]
+
+    def to_dict(self) -> Dict[str, List]:
+        return {k: self[k] for k in self.keys()}
+
+    def write(self, path: Union[str, Path] = None, precision: int = PARAMETER_PRECISION):
+        """
+        Write the file atomically, so a crash or a concurrent reader never sees a partial file
+
+        Parameters
+        ----------
+        path
+            Where to write. Defaults to the file that was read
+        precision
+            Decimal places for the transform parameters, if they have been modified
+        """
+        path = Path(path or self.path)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                for line in self._lines:
+                    if line not in self._values:
+                        fh.write(line + '\n')
+                    elif line == PARAMETERS_KEY:
+                        fh.write(f'({PARAMETERS_KEY} ')
+                        if self._parameters_text is not None and (
+                                self._parameters is None or np.array_equal(self._parameters, self._text_parameters)):
+                            fh.write(self._parameters_text)
+                        else:
+                            self._parameters.tofile(fh, sep=' ', format=f'%.{precision}f')
+                        fh.write(')\n')
+                    else:
+                        fh.write(f'({line} {self._values[line]})\n')
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self.path = path
+
+
+def _parse_token(token: str):
+    if token.startswith('"'):
+        return token.strip('"')
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def _format_value(value) -> str:
+    if isinstance(value, (bool, np.bool_)):
+        return f'"{str(value).lower()}"'
+    if isinstance(value, (int, np.integer)):
+        return str(value)
+    if isinstance(value, (float, np.floating)):
+        return f'{value:.10g}'
+    return f'"{value}"'
@@ -0,0 +1,416 @@
+"""
+Make population averages from a set of volumes.
+
+The volumes are summed into a floating point accumulator, so large cohorts of uint8/uint16 images do not overflow, and
+the mean is rounded and cast back to the input dtype before writing.
+
+Volumes are read by a small thread pool that keeps a bounded number of reads ahead of the accumulation. SimpleITK
+releases the GIL while reading, so decompression of the next volumes overlaps with summing the current one.
+
+Each volume is read whole and once. SimpleITK cannot stream NRRD, so reading z-slabs with an extract region would
+decompress the whole volume for every slab. Peak memory is the accumulator plus the volumes being read ahead.
+
+Robust averages (median, trimmed mean and winsorised mean) are less affected by a few badly registered specimens
+dragging the next stage's target off. They need every specimen's value at each voxel, so they are always computed
+out-of-core over z-slabs, with the slab size chosen to fit a memory budget. Each volume is decoded once to a raw
+memory-mapped scratch file and the slabs are sliced from those, so the cost is one decode per volume plus disk I/O.
+
+Examples
+--------
+    avg = mean(paths)
+    avg = mean(paths, accumulator_dtype=np.float32)
+    avg = robust_average(paths, 'trimmed_mean', trim=0.1)
+    write_average(paths, 'average.nrrd', method='median')
+
+For distributed runs (parallel_average.py) each worker keeps a PartialSum of the specimens it has registered. The stage
+average is then a merge of these partial sums rather than a re-read of every specimen on a single node:
+
+    partial = PartialSum(stage_dir / PARTIAL_SUMS_DIR / 'worker1.npz')
+    partial.add(registered_img_path, spec_id)
+    ...
+    avg = mean_from_partial_sums(stage_dir / PARTIAL_SUMS_DIR, spec_paths)
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Union, Iterator, Callable, Iterable, Dict
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from logzero import logger as logging
+import numpy as np
+import SimpleITK as sitk
+import psutil
+
+DEFAULT_READ_AHEAD = 2
+ROBUST_METHODS = ('median', 'trimmed_mean', 'winsorised_mean')
+AVERAGE_METHODS = ('mean', ) + ROBUST_METHODS
+
+PARTIAL_SUMS_DIR = 'partial_sums'
+
+# Fraction of the available memory the robust average slab stack may use if max_memory is not given
+ROBUST_MEMORY_FRACTION = 0.25
+
+
+def average(img_paths: List[Union[str, Path]], method: str = 'mean', trim: float = 0.1, **kwargs) -> sitk.Image:
+    """
+    Make an average volume using one of AVERAGE_METHODS.
+    trim is only used by the trimmed and winsorised means. Other kwargs are passed to mean() or robust_average()
+    """
+    if method == 'mean':
+        return mean(img_paths, **kwargs)
+    elif method in ROBUST_METHODS:
+        return robust_average(img_paths, method, trim, **kwargs)
+    else:
+        raise ValueError(f'average method should be one of {AVERAGE_METHODS}, not {method}')
+
+
+def mean(img_paths: List[Union[str, Path]],
+         accumulator_dtype=np.float64,
+         read_ahead: int = DEFAULT_READ_AHEAD) -> sitk.Image:
+    """
+    Make a mean intensity volume from a list of volume paths
+
+    Parameters
+    ----------
+    img_paths
+        The volumes to average. They must all have the same size
+    accumulator_dtype
+        np.float64 or np.float32. float32 halves accumulator memory but loses precision for large cohorts
+    read_ahead
+        The maximum number of volumes to read ahead of the accumulation
+
+    Returns
+    -------
+    The mean volume with the dtype, spacing, origin and direction of the first input
+    """
+    img_paths = [str(x) for x in img_paths]
+
+    if not img_paths:
+        raise ValueError('Cannot make an average from an empty list of volumes')
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img_paths[0])
+    reader.ReadImageInformation()
+    size = reader.GetSize()  # x, y, z
+
+    out_dtype = _pixel_dtype(img_paths[0])
+    summed = np.zeros(size[::-1], dtype=accumulator_dtype)
+
+    for path, arr in zip(img_paths, read_ahead_map(_read_volume, img_paths, read_ahead)):
+        if arr.shape != summed.shape:
+            raise ValueError(f"Can't average {path}. It has a different size to {img_paths[0]}")
+        summed += arr
+
+    summed /= len(img_paths)
+
+    avg_img = sitk.GetImageFromArray(_to_dtype(summed, out_dtype))
+    avg_img.SetSpacing(reader.GetSpacing())
+    avg_img.SetOrigin(reader.GetOrigin())
+    avg_img.SetDirection(reader.GetDirection())
+
+    return avg_img
+
+
+def write_average(img_paths: List[Union[str, Path]], out_path: Union[str, Path], method: str = 'mean', **kwargs):
+    """
+    Make an average of img_paths and write it to out_path. kwargs are passed to average()
+    """
+    logging.info(f'Making {method} average from {len(img_paths)} volumes')
+    if method in ROBUST_METHODS:
+        # The scratch copies are as big as the uncompressed cohort, which may not fit in the system temporary directory
+        kwargs.setdefault('scratch_dir', Path(out_path).parent)
+    avg = average(img_paths, method, **kwargs)
+    sitk.WriteImage(avg, str(out_path), True)
+
+
+def robust_average(img_paths: List[Union[str, Path]],
+                   method: str = 'median',
+                   trim: float = 0.1,
+                   slab_size: int = None,
+                   max_memory: int = None,
+                   read_ahead: int = DEFAULT_READ_AHEAD,
+                   scratch_dir: Union[str, Path] = None) -> sitk.Image:
+    """
+    Make a median, trimmed mean or winsorised mean volume, working over z-slabs.
+
+    SimpleITK cannot stream NRRD, so each volume is decoded once into a raw memory-mapped copy in scratch_dir and the
+    slabs are sliced from those copies. This needs scratch space the size of the uncompressed cohort. Decoding holds up
+    to read_ahead full volumes in memory, in addition to the max_memory budget for the slab stack.
+
+    Parameters
+    ----------
+    img_paths
+        The volumes to average. They must all have the same size
+    method
+        'median', 'trimmed_mean' or 'winsorised_mean'
+    trim
+        The proportion of values to cut (trimmed_mean) or clamp (winsorised_mean) at each end of the distribution
+        at each voxel. int(trim * n) values are trimmed each side, as in scipy.stats.trim_mean and mstats.winsorize
+    slab_size
+        The number of z-slices in each slab. If None, the largest that fits in max_memory is used
+    max_memory
+        Memory budget in bytes used to choose the slab size. Defaults to a quarter of the available memory
+    read_ahead
+        The maximum number of volumes being decoded at once
+    scratch_dir
+        Where to put the raw copies of the volumes. Defaults to the system temporary directory
+
+    Returns
+    -------
+    The average volume with the dtype, spacing, origin and direction of the first input
+    """
+    if method not in ROBUST_METHODS:
+        raise ValueError(f'robust average method should be one of {ROBUST_METHODS}, not {method}')
+
+    if not 0 <= trim < 0.5:
+        raise ValueError(f'trim should be >= 0 and < 0.5, not {trim}')
+
+    img_paths = [str(x) for x in img_paths]
+    n = len(img_paths)
+
+    if n == 0:
+        raise ValueError('Cannot make an average from an empty list of volumes')
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img_paths[0])
+    reader.ReadImageInformation()
+    size = reader.GetSize()  # x, y, z
+    shape = size[::-1]
+
+    dtype = _pixel_dtype(img_paths[0])
+    out = np.zeros(shape, dtype=dtype)
+
+    if slab_size is None:
+        if max_memory is None:
+            max_memory = int(psutil.virtual_memory().available * ROBUST_MEMORY_FRACTION)
+        # The stack of slabs plus float64 temporaries for the result slab
+        bytes_per_slice = size[0] * size[1] * (n * dtype.itemsize + 16)
+        slab_size = int(min(size[2], max(1, max_memory // bytes_per_slice)))
+
+    logging.info(f'{method} average of {n} volumes using slabs of {slab_size} slices')
+
+    k = int(trim * n)  # Number of values to trim each side
+
+    with tempfile.TemporaryDirectory(prefix='lama_robust_average_', dir=scratch_dir) as tmp_dir:
+
+        def to_raw(i: int) -> Path:
+            arr = _read_volume(img_paths[i])
+
+            if arr.shape != shape:
+                raise ValueError(f"Can't average {img_paths[i]}. It has a different size to {img_paths[0]}")
+
+            raw_path = Path(tmp_dir) / f'{i}.raw'
+            raw = np.memmap(raw_path, dtype=dtype, mode='w+', shape=shape)
+            raw[:] = arr
+            raw.flush()
+            del raw
+            return raw_path
+
+        volumes = [np.memmap(raw_path, dtype=dtype, mode='r', shape=shape)
+                   for raw_path in read_ahead_map(to_raw, range(n), read_ahead)]
+
+        for z_start in range(0, size[2], slab_size):
+            z_end = min(z_start + slab_size, size[2])
+
+            stack = np.empty((n, z_end - z_start, size[1], size[0]), dtype=dtype)
+
+            for i, vol in enumerate(volumes):
+                stack[i] = vol[z_start: z_end]
+
+            if method == 'median':
+                result = np.median(stack, axis=0, overwrite_input=True)
+            else:
+                stack.sort(axis=0)
+                if method == 'trimmed_mean':
+                    result = stack[k: n - k].mean(axis=0, dtype=np.float64)
+                else:  # winsorised_mean
+                    if k:
+                        stack[:k] = stack[k]
+                        stack[n - k:] = stack[n - k - 1]
+                    result = stack.mean(axis=0, dtype=np.float64)
+
+            out[z_start: z_end] = _to_dtype(result, dtype)
+
+        del volumes  # Close the memory maps before the scratch files are removed
+
+    avg_img = sitk.GetImageFromArray(out)
+    avg_img.SetSpacing(reader.GetSpacing())
+    avg_img.SetOrigin(reader.GetOrigin())
+    avg_img.SetDirection(reader.GetDirection())
+
+    return avg_img
+
+
+class PartialSum:
+    """
+    A running sum of volumes and the ids of the specimens in it. See _sum_dtype for the type of the sum.
+    The sum is written compressed after every addition via a temporary file and rename, so a reader never sees a sum
+    and specimen list that disagree.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.sum = None
+        self.ids = []
+
+    def add(self, img_path: Union[str, Path], spec_id: str):
+        arr = sitk.GetArrayFromImage(sitk.ReadImage(str(img_path)))
+
+        if self.sum is None:
+            self.sum = arr.astype(_sum_dtype(arr.dtype))
+        else:
+            self.sum += arr
+        self.ids.append(spec_id)
+
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+
+        with open(tmp_path, 'wb') as fh:  # Pass a file handle or numpy adds its own extension
+            np.savez_compressed(fh, sum=self.sum, ids=np.array(self.ids))
+
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'PartialSum':
+        partial = cls(path)
+        with np.load(path) as data:
+            partial.sum = data['sum']
+            partial.ids = [str(x) for x in data['ids']]
+        return partial
+
+
+def mean_from_partial_sums(partials_dir: Path, spec_paths: Dict[str, Path]) -> sitk.Image:
+    """
+    Make a mean volume by merging the PartialSums in partials_dir.
+
+    Specimens that are not in any partial sum (for example a worker died between registering a specimen and saving
+    its sum) are read and added here.
+
+    Parameters
+    ----------
+    partials_dir
+        Directory of PartialSum .npz files
+    spec_paths
+        The volumes the average should be made from, keyed by specimen id
+
+    Returns
+    -------
+    The mean volume with the dtype, spacing, origin and direction of the first volume in spec_paths
+    """
+    reference = str(next(iter(spec_paths.values())))
+    dtype = _pixel_dtype(reference)
+
+    summed = None
+    done = set()
+
+    partial_files = sorted(Path(partials_dir).glob('*.npz')) if Path(partials_dir).is_dir() else []
+
+    for partial_file in partial_files:
+        partial = PartialSum.load(partial_file)
+
+        ids = set(partial.ids)
+        unknown = ids.difference(spec_paths)
+
+        if unknown:
+            raise ValueError(f'Partial sum {partial_file} contains specimens that are not in this stage: {unknown}')
+        if ids & done:
+            raise ValueError(f'Specimens {ids & done} have been summed more than once')
+        if partial.sum is None or not ids:
+            continue
+
+        summed = partial.sum if summed is None else summed + partial.sum
+        done.update(ids)
+
+    missing = [spec_paths[x] for x in spec_paths if x not in done]
+
+    if missing:
+        logging.info(f'{len(missing)} specimens not in the partial sums. Reading them')
+
+    for arr in read_ahead_map(lambda p: sitk.GetArrayFromImage(sitk.ReadImage(str(p))), missing):
+        summed = arr.astype(_sum_dtype(arr.dtype)) if summed is None else summed + arr
+
+    summed = summed / len(spec_paths)
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(reference)
+    reader.ReadImageInformation()
+
+    if summed.shape != tuple(reader.GetSize()[::-1]):
+        raise ValueError(f'The partial sums in {partials_dir} do not match the size of {reference}')
+
+    avg_img = sitk.GetImageFromArray(_to_dtype(summed, dtype))
+    avg_img.SetSpacing(reader.GetSpacing())
+    avg_img.SetOrigin(reader.GetOrigin())
+    avg_img.SetDirection(reader.GetDirection())
+
+    return avg_img
+
+
+def read_ahead_map(func: Callable, items: Iterable, read_ahead: int = DEFAULT_READ_AHEAD) -> Iterator:
+    """
+    Like map(func, items) but func is run in a thread pool with up to read_ahead calls in flight.
+    Results are yielded in order. read_ahead < 1 runs everything in the calling thread.
+    """
+    if read_ahead < 1:
+        yield from map(func, items)
+        return
+
+    items = iter(items)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=read_ahead) as pool:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= read_ahead:
+                break
+
+        while pending:
+            result = pending.popleft().result()
+            # Top up the queue before handing back the result so the next read starts while this one is used
+            for item in items:
+                pending.append(pool.submit(func, item))
+                break
+            yield result
+
+
+def _read_volume(path: str) -> np.ndarray:
+    return sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+
+def _sum_dtype(dtype: np.dtype) -> np.dtype:
+    """
+    The dtype to sum volumes of dtype in without overflow or rounding. uint32 holds the sum of over 65000 uint16
+    volumes and keeps a partial sum of uint8/uint16 volumes at 4 bytes a voxel rather than float64's 8
+    """
+    if np.issubdtype(dtype, np.unsignedinteger) and dtype.itemsize <= 2:
+        return np.dtype(np.uint32)
+    if np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+def _pixel_dtype(path: str) -> np.dtype:
+    """
+    Get the numpy dtype of an image without reading the pixel data
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    # A 1-voxel extract gives us the pixel type without depending on SimpleITK's pixel id to numpy mapping
+    reader.SetExtractIndex([0] * reader.GetDimension())
+    reader.SetExtractSize([1] * reader.GetDimension())
+    return sitk.GetArrayViewFromImage(reader.Execute()).dtype
+
+
+def _to_dtype(arr: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Round and clip a floating point mean so it can be stored in the input dtype
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        arr = np.clip(np.rint(arr), info.min, info.max)
+    return arr.astype(dtype)
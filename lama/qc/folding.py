@@ -5,22 +5,63 @@ from typing import Union
 from pathlib import Path
 
 
-def folding_report(jac_array, label_map: np.ndarray, label_info: Union[pd.DataFrame, str, Path] = None, outdir=None):
+def folding_report(neg_jac_summary: Union[pd.DataFrame, None],
+                   label_map: Union[np.ndarray, str, Path, None],
+                   label_info: Union[pd.DataFrame, str, Path] = None,
+                   outdir=None):
     """
-    Write out csv detailing the presence of folding per organ
+    Write out csv detailing the presence of folding per organ for each specimen that has negative jacobians
+
+    Parameters
+    ----------
+    neg_jac_summary
+        The summary from deformations.make_deformations_at_different_scales. Rows with negative jacobians have the
+        path to the negative jacobian image in 'neg_jac_path'
+    label_map
+        The atlas label map (array or path). If None, no report is made
+    label_info
+        The label names
+    outdir
+        Where to write the report. If None the report is returned
     """
-    if jac_array is None:
+    if neg_jac_summary is None or label_map is None:
         return
-    labels = np.unique(label_map)
 
-    if not isinstance(label_info, pd.DataFrame):
+    folded = neg_jac_summary[neg_jac_summary.num_neg_voxels > 0]
+    if len(folded) == 0:
+        return
+
+    if not isinstance(label_map, np.ndarray):
+        label_map = common.LoadImage(label_map).array
+
+    if label_info is not None and not isinstance(label_info, pd.DataFrame):
         label_info = pd.read_csv(label_info, index_col=0)
 
+    labels = np.unique(label_map)
+    labels = labels[labels != 0]
+
+    dfs = []
+    for _, row in folded.iterrows():
+        jac_array = common.LoadImage(row.neg_jac_path).array
+        df = _label_folding(jac_array, label_map, labels)
+        df.insert(0, 'specimen_id', row.specimen_id)
+        df.insert(0, 'deformation_id', row.deformation_id)
+        dfs.append(df)
+
+    df = pd.concat(dfs)
+
+    if label_info is not None:
+        df = df.merge(label_info[['label_name']], left_index=True, right_index=True)
+
+    if outdir:
+        df.to_csv(Path(outdir) / common.FOLDING_FILE_NAME)
+    else:
+        return df
+
+
+def _label_folding(jac_array: np.ndarray, label_map: np.ndarray, labels: np.ndarray) -> pd.DataFrame:
     result = []
     for label in labels:
-        # print(label)
-        if label == 0:
-            continue
         jac_label = jac_array[label_map == label]
         label_size = jac_label.size
         num_neg_vox = jac_label[jac_label < 0].size
@@ -30,11 +71,4 @@ def folding_report(jac_array, label_map: np.ndarray, label_info: Union[pd.DataFr
     df = pd.DataFrame.from_records(result)
     df.columns = ['label', 'label_size', 'num_neg_voxels', 'summed_folding']
     df.set_index('label', drop=True, inplace=True)
-
-    if label_info is not None:
-        df = df.merge(label_info[['label_name']], left_index=True, right_index=True)
-
-    if outdir:
-        df.to_csv(outdir / common.FOLDING_FILE_NAME)
-    else:
-        return df
\ No newline at end of file
+    return df
@@ -3,12 +3,12 @@
 
 A go at making populaiton average construction parallelizable across the grid.
 
-Take a root directory with inputs. Poll this directory to get a list of specimens.
-Look in the output directory and see what folders are avaialbe to see if there are remaiing specimens to process for a
-stage.
+Take a root directory with inputs. Each specimen in each stage is a task in a SQLite work queue (lama.work_queue) in
+the output directory, which any number of instances of this script on a shared filesystem claim work from.
 
-If one job runner finds a stage complete, but there's not completion file, create an exlusive file and then go about
-starting the next stage and.
+When a stage's tasks are all done, one job runner claims the stage's average task and makes the average, which is
+the target for the next stage. If a node dies its leases expire and its specimens (or the average) are picked up by
+another job runner.
 
 
 example
@@ -18,40 +18,50 @@ parallel_average.py lama_config.toml
 """
 
 from pathlib import Path
+from typing import Callable
+import os
+import shutil
 from os.path import join
-import time
 from lama.registration_pipeline.validate_config import LamaConfig
 from lama.registration_pipeline.run_lama import generate_elx_parameters, ELX_PARAM_PREFIX
 from lama import common
+from lama.img_processing import averaging
+from lama.img_processing.averaging import PARTIAL_SUMS_DIR
 from lama.elastix.elastix_registration import TargetBasedRegistration
+from lama.work_queue import WorkQueue, default_worker_id
 from logzero import logger as logging
 import logzero
 import SimpleITK as sitk
 
+WORK_QUEUE_DB = 'work_queue.db'
+AVERAGE_STAGE_SUFFIX = '_average'  # The average for each stage is a single task in its own queue stage
 
-def make_avg(root_dir: Path,  out_path: Path, log_path):
 
-    paths = []
+def make_avg(root_dir: Path,  out_path: Path, log_path, method: str = 'mean', trim: float = 0.1):
+
+    paths = {}
     for spec_dir in root_dir.iterdir():
-        if not spec_dir.is_dir():
+        if not spec_dir.is_dir() or spec_dir.name == PARTIAL_SUMS_DIR:
             continue
-        paths.append(spec_dir / f'{spec_dir.name}.nrrd')
+        paths[spec_dir.name] = spec_dir / f'{spec_dir.name}.nrrd'
 
-    avg = common.average(paths)
     logzero.logfile(log_path)
     logging.info(f'\nCreating average from:\n')
-    logging.info('\n'.join([str(x) for x in paths]))
-    sitk.WriteImage(avg, str(out_path))
+    logging.info('\n'.join([str(x) for x in paths.values()]))
 
+    if method == 'mean':
+        # Merge the sums written by each worker as it finished its specimens rather than re-read every volume
+        try:
+            avg = averaging.mean_from_partial_sums(root_dir / PARTIAL_SUMS_DIR, paths)
+        except ValueError as e:
+            # A specimen can be in two partial sums if a worker died after saving its sum but before marking the
+            # specimen done, and another worker then re-registered it
+            logging.warning(f'Cannot use partial sums ({e}). Averaging from the registered volumes')
+        else:
+            sitk.WriteImage(avg, str(out_path), True)
+            return
 
-def check_stage_done(root_dir) -> bool:
-    # Check to see if all specimens have finished within a stage
-    for spec_dir in root_dir.iterdir():
-        if not spec_dir.is_dir():
-            continue
-        if not (spec_dir / 'spec_done').is_file():
-            return False
-    return True
+    averaging.write_average(list(paths.values()), out_path, method, trim=trim)
 
 
 def job_runner(config_path: Path) -> Path:
@@ -79,6 +89,9 @@ def job_runner(config_path: Path) -> Path:
     inputs_dir = config.options['inputs']
     spec_ids = [Path(x).stem for x in common.get_file_paths(inputs_dir)]
 
+    queue = WorkQueue(Path(config['output_dir']) / WORK_QUEUE_DB)
+    worker_id = default_worker_id()
+
     for i, reg_stage in enumerate(config['registration_stage_params']):
 
         stage_id = reg_stage['stage_id']
@@ -88,103 +101,116 @@ def job_runner(config_path: Path) -> Path:
         # Make stage dir if not made by another instance of the script
         stage_dir.mkdir(exist_ok=True, parents=True)
 
-        starting_avg = stage_dir / 'avg_started'
-        average_done = stage_dir / "avg_done"
-
-        while True:  # Pick up unstarted speciemens. Only break when reg and avergae complete
-
-            # Check if any specimens left (It's possible the avg is being made but all specimens are registered)
-            spec_stage_dirs = [x.name for x in stage_dir.iterdir() if x.is_dir()]
-            not_started = set(spec_ids).difference(spec_stage_dirs)
-
-            next_stage = False  # No breaking out yet
-
-            if len(not_started) > 0:
-                next_spec_id = list(not_started)[0] # Some specimens left. Pick up spec_id and process
-
-            else:  # All specimens are being processed
-                next_stage = True
-
-                #  This block controls what happens if we have all speciemns registered
-                while True:
-                    if not check_stage_done(stage_dir):
-                        print('waiting for stage to finish')
-                        time.sleep(5)
-                        continue
-
-                    print('stage finished')
-
-                    if average_done.is_file():
-                        print('found average done file')
-                        break  # Next stage
-                    else:
-                        if starting_avg.is_file():
-                            print('found starting average file')
-                            time.sleep(5)
-                            continue
-                        else:
-                            try:
-                                open(starting_avg, 'x')
-                            except FileExistsError:
-                                time.sleep(5)
-                                print('cannot write avg starting file')
-                                continue
-                            else:
-                                average_path = avg_dir / f'{stage_id}.nrrd'
-                                make_avg(stage_dir, average_path, avg_dir / f'{stage_id}.log')
-                                open(average_done, 'x').close()
-                                print('making average')
-                                break
-
-            if next_stage:
-                print('breaking stage')
+        # Every worker adds the tasks. Ones already added by another worker are ignored
+        avg_stage = f'{stage_id}{AVERAGE_STAGE_SUFFIX}'
+        queue.add_tasks(stage_id, spec_ids)
+        queue.add_tasks(avg_stage, ['average'])
+
+        # The specimens this worker registers are added to its own partial sum, which are merged to make the average
+        partial_sum = averaging.PartialSum(stage_dir / PARTIAL_SUMS_DIR / f'{worker_id}.npz')
+
+        if i > 0:
+            fixed_vol = avg_dir / f'{list(config.stage_dirs.keys())[i-1]}.nrrd'
+
+        # Make the elastix parameter file for this stage
+        elxparam = elastix_stage_parameters[stage_id]
+        elxparam_path = stage_dir / f'{ELX_PARAM_PREFIX}{stage_id}.txt'
+
+        if not elxparam_path.is_file():
+            tmp_path = elxparam_path.with_name(f'{elxparam_path.name}.{worker_id}')
+            with open(tmp_path, 'w') as fh:
+                if elxparam:
+                    fh.write(elxparam)
+            os.replace(tmp_path, elxparam_path)
+
+        def register(spec_id):
+            register_specimen(config, i, spec_id, stage_dir, elxparam_path, fixed_vol, partial_sum)
+
+        run_stage(queue, stage_id, worker_id, register)
+
+        # Then one worker makes the average. If it dies its lease expires and another worker takes over
+        def average(_):
+            make_avg(stage_dir, avg_dir / f'{stage_id}.nrrd', avg_dir / f'{stage_id}.log',
+                     config['average_method'], config['average_trim'])
+
+        run_stage(queue, avg_stage, worker_id, average)
+
+
+def run_stage(queue: WorkQueue, stage: str, worker_id: str, run_task: Callable[[str], None]):
+    """
+    Claim and run tasks from a stage until every task in it is done (the stage barrier).
+
+    Waiting for the other workers' tasks is done in lease-length steps, claiming again in between. So if a worker
+    dies, its tasks are taken over once their leases expire rather than the barrier waiting for them forever
+
+    Parameters
+    ----------
+    run_task
+        Called with each claimed task id. A task that raises is given back to the queue to be retried
+
+    Raises
+    ------
+    WorkQueueException if a task in the stage has failed on all its attempts
+    """
+    while True:
+
+        while True:  # Pick up unstarted tasks until there are none left to claim
+
+            task_id = queue.claim(stage, worker_id)
+
+            if task_id is None:
                 break
 
-            # Get the input for this specimen
-            if i == 0:  # The first stage
-                moving = inputs_dir / f'{next_spec_id}.nrrd'
-            else:
-                moving = list(config.stage_dirs.values())[i-1] / next_spec_id / f'{next_spec_id}.nrrd'
-                fixed_vol = avg_dir / f'{list(config.stage_dirs.keys())[i-1]}.nrrd'
-            reg_method = TargetBasedRegistration
+            with queue.lease(stage, task_id, worker_id):
+                try:
+                    run_task(task_id)
+                except Exception as e:
+                    logging.exception(f'{task_id} failed in stage {stage}')
+                    queue.fail(stage, task_id, worker_id, str(e))
+                    continue
+
+            queue.complete(stage, task_id, worker_id)
 
-            # Make the elastix parameter file for this stage
-            elxparam = elastix_stage_parameters[stage_id]
-            elxparam_path = stage_dir / f'{ELX_PARAM_PREFIX}{stage_id}.txt'
+        if queue.wait_for_stage(stage, timeout=queue.lease_seconds):
+            return
 
-            if not elxparam_path.is_file():
-                with open(elxparam_path, 'w') as fh:
-                    if elxparam:
-                        fh.write(elxparam)
 
-            fixed_mask = None
+def register_specimen(config: LamaConfig, stage_idx: int, spec_id: str, stage_dir: Path, elxparam_path: Path,
+                      fixed_vol: Path, partial_sum: averaging.PartialSum):
 
-            logging.info(moving)
+    # Get the input for this specimen
+    if stage_idx == 0:  # The first stage
+        moving = config.options['inputs'] / f'{spec_id}.nrrd'
+    else:
+        moving = list(config.stage_dirs.values())[stage_idx - 1] / spec_id / f'{spec_id}.nrrd'
 
-            # Do the registrations
-            registrator = reg_method(elxparam_path,
-                                     moving,
-                                     stage_dir,
-                                     config['filetype'],
-                                     config['threads'],
-                                     fixed_mask
-                                     )
+    # Output left by a worker that died before completing this specimen
+    spec_dir = stage_dir / spec_id
+    if spec_dir.is_dir():
+        logging.info(f'Removing incomplete output {spec_dir}')
+        shutil.rmtree(spec_dir)
 
-            registrator.set_target(fixed_vol)
+    fixed_mask = None
 
-            try:
-                registrator.run()  # Do the registrations for a single stage
-            except FileExistsError as e:
-                # 040620: Bodge as some specimens are picked up twice.
-                # Need a better way to make sure each speciemn picked up only once
-                continue
+    logging.info(moving)
 
-            spec_done = stage_dir / next_spec_id / 'spec_done'  # The directory gets created in .run()
-            open(spec_done, 'x').close()
+    # Do the registrations
+    registrator = TargetBasedRegistration(elxparam_path,
+                                          moving,
+                                          stage_dir,
+                                          config['filetype'],
+                                          config['threads'],
+                                          fixed_mask
+                                          )
+
+    registrator.set_target(fixed_vol)
+    registrator.run()
+
+    if config['average_method'] == 'mean':
+        partial_sum.add(stage_dir / spec_id / f'{spec_id}.nrrd', spec_id)
 
 
 if __name__ == '__main__':
     import sys
     config_path_ = Path(sys.argv[1])
-
-job_runner(config_path_)
\ No newline at end of file
+    job_runner(config_path_)
@@ -33,9 +33,21 @@ Config file
     pad_dims: true # Pads all the volumes so all are the same dimensions. Finds the largest dimension from each volume
     pad_dims: [300, 255, 225]  # this specifies the dimensions tyo pad to
     threads: 10  # number of cpu cores to use
+    max_parallel_registrations: 4  # number of elastix/transformix processes to run at once. threads are split between them
+    overlap_reverse_registration: true  # run the reverse registrations while the deformations and glcms are made. threads are split between them
+    resume_registration: true  # reuse registrations from a previous run if their inputs and parameters are unchanged
+    process_timeout: 7200  # kill (and optionally retry) any elastix/transformix call running longer than this (seconds)
+    process_retries: 1
+    max_concurrent_processes: 6  # cap on elastix/transformix processes running at once, eg. when reverse registration overlaps other stages
+    propagation_backend: sitk  # propagate masks and labels in-process with SimpleITK rather than with transformix
+    pack_mask_into_labels: true  # propagate the stats mask and label map together in one pass
+    deformation_engine: numpy  # make jacobians in-process rather than with transformix. Falls back to transformix if needed
+    label_propagation: invert_field  # invert the transforms numerically rather than with elastix (or invert_transform, reverse_registration)
     filetype: nrrd  # the output file format - nrrd, nii, tiff
     compress_averages: true  # compress the averages to save disk space
     generate_new_target_each_stage: true  # true for creating an average. false for phenotype detection
+    average_method: trimmed_mean  # mean, median, trimmed_mean or winsorised_mean. Robust averages resist outliers
+    average_trim: 0.1  # proportion cut from each end for trimmed_mean and winsorised_mean
     
     staging entry. this allows for the automatoc determination of stage using various surrogates
     staging: scaling_factor
@@ -109,10 +121,13 @@ import SimpleITK as sitk
 import yaml
 import sys
 from pathlib import Path
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import signal
 import shutil
 
-from lama.elastix.propagate_volumes import PropagateLabelMap, PropagateMeshes
+from lama.elastix.propagate_volumes import (PropagateLabelMap, PropagatePackedLabelMap, PropagateMeshes,
+                                            run_propagations)
 from lama.elastix.invert_transforms import batch_invert_transform_parameters
 from lama.elastix.reverse_registration import reverse_registration
 from lama.img_processing.organ_vol_calculation import label_sizes
@@ -120,13 +135,14 @@ from lama.img_processing import glcm3d
 from lama.registration_pipeline.validate_config import LamaConfig, LamaConfigError
 from lama.elastix.deformations import make_deformations_at_different_scales
 from lama.qc.metric_charts import make_charts
-from lama.elastix.elastix_registration import TargetBasedRegistration, PairwiseBasedRegistration
+from lama.elastix.elastix_registration import TargetBasedRegistration, PairwiseBasedRegistration, split_threads
 from lama.staging import staging_metric_maker
 from lama.qc.qc_images import make_qc_images
 from lama.qc.folding import folding_report
 from lama.stats.standard_stats.data_loaders import DEFAULT_FWHM, DEFAULT_VOXEL_SIZE
 from lama.elastix import PROPAGATE_CONFIG, REG_DIR_ORDER_CFG
 from lama.monitor_memory import MonitorMemory
+from lama.elastix import process_runner
 from lama.common import cfg_load
 from lama.segmentation_plugins import plugin_interface
 
@@ -162,10 +178,13 @@ def run(configfile: Path):
         except Exception as e:
             raise(LamaConfigError(e))
 
-        config.mkdir('output_dir')
+        # If resuming, keep the previous registrations. They are checked against their inputs before being reused
+        clobber = not config['resume_registration']
+
+        config.mkdir('output_dir', clobber=clobber)
         qc_dir = config.mkdir('qc_dir')
-        config.mkdir('average_folder')
-        config.mkdir('root_reg_dir')
+        config.mkdir('average_folder', clobber=clobber)
+        config.mkdir('root_reg_dir', clobber=clobber)
 
         # TODO find the histogram batch code
         # if not config['no_qc']:
@@ -182,6 +201,9 @@ def run(configfile: Path):
         # signal.signal(signal.SIGTERM, common.service_shutdown)
         signal.signal(signal.SIGINT, common.service_shutdown)
 
+        process_runner.configure(max_concurrent=config['max_concurrent_processes'] or None,
+                                 timeout=config['process_timeout'] or None, retries=config['process_retries'])
+
         mem_monitor = MonitorMemory(Path(config['output_dir']).absolute())
 
         # Disable QC output?
@@ -196,12 +218,6 @@ def run(configfile: Path):
         # Fixed image for the moving populaiton average
         final_registration_dir = run_registration_schedule(config, first_stage_only=first_stage_only)
 
-        if not first_stage_only:
-            neg_jac = make_deformations_at_different_scales(config)
-            folding_report(neg_jac, config['output_dir'], config['label_info'], outdir=config['output_dir'])
-
-            create_glcms(config, final_registration_dir)
-
         # Write out the names of the registration dirs in the order they were run
         with open(config['root_reg_dir'] / REG_DIR_ORDER_CFG, 'w') as fh:
             for reg_stage in config['registration_stage_params']:
@@ -209,14 +225,37 @@ def run(configfile: Path):
                 if first_stage_only:
                     break
 
+        # The reverse registrations only need the first forward stage, so they can run while the deformations and
+        # glcms are made. The thread budget is then split between the two
+        reverse_reg = None
+        deformation_threads = config['threads']
+        if (not config['skip_transform_inversion'] and config['label_propagation'] == 'reverse_registration'
+                and config['overlap_reverse_registration']):
+            logging.info('Starting reverse registration in the background')
+            deformation_threads = split_threads(config['threads'], 2)
+            # generate_elx_parameters modifies the config, so do it before the main thread carries on using it
+            elastix_stage_parameters = generate_elx_parameters(config)
+            reverse_reg_pool = ThreadPoolExecutor(max_workers=1)
+            reverse_reg = reverse_reg_pool.submit(reverse_registration, config, deformation_threads,
+                                                  elastix_stage_parameters)
+            reverse_reg_pool.shutdown(wait=False)
+
+        if not first_stage_only:
+            neg_jac_summary = make_deformations_at_different_scales(config, deformation_threads)
+            folding_report(neg_jac_summary, config['label_map'], config['label_info'], outdir=config['output_dir'])
+
+            create_glcms(config, final_registration_dir)
+
         if config['skip_transform_inversion']:
             logging.info('Skipping inversion of transforms')
         else:
             logging.info('inverting transforms')
 
-            if config['label_propagation'] == 'reverse_registration':
+            if reverse_reg:
+                reverse_reg.result()  # Wait for the background reverse registration and raise any error from it
+            elif config['label_propagation'] == 'reverse_registration':
                 reverse_registration(config)
-            else:  # invert_transform method is the default
+            else:  # invert_transform or invert_field
                 batch_invert_transform_parameters(config)
 
             logging.info('propagating volumes')
@@ -309,13 +348,28 @@ def invert_volumes(config: LamaConfig):
 
     invert_config = config['inverted_transforms'] / PROPAGATE_CONFIG
 
-    if config['stats_mask']:
-        mask_inversion_dir = config.mkdir('inverted_stats_masks')
-        PropagateLabelMap(invert_config, config['stats_mask'], mask_inversion_dir, threads=config['threads']).run()
+    propagators = []
 
-    if config['label_map']:
+    if config['stats_mask'] and config['label_map'] and config['pack_mask_into_labels']:
+        # Propagate the mask and labels together, packed into one label map
+        mask_inversion_dir = config.mkdir('inverted_stats_masks')
         labels_inverion_dir = config.mkdir('inverted_labels')
-        PropagateLabelMap(invert_config, config['label_map'], labels_inverion_dir, threads=config['threads']).run()
+        propagators.append(PropagatePackedLabelMap(invert_config, config['label_map'], config['stats_mask'],
+                                                   labels_inverion_dir, mask_inversion_dir, threads=config['threads'],
+                                                   backend=config['propagation_backend']))
+    else:
+        if config['stats_mask']:
+            mask_inversion_dir = config.mkdir('inverted_stats_masks')
+            propagators.append(PropagateLabelMap(invert_config, config['stats_mask'], mask_inversion_dir,
+                                                 threads=config['threads'], backend=config['propagation_backend']))
+
+        if config['label_map']:
+            labels_inverion_dir = config.mkdir('inverted_labels')
+            propagators.append(PropagateLabelMap(invert_config, config['label_map'], labels_inverion_dir,
+                                                 threads=config['threads'], backend=config['propagation_backend']))
+
+    # Propagate the mask and labels of all specimens from one pool, sharing the threads
+    run_propagations(propagators, config['max_parallel_registrations'], config['threads'])
 
 
 def generate_organ_volumes(config: LamaConfig):
@@ -390,6 +444,16 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
     else:
         logging.info('Using same target for each stage')
 
+    if not regenerate_target and not config['pairwise_registration']:
+        # The target does not depend on the other specimens, so there is no need for a barrier between stages
+        if st:
+            stage_fixed_vols = stage_targets
+        else:
+            stage_fixed_vols = [config['fixed_volume']] * len(config['registration_stage_params'])
+
+        return run_pipelined_schedule(config, elastix_stage_parameters, stage_fixed_vols,
+                                      first_stage_only=first_stage_only)
+
     # Set the moving volume dir and the fixed image for the first stage
     moving_vols_dir = config['inputs']
 
@@ -422,7 +486,7 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
         stage_id = reg_stage['stage_id']
         stage_dir = config.stage_dirs[stage_id]
 
-        common.mkdir_force(stage_dir)
+        make_stage_dir(stage_dir, config)
 
         logging.info("### Current registration step: {} ###".format(stage_id))
 
@@ -460,6 +524,11 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
                 logging.info(f'Folding correction for stage {stage_id} set')
             registrator.fix_folding = config['fix_folding']  # Curently only works for TargetBasedRegistration
 
+        registrator.max_parallel_registrations = config['max_parallel_registrations']  # Only used by TargetBasedRegistration
+        registrator.resume = config['resume_registration']  # Only used by TargetBasedRegistration
+        registrator.average_method = config['average_method']
+        registrator.average_trim = config['average_trim']
+
         registrator.run()  # Do the registrations for a single stage
 
         # Make average from the stage outputs
@@ -490,6 +559,139 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
     return stage_dir
 
 
+def run_pipelined_schedule(config: LamaConfig,
+                           elastix_stage_parameters: OrderedDict,
+                           stage_fixed_vols: List,
+                           first_stage_only: bool = False) -> Path:
+    """
+    Run the registration stages when the fixed image of each stage is known in advance (phenotype detection).
+
+    The stages of each specimen form a chain of dependent jobs: a specimen moves on to its next stage as soon as its
+    previous stage has finished, so the batch is not held back by the slowest specimen at the end of every stage.
+    Up to config['max_parallel_registrations'] specimen chains are run at once, sharing the thread budget.
+
+    Parameters
+    ----------
+    config: Parsed and validated lama config
+    elastix_stage_parameters: The generated elastix parameters for each stage (from generate_elx_parameters)
+    stage_fixed_vols: The fixed image for each stage
+    first_stage_only: If True, just do the initial rigid stage
+
+    Returns
+    -------
+    The path to the final registrered images
+    """
+    reg_stages = config['registration_stage_params']
+    if first_stage_only:
+        reg_stages = reg_stages[:1]
+
+    stages: List[Dict] = []
+
+    for reg_stage, fixed_vol in zip(reg_stages, stage_fixed_vols):
+        stage_id = reg_stage['stage_id']
+        stage_dir = config.stage_dirs[stage_id]
+
+        make_stage_dir(stage_dir, config)
+
+        elxparam = elastix_stage_parameters[stage_id]
+        elxparam_path = stage_dir / f'{ELX_PARAM_PREFIX}{stage_id}.txt'
+
+        with open(elxparam_path, 'w') as fh:
+            if elxparam:
+                fh.write(elxparam)
+
+        fix_folding = False
+        if reg_stage['elastix_parameters']['Transform'] == 'BSplineTransform' and config['fix_folding']:
+            logging.info(f'Folding correction for stage {stage_id} set')
+            fix_folding = True
+
+        stages.append({'stage_id': stage_id,
+                       'stage_dir': stage_dir,
+                       'elxparam_path': elxparam_path,
+                       'fixed_vol': fixed_vol,
+                       'fix_folding': fix_folding})
+
+    moving_imgs = common.get_images_ignore_elx_itermediates(config['inputs'])
+
+    if len(moving_imgs) < 1:
+        raise common.LamaDataException("No volumes in {}".format(config['inputs']))
+
+    num_parallel = max(1, min(config['max_parallel_registrations'], len(moving_imgs)))
+    threads = split_threads(config['threads'], num_parallel)
+
+    logging.info(f"### Registering {len(moving_imgs)} specimens through stages: "
+                 f"{', '.join(s['stage_id'] for s in stages)} ###")
+    logging.info(f'{num_parallel} specimens at a time using {threads} threads each')
+
+    def register_specimen(mov: Path):
+        for stage in stages:
+            logging.info(f"{mov.stem}: registration step {stage['stage_id']}")
+
+            registrator = TargetBasedRegistration(stage['elxparam_path'],
+                                                  mov,
+                                                  stage['stage_dir'],
+                                                  config['filetype'],
+                                                  threads,
+                                                  config['fixed_mask'])
+            registrator.set_target(stage['fixed_vol'])
+            registrator.fix_folding = stage['fix_folding']
+            registrator.resume = config['resume_registration']
+            registrator.run()
+
+            # The output of the current stage is the input to the next
+            mov = stage['stage_dir'] / mov.stem / f"{mov.stem}.{config['filetype']}"
+
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=num_parallel) as pool:
+        jobs = {pool.submit(register_specimen, mov): mov for mov in moving_imgs}
+
+        for job in as_completed(jobs):
+            mov = jobs[job]
+            try:
+                job.result()
+            except Exception as e:
+                logging.exception(f'Registration of {mov.stem} failed: {e}')
+                failed.append(mov.stem)
+            else:
+                logging.info(f'{mov.stem}: all registration stages finished')
+
+    if failed:
+        raise common.RegistrationException(f'Registration failed for the following specimens: {", ".join(failed)}')
+
+    if not config['no_qc']:
+        for stage in stages:
+            stage_metrics_dir = config['metric_charts_dir'] / stage['stage_id']
+            common.mkdir_force(stage_metrics_dir)
+            make_charts(stage['stage_dir'], stage_metrics_dir)
+
+    logging.info("### Registration finished ###")
+
+    return stages[-1]['stage_dir']
+
+
+def make_stage_dir(stage_dir: Path, config: LamaConfig):
+    """
+    Make the output directory for a registration stage.
+
+    If config['resume_registration'] is set, the specimen results from a previous run are kept so that they can be
+    reused if their inputs and parameters have not changed. Results for specimens that are no longer in the inputs
+    are removed so they do not end up in the averages
+    """
+    if not config['resume_registration']:
+        common.mkdir_force(stage_dir)
+        return
+
+    stage_dir.mkdir(parents=True, exist_ok=True)
+
+    input_ids = [x.stem for x in common.get_images_ignore_elx_itermediates(config['inputs'])]
+
+    for spec_dir in stage_dir.iterdir():
+        if spec_dir.is_dir() and spec_dir.name not in input_ids:
+            logging.info(f'Removing previous registration output for {spec_dir.name} as it is not in the inputs')
+            shutil.rmtree(spec_dir)
+
+
 def create_glcms(config: LamaConfig, final_reg_dir):
     """
     Create grey level co-occurence matrices. This is done in the main registration pipeline as we don't
@@ -13,6 +13,7 @@ import toml
 
 from lama import common
 from lama.staging.staging_metric_maker import STAGING_METHODS, DEFAULT_STAGING_METHOD
+from lama.img_processing.averaging import AVERAGE_METHODS
 
 
 DATA_TYPE_OPTIONS = ('uint8', 'int8', 'int16', 'uint16', 'float32')
@@ -108,9 +109,17 @@ class LamaConfig:
             'registration_stage_params': ('dict', 'required'),
             'no_qc': ('bool', False),
             'threads': ('int', 4),
+            'max_parallel_registrations': ('int', 1),
+            'resume_registration': (bool, False),
+            'process_timeout': ('int', 0),  # Wall-clock limit in seconds for each elastix/transformix call. 0 for none
+            'process_retries': ('int', 0),  # How many times to retry an elastix/transformix call that times out
+            'max_concurrent_processes': ('func', self.validate_max_concurrent_processes),
+            'deformation_engine': (['transformix', 'numpy'], 'transformix'),  # numpy: make jacobians in-process
             'filetype': ('func', self.validate_filetype),
             'voxel_size': ('float', 14.0),
             'generate_new_target_each_stage': ('bool', False),
+            'average_method': (list(AVERAGE_METHODS), 'mean'),  # How to make the population average for each stage
+            'average_trim': ('func', self.validate_average_trim),
             'skip_transform_inversion': ('bool', False),
             'pairwise_registration': ('bool', False),
             'generate_deformation_fields': ('dict', None),
@@ -121,7 +130,10 @@ class LamaConfig:
             'stage_targets': (Path, False),
             'fix_folding': (bool, False),
             # 'inverse_transform_method': (['invert_transform', 'reverse_registration'], 'invert_transform')
-            'label_propagation': (['invert_transform', 'reverse_registration'], 'reverse_registration'),
+            'label_propagation': (['invert_transform', 'invert_field', 'reverse_registration'], 'reverse_registration'),
+            'overlap_reverse_registration': (bool, True),  # Run reverse_registration alongside the deformations
+            'propagation_backend': (['transformix', 'sitk'], 'transformix'),  # sitk: resample labels in-process
+            'pack_mask_into_labels': (bool, False),  # Propagate the stats mask packed into a spare bit of the labels
             'skip_forward_registration': (bool, False),
             'seg_plugin_dir': (Path, None),
 
@@ -176,7 +188,7 @@ class LamaConfig:
         self.options[key] = value
 
     def check_propagation_options(self):
-        if self.options['skip_forward_registration'] and self.options['label_propagation'] == 'invert_transform':
+        if self.options['skip_forward_registration'] and self.options['label_propagation'] != 'reverse_registration':
                 raise LamaConfigError("'skip_forward_registration' is only abailble when 'label_propagation "
                                       "= 'reverse_registration'")
         # # Temp until a fix is made
@@ -299,6 +311,29 @@ class LamaConfig:
 
         self.options['staging'] = st
 
+    def validate_average_trim(self):
+        """
+        The proportion cut from each end of the distribution by the trimmed and winsorised mean averages
+        """
+        trim = self.config.get('average_trim', 0.1)
+
+        if not isinstance(trim, (int, float)) or not 0 <= trim < 0.5:
+            raise LamaConfigError("'average_trim' should be a number >= 0 and < 0.5")
+
+        self.options['average_trim'] = float(trim)
+
+    def validate_max_concurrent_processes(self):
+        """
+        The most elastix/transformix processes to run at once across all of LAMA, whichever stages are overlapping.
+        0 for no limit other than max_parallel_registrations
+        """
+        max_concurrent = self.config.get('max_concurrent_processes', 0)
+
+        if not isinstance(max_concurrent, int) or isinstance(max_concurrent, bool) or max_concurrent < 0:
+            raise LamaConfigError("'max_concurrent_processes' should be an integer >= 0")
+
+        self.options['max_concurrent_processes'] = max_concurrent
+
     def validate_filetype(self):
         """
         Filetype can be specified in the elastix config section, but this intereferes with LAMA config section
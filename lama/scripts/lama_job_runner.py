@@ -2,8 +2,14 @@
 
 """
 This module takes a directory containing one or more subdirectories each containing a mutant line or baseline inputs
-It will try to make a lock on the input file and remove a line/specimen to process after which it will release the lock
-This is to enable multiple machines to process the data concurrently.
+Each specimen is a job in a SQLite job store (lama.work_queue) in the root directory. Instances of this script claim
+jobs from it, which enables multiple machines to process the data concurrently.
+
+Jobs are claimed under a lease that is kept alive while lama runs. If a machine dies, its jobs are picked up by
+another instance once the lease expires.
+
+Progress, throughput and an estimated finish time can be seen with --status, and the job list can be exported to the
+old lama_jobs.csv format with --export_csv.
 
 """
 import sys
@@ -20,22 +26,38 @@ if lama_docker_dir.is_dir():
     print(sys.path)
 
 import shutil
-import socket
-from datetime import datetime
+import time
+import multiprocessing
+from typing import Union, Dict
 
-from filelock import SoftFileLock, Timeout
 from logzero import logger as logging
 import pandas as pd
+import psutil
 import toml
 
 from inspect import currentframe
 
 from lama.registration_pipeline import run_lama
 from lama.registration_pipeline.validate_config import LamaConfigError
+from lama import common
 from lama.common import cfg_load
+from lama.monitor_memory import LOG_FILENAME
+from lama.work_queue import WorkQueue, default_worker_id, PENDING, RUNNING, DONE, FAILED
+
 
+JOBFILE_NAME = 'lama_jobs.csv'  # Now only written by export_jobs_csv
+JOB_STORE_NAME = 'lama_jobs.db'
+JOB_STAGE = 'lama_jobs'  # All the jobs are in one stage of the work queue
+CONFIG_ERROR = 'config_error'
 
-JOBFILE_NAME = 'lama_jobs.csv'
+# run_job return values. Also the exit codes of job processes in multi-slot mode, so they must not be codes a process
+# could exit with for other reasons (1 for an uncaught exception, 2 for a usage error)
+JOB_OK = 0
+JOB_FAILED = 10
+JOB_CONFIG_ERROR = 11
+
+# How long a job's lease lasts without a heartbeat. Heartbeats are sent every third of this
+LEASE_SECONDS = 600
 
 
 def linenum():
@@ -43,17 +65,16 @@ def linenum():
     return cf.f_back.f_lineno
 
 
-def make_jobs_file(jobs_file: Path, root_dir: Path):
+def make_jobs_file(job_store: Path, root_dir: Path):
     """
-    Creates a joblist csv file for use with lama_job_runner.
+    Creates the job store for use with lama_job_runner.
     Searches for all images paths in subdirectories of root_dir/inputs
     and ...
 
     Parameters
     ----------
-    jobfile_path: Path to save job file to
+    job_store: Path to the job store (SQLite) file
     root_dir: the root project directory
-    is_mutants: if True search the folder for individual line sub folders
 
     """
     output_dir = root_dir / 'output'
@@ -71,18 +92,214 @@ def make_jobs_file(jobs_file: Path, root_dir: Path):
 
             # Create a job entry. Dir will be the specimen directory relative to the jobs file
             rel_path_to_specimen_input = str(vol_path.relative_to(root_dir))
-            jobs_entries.append([rel_path_to_specimen_input, 'to_run', '_', '_', '_'])
-
-    jobs_df = pd.DataFrame.from_records(jobs_entries, columns=['job', 'status', 'host', 'start_time', 'end_time'])
+            jobs_entries.append(rel_path_to_specimen_input)
 
-    jobs_df.to_csv(jobs_file)
+    WorkQueue(job_store).add_tasks(JOB_STAGE, jobs_entries)
     return True
 
 
+def export_jobs_csv(job_store: Path, csv_path: Path) -> pd.DataFrame:
+    """
+    Write the jobs to csv in the format of the old lama_jobs.csv job file
+    """
+    df = WorkQueue(job_store).tasks(JOB_STAGE)
+
+    status_names = {PENDING: 'to_run', RUNNING: 'running', DONE: 'complete', FAILED: 'failed'}
+    status = df.status.map(status_names)
+    status[df.error == CONFIG_ERROR] = CONFIG_ERROR
+
+    def fmt_time(t):
+        return pd.to_datetime(t, unit='s').dt.strftime('%Y-%m-%d %H:%M:%S').fillna('_')
+
+    jobs_df = pd.DataFrame({'job': df.task_id,
+                            'status': status,
+                            'host': df.host.fillna('_'),
+                            'start_time': fmt_time(df.started),
+                            'end_time': fmt_time(df.finished)})
+    jobs_df.to_csv(csv_path)
+    return jobs_df
+
+
+def setup_job(vol: Path, config_path: Path, root_directory: Path) -> Path:
+    """
+    Make a project directory for a specimen and copy in its input and the config
+
+    Returns
+    -------
+    The path to the specimen's config
+    """
+    # Make a project dir drectory for specimen
+    # vol.parent should be the line name
+    # vol.stem is the specimen name minus the extension
+    spec_root_dir = root_directory / 'output' / vol.parent.name / vol.stem
+    spec_input_dir = spec_root_dir / 'inputs'
+    spec_input_dir.mkdir(exist_ok=True, parents=True)
+    spec_out_dir = spec_root_dir / 'output'
+    spec_out_dir.mkdir(exist_ok=True, parents=True)
+    shutil.copy(vol, spec_input_dir)
+
+    # Copy the config into the project directory
+    dest_config_path = spec_root_dir / config_path.name
+
+    if dest_config_path.is_file():
+        os.remove(dest_config_path)
+
+    shutil.copy(config_path, dest_config_path)
+
+    # rename the target_folder now we've moved the config
+    c = cfg_load(dest_config_path)
+
+    target_folder = config_path.parent / c.get('target_folder')
+    # Can't seem to get this to work with pathlib
+    target_folder_relpath = os.path.relpath(target_folder, str(dest_config_path.parent))
+    c['target_folder'] = target_folder_relpath
+
+    with open(dest_config_path, 'w') as fh:
+        fh.write(toml.dumps(c))
+
+    return dest_config_path
+
+
+class JobMemoryEstimator:
+    """
+    Estimate the peak memory a job will need from the memory.log files (see lama.monitor_memory) of previous jobs.
+    The logs record memory as a percentage of the total memory of the machine, which is assumed to be the same size
+    as this one.
+    """
+    def __init__(self, root_directory: Path, default: Union[int, None] = None, safety_factor: float = 1.2):
+        """
+        Parameters
+        ----------
+        root_directory
+            The job runner root. Logs are found in output/<line>/<specimen>/output/memory.log
+        default
+            Estimate in bytes to use before any logs exist. If None, no estimate is made until one job has
+            written a log, so only one job is run until then
+        safety_factor
+            The largest previous peak is multiplied by this
+        """
+        self.log_glob = str(Path('output') / '*' / '*' / 'output' / LOG_FILENAME)
+        self.root_directory = root_directory
+        self.default = default
+        self.safety_factor = safety_factor
+        self._peaks = {}  # log path: (mtime, peak %)
+
+    def _peak_percent(self, log_path: Path) -> float:
+        mtime = log_path.stat().st_mtime
+        if log_path in self._peaks and self._peaks[log_path][0] == mtime:
+            return self._peaks[log_path][1]
+        try:
+            peak = pd.read_csv(log_path).iloc[:, 1].max()
+        except (pd.errors.EmptyDataError, IndexError):
+            peak = 0
+        peak = 0 if pd.isnull(peak) else float(peak)
+        self._peaks[log_path] = (mtime, peak)
+        return peak
+
+    def estimate(self) -> Union[int, None]:
+        """
+        Returns
+        -------
+        Estimated peak memory in bytes for the next job. None if there is no history and no default
+        """
+        peaks = [self._peak_percent(p) for p in self.root_directory.glob(self.log_glob)]
+        peaks = [p for p in peaks if p > 0]
+
+        if not peaks:
+            return self.default
+
+        total = psutil.virtual_memory().total
+        return int(max(peaks) / 100 * total * self.safety_factor)
+
+
+def process_tree_rss(pid: int) -> int:
+    """
+    The resident memory of a process and all of its children (eg. the elastix calls) in bytes
+    """
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+
+    rss = 0
+    for p in procs:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+def run_job(queue: WorkQueue, job: str, worker: str, config_path: Path, root_directory: Path) -> int:
+    """
+    Run a single job and record the outcome in the job store
+
+    Returns
+    -------
+    JOB_OK, JOB_FAILED or JOB_CONFIG_ERROR
+    """
+    queue.start(JOB_STAGE, job, worker)
+    vol = root_directory / job
+
+    try:
+        logging.info(f'trying {vol.name}')
+        dest_config_path = setup_job(vol, config_path, root_directory)
+        run_lama.run(dest_config_path)
+
+    except LamaConfigError as lce:
+        logging.exception(f'There is a problem with the config\n{lce}')
+        queue.fail(JOB_STAGE, job, worker, CONFIG_ERROR, retry=False)
+        return JOB_CONFIG_ERROR
+
+    except KeyboardInterrupt:
+        logging.info('terminating')
+        # Put the job back so other instances can run it
+        queue.fail(JOB_STAGE, job, worker, 'interrupted')
+        raise
+
+    except Exception as e:
+        logging.exception(e)
+        queue.fail(JOB_STAGE, job, worker, str(e), retry=False)
+        return JOB_FAILED
+
+    queue.complete(JOB_STAGE, job, worker)
+    return JOB_OK
+
+
+def _run_job_process(*args):
+    # Entry point for job processes in multi-slot mode. The exit code is the run_job status
+    try:
+        sys.exit(run_job(*args))
+    except KeyboardInterrupt:
+        sys.exit(JOB_FAILED)
+
+
+def _job_process_exited(queue: WorkQueue, job: str, worker: str, exitcode: int) -> int:
+    """
+    Handle the exit of a job process. run_job has recorded the outcome if the exit code is one of its return values.
+    Any other code means the process died (killed, or crashed before recording anything), so the job is given back to
+    be tried again
+
+    Returns
+    -------
+    The run_job status. JOB_FAILED if the process died
+    """
+    if exitcode in (JOB_OK, JOB_FAILED, JOB_CONFIG_ERROR):
+        return exitcode
+
+    logging.error(f'Job process for {job} exited with code {exitcode}')
+    queue.fail(JOB_STAGE, job, worker, f'job process exited with code {exitcode}')
+    return JOB_FAILED
+
+
 def lama_job_runner(config_path: Path,
                     root_directory: Path,
                     make_job_file: bool=False,
-                    log_level=None):
+                    log_level=None,
+                    batch_size: int = 1,
+                    slots: int = 1,
+                    job_memory: Union[int, None] = None):
 
     """
 
@@ -93,18 +310,20 @@ def lama_job_runner(config_path: Path,
     root_directory
         path to root directory. The folder names from job_file.dir will be appending to this path to resolve project directories
     make_job_file
-        if true, just make the job_file that other instances can consume
+        if true, just make the job store that other instances can consume
+    batch_size
+        The number of jobs to claim at a time. Larger batches mean less traffic on the job store, but jobs waiting
+        in a batch can't be picked up by other instances
+    slots
+        The maximum number of jobs to run at once. If > 1, jobs are run in separate processes and a new job is only
+        claimed when there are enough free cores (by the config's thread count) and memory for it. See run_slots
+    job_memory
+        Memory estimate per job in bytes, used by slots > 1 until memory logs from previous jobs are available
 
     Notes
     -----
-    This function uses a SoftFileLock for locking the job_file csv to prevent multiple instances of this code from
-    processing the same line or specimen. A SoftFileLock works by creating a lock file, and the presence of this file
-    prevents other instances from accessing it. We don't use FileLock (atlhough this is more robust) as it's not
-    supported on nfs file systems. The advantage of SoftFileLock is you can create a lock file manually if
-    you want to edit a job file manually while job_runner is running (make sure to delete after editing).
-
-    If this script terminates unexpectedly while it has a lock on the file, it will not be released and the file
-    remains. Therefore before running this script, ensure no previous lock file is hanging around.
+    Jobs are claimed from a SQLite job store in a single transaction, so each job is only run once. If an instance dies,
+    the lease on its jobs expires and they are given to another instance. A job that fails is not retried.
     """
     if log_level:
         logzero.loglevel(log_level)
@@ -114,121 +333,142 @@ def lama_job_runner(config_path: Path,
 
     root_directory = root_directory.resolve()
 
-    job_file = root_directory / JOBFILE_NAME
-    lock_file = job_file.with_suffix('.lock')
-    lock = SoftFileLock(lock_file)
-    # init_file = root_directory / 'init'
-
-    HN = socket.gethostname()
+    job_store = root_directory / JOB_STORE_NAME
 
     if make_job_file:
 
-        # Delete any lockfile and job_file that might be present from previous runs.
-        if job_file.is_file():
-            os.remove(job_file)
-
-        if lock_file.is_file():
-            os.remove(lock_file)
+        # Delete any job store that might be present from previous runs.
+        if job_store.is_file():
+            os.remove(job_store)
 
-        try:
-            with lock.acquire(timeout=1):
-                logging.info('Making job list file')
-                make_jobs_file(job_file, root_directory)
-                logging.info('Job file created!. You can now run job_runner from multiple machines')
-                return
+        logging.info('Making job store')
+        make_jobs_file(job_store, root_directory)
+        logging.info('Job store created!. You can now run job_runner from multiple machines')
+        return
 
-        except Timeout:
-            logging.error(f"Make sure lock file: {lock_file} is not present on running first instance")
-            sys.exit()
+    queue = WorkQueue(job_store, lease_seconds=LEASE_SECONDS)
+    worker = default_worker_id()
 
-    config_name = config_path.name
+    if slots > 1:
+        run_slots(queue, worker, config_path, root_directory, slots, job_memory)
+        logging.info('Exiting job_runner')
+        return True
 
     while True:
 
-        try:
-            # Create a lock then read jobs and add status to job file to ensure job is run once only.
-            with lock.acquire(timeout=60):
+        batch = queue.claim_batch(JOB_STAGE, worker, batch_size)
 
-                df_jobs = pd.read_csv(job_file, index_col=0)
+        if not batch:
+            logging.info("No more jobs left on jobs list")
+            break
 
-                # Get an unfinished job
-                jobs_to_do = df_jobs[df_jobs['status'] == 'to_run']
+        with queue.lease(JOB_STAGE, None, worker):
+            for i, job in enumerate(batch):
+                try:
+                    status = run_job(queue, job, worker, config_path, root_directory)
+                except KeyboardInterrupt:
+                    queue.release(JOB_STAGE, batch[i + 1:], worker)
+                    sys.exit('Exiting')
 
-                if len(jobs_to_do) < 1:
-                    logging.info("No more jobs left on jobs list")
-                    break
+                if status == JOB_CONFIG_ERROR:
+                    queue.release(JOB_STAGE, batch[i + 1:], worker)
+                    sys.exit()
 
-                indx = jobs_to_do.index[0]
+    logging.info('Exiting job_runner')
+    return True
 
-                vol = root_directory / (jobs_to_do.at[indx, 'job'])
 
-                df_jobs.at[indx, 'status'] = 'running'
+def run_slots(queue: WorkQueue, worker: str, config_path: Path, root_directory: Path, slots: int,
+              job_memory: Union[int, None] = None, poll_interval: float = 10):
+    """
+    Run up to `slots` jobs at once, each in its own process.
 
-                df_jobs.at[indx, 'start_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    Before each claim we check that
+        * the config's thread count fits in the cores not already given to running jobs
+        * common.available_memory(), less the memory the running jobs are still expected to grow into, is more than
+          the per-job estimate from JobMemoryEstimator
 
-                df_jobs.at[indx, 'host'] = socket.gethostname()
+    If no estimate is available yet (no memory logs and no job_memory) only one job is run at a time.
+    """
+    threads = int(cfg_load(config_path).get('threads', 4))
+    cores = os.cpu_count() or 1
+    estimator = JobMemoryEstimator(root_directory, job_memory)
 
-                df_jobs.to_csv(job_file)
+    if threads > cores:
+        logging.warning(f'config threads ({threads}) is more than the number of cores ({cores})')
 
-                # Make a project dir drectory for specimen
-                # vol.parent should be the line name
-                # vol.stem is the specimen name minus the extension
-                spec_root_dir = root_directory / 'output' / vol.parent.name / vol.stem
-                spec_input_dir = spec_root_dir / 'inputs'
-                spec_input_dir.mkdir(exist_ok=True, parents=True)
-                spec_out_dir = spec_root_dir / 'output'
-                spec_out_dir.mkdir(exist_ok=True, parents=True)
-                shutil.copy(vol, spec_input_dir)
+    running = {}  # job: Process
+    ctx = multiprocessing.get_context('spawn')  # Don't fork the heartbeat thread or open sqlite handles
+    no_more_jobs = False
+    config_error = False
 
-                # Copy the config into the project directory
-                dest_config_path = spec_root_dir / config_name
+    with queue.lease(JOB_STAGE, None, worker):
+        while True:
 
-                if dest_config_path.is_file():
-                    os.remove(dest_config_path)
+            for job, proc in list(running.items()):
+                if not proc.is_alive():
+                    proc.join()
+                    del running[job]
+                    if _job_process_exited(queue, job, worker, proc.exitcode) == JOB_CONFIG_ERROR:
+                        config_error = True
 
-                shutil.copy(config_path, dest_config_path)
+            if (no_more_jobs or config_error) and not running:
+                break
 
-                # rename the target_folder now we've moved the config
-                c = cfg_load(dest_config_path)
+            if not no_more_jobs and not config_error and len(running) < slots and \
+                    _can_admit(running, threads, cores, estimator):
 
-                target_folder = config_path.parent / c.get('target_folder')
-                # Can't seem to get this to work with pathlib
-                target_folder_relpath = os.path.relpath(target_folder, str(dest_config_path.parent))
-                c['target_folder'] = target_folder_relpath
+                job = queue.claim(JOB_STAGE, worker)
 
-                with open(dest_config_path, 'w') as fh:
-                    fh.write(toml.dumps(c))
+                if job is None:
+                    logging.info("No more jobs left on jobs list")
+                    no_more_jobs = True
+                    continue
 
-        except Timeout:
-            sys.exit('Timed out' + socket.gethostname())
+                proc = ctx.Process(target=_run_job_process,
+                                   args=(queue, job, worker, config_path, root_directory))
+                proc.start()
+                running[job] = proc
+                logging.info(f'Started {job} ({len(running)} running)')
+                continue  # See if another job fits
+
+            time.sleep(poll_interval)
+
+    if config_error:
+        sys.exit()
+
+
+def _can_admit(running: Dict, threads: int, cores: int, estimator: JobMemoryEstimator) -> bool:
+    """
+    Decide whether there are the cores and memory to start another job alongside the running ones
+    """
+    if not running:
+        return True  # Always run at least one job
+
+    free_cores = cores - threads * len(running)
+    if free_cores < threads:
+        return False
+
+    estimate = estimator.estimate()
+    if estimate is None:
+        return False  # Nothing to go on yet. Wait for a memory log
+
+    rss = [process_tree_rss(p.pid) for p in running.values()]
+
+    # Running jobs may not have reached their peak yet, so hold back the memory they are still expected to use
+    reserved = sum(max(0, estimate - r) for r in rss)
+
+    if 'MEMORY_LIMIT' in os.environ:
+        # available_memory() is then the fixed limit rather than what is free now, so also take off what the running
+        # jobs already use
+        reserved += sum(rss)
+
+    free_mem = common.available_memory() - reserved
+
+    if free_mem < estimate:
+        logging.debug(f'Not starting another job. {free_mem / 1e9:.1f}GB free, job estimated at {estimate / 1e9:.1f}GB')
+        return False
 
-        try:
-            logging.info(f'trying {vol.name}')
-            run_lama.run(dest_config_path)
-
-        except LamaConfigError as lce:
-            status = 'config_error'
-            logging.exception(f'There is a problem with the config\n{lce}')
-            sys.exit()
-
-        except Exception as e:
-            if e.__class__.__name__ == 'KeyboardInterrupt':
-                logging.info('terminating')
-                sys.exit('Exiting')
-
-            status = 'failed'
-            logging.exception(e)
-
-        else:
-            status = 'complete'
-
-        finally:
-            with lock:
-                df_jobs = pd.read_csv(job_file, index_col=0)
-                df_jobs.at[indx, 'status'] = status
-                df_jobs.at[indx, 'end_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                df_jobs.to_csv(job_file)
-    logging.info('Exiting job_runner')
     return True
 
 
@@ -237,18 +477,41 @@ def main():
 
     parser = argparse.ArgumentParser("Schedule LAMA jobs")
 
-    parser.add_argument('-c', '--config', dest='config', help='lama.yaml config file',
-                        required=True)
+    parser.add_argument('-c', '--config', dest='config', help='lama.yaml config file. Not needed for --status or --export_csv',
+                        required=False)
     parser.add_argument('-r', '--root_dir', dest='root_dir', help='The root directory containing the input folders',
                         required=True)
     parser.add_argument('-m', '--make_job_file', dest='make_job_file', help='Run with this option forst to crate a job file',
                     action='store_true', default=False)
+    parser.add_argument('-b', '--batch_size', dest='batch_size', help='Number of jobs to claim at a time',
+                        type=int, default=1)
+    parser.add_argument('-k', '--slots', dest='slots', help='Maximum number of jobs to run at once on this machine. '
+                        'Jobs are only started when there are free cores and enough memory for them', type=int, default=1)
+    parser.add_argument('--job_memory', dest='job_memory', type=float, default=None,
+                        help='Memory (GB) needed per job. Only used with --slots until memory logs from earlier jobs exist')
+    parser.add_argument('-s', '--status', dest='status', help='Print job progress, throughput and ETA then exit',
+                        action='store_true', default=False)
+    parser.add_argument('-e', '--export_csv', dest='export_csv', help='Write the job list to this csv then exit',
+                        default=None)
     args = parser.parse_args()
 
-    try:
-        lama_job_runner(Path(args.config), Path(args.root_dir), args.make_job_file)
-    except pd.errors.EmptyDataError as e:
-        logging.exception(f'poandas read failure {e}')
+    job_store = Path(args.root_dir).resolve() / JOB_STORE_NAME
+
+    if args.status:
+        print(WorkQueue(job_store).status_report(JOB_STAGE))
+        return
+
+    if args.export_csv:
+        export_jobs_csv(job_store, Path(args.export_csv))
+        return
+
+    if not args.config:
+        parser.error('--config is required to run jobs')
+
+    job_memory = int(args.job_memory * 1e9) if args.job_memory else None
+
+    lama_job_runner(Path(args.config), Path(args.root_dir), args.make_job_file, batch_size=args.batch_size,
+                    slots=args.slots, job_memory=job_memory)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 """
-The code to run linear models in R.
+The code to run linear models in R, or natively with numpy (lm_numpy). lm_baseline fits the same models using stored
+wild type statistics (see standard_stats.baseline_store) instead of the wild type data.
 
 The current interface to R is to write binary files that R can read (numpy_to_dat). The reason r2py wasn't used is that
 it used to be a pain to install. I imagine it's better now and using docker should improve things so adding
@@ -9,23 +10,31 @@ test
 
 
 import subprocess as sub
-import os
 import struct
 from pathlib import Path
 import tempfile
-from typing import Tuple
+from typing import Dict, List, Tuple
 import shutil
 
 from logzero import logger as logging
 
 import numpy as np
 import pandas as pd
+from scipy import linalg, stats
 import statsmodels.formula.api as smf
 
 from lama import common
+from lama.stats import r_workers
 
 LM_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'lmFast.R')
 
+# Columns that R's lm treats as linearly dependent on the previous ones (see lm.fit tol)
+RANK_TOLERANCE = 1e-7
+
+# The row of the wild type X'Y (baseline_store.BaselineStatistics.xty) for each design matrix column. For the wild
+# types the genotype column is all ones ('wildtype'), the same as the intercept
+_BASELINE_ROWS = {'(Intercept)': 0, 'genotype': 0, 'staging': 1}
+
 # If debugging, don't delete the temp files used for communication with R so they can be used for R debugging.
 DEBUGGING = False
 
@@ -58,10 +67,10 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
 
     """
 
-    input_binary_file = tempfile.NamedTemporaryFile().name
-    line_level_pval_out_file = tempfile.NamedTemporaryFile().name
-    line_level_tstat_out_file = tempfile.NamedTemporaryFile().name
-    groups_file = tempfile.NamedTemporaryFile().name
+    input_binary_file = tempfile.NamedTemporaryFile(dir=r_workers.EXCHANGE_DIR).name
+    line_level_pval_out_file = tempfile.NamedTemporaryFile(dir=r_workers.EXCHANGE_DIR).name
+    line_level_tstat_out_file = tempfile.NamedTemporaryFile(dir=r_workers.EXCHANGE_DIR).name
+    groups_file = tempfile.NamedTemporaryFile(dir=r_workers.EXCHANGE_DIR).name
 
     # create groups file
     if use_staging:
@@ -73,49 +82,303 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=F
         formula = 'genotype'
 
     groups.index.name = 'volume_id'
-    groups.to_csv(groups_file)
 
-    _numpy_to_dat(data, input_binary_file)
+    args = [input_binary_file,
+            groups_file,
+            line_level_pval_out_file,
+            line_level_tstat_out_file,
+            formula,
+            str(boxcox).upper(),  # bool to string for R
+            ''  # No plots needed for permutation testing
+            ]
 
-    cmd = ['Rscript',
-           LM_SCRIPT,
-           input_binary_file,
-           groups_file,
-           line_level_pval_out_file,
-           line_level_tstat_out_file,
-           formula,
-           str(boxcox).upper(),  # bool to string for R
-           ''  # No plots needed for permutation testing
-           ]
-
-    try:
-        sub.check_output(cmd)
-    except sub.CalledProcessError as e:
-        msg = "R linear model failed: {}".format(e)
-        logging.exception(msg)
-        raise RuntimeError(msg)
-
-    # Read in the pvalue and t-statistic results.
-    # The start of the binary file will contain values from the line level call
-    # the specimen-level calls are appended onto this and need to be split accordingly.
     try:
-        p_all = np.fromfile(line_level_pval_out_file, dtype=np.float64).astype(np.float32)
-        t_all = np.fromfile(line_level_tstat_out_file, dtype=np.float64).astype(np.float32)
-    except FileNotFoundError as e:
-        print(f'Linear model file from R not found {e}')
-        raise FileNotFoundError('Cannot find LM output'.format(e))
-
-    if not DEBUGGING:
-        os.remove(input_binary_file)
-        os.remove(line_level_pval_out_file)
-        os.remove(line_level_tstat_out_file)
-        os.remove(groups_file)
+        groups.to_csv(groups_file)
+        _numpy_to_dat(data, input_binary_file)
+
+        try:
+            r_workers.run_rscript(LM_SCRIPT, args)
+        except sub.CalledProcessError as e:
+            msg = "R linear model failed: {}".format(e)
+            logging.exception(msg)
+            raise RuntimeError(msg)
+
+        # Read in the pvalue and t-statistic results.
+        # The start of the binary file will contain values from the line level call
+        # the specimen-level calls are appended onto this and need to be split accordingly.
+        try:
+            p_all = np.fromfile(line_level_pval_out_file, dtype=np.float64).astype(np.float32)
+            t_all = np.fromfile(line_level_tstat_out_file, dtype=np.float64).astype(np.float32)
+        except FileNotFoundError as e:
+            print(f'Linear model file from R not found {e}')
+            raise FileNotFoundError('Cannot find LM output'.format(e))
+
+    finally:
+        # The data chunks are large, so don't leave them behind if R fails
+        if not DEBUGGING:
+            r_workers.remove_exchange_files(input_binary_file, line_level_pval_out_file, line_level_tstat_out_file,
+                                            groups_file)
+
     return p_all, t_all
 
 
+def lm_numpy(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bool = False,
+             use_staging: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit the same linear models as lm_r (lmFast.R) with numpy, without the round trip to R.
+
+    The design matrix is shared by every voxel or label, so it is factored once and all the columns of data are fitted
+    with one matrix product. The specimen-level fits (all wild types plus one mutant) are not refitted for each
+    mutant, see _fit_specimens.
+
+    Parameters and returns as lm_r: the line-level results, followed by the results for each mutant in the order they
+    appear in info. The t-statistics are for the mutant genotype
+    """
+    if boxcox:
+        raise NotImplementedError('boxcox is not implemented in lmFast.R either')
+
+    # As lmFast.R, which fits the absolute values
+    y = np.abs(np.asarray(data, dtype=np.float64))
+
+    predictors = ['genotype', 'staging'] if use_staging else ['genotype']
+    groups = info[predictors]
+
+    p_line, t_line = _fit_genotype(y, groups)
+
+    genotype = groups['genotype'].values
+    wt_rows = np.flatnonzero(genotype == 'wildtype')
+    mut_rows = np.flatnonzero(genotype == 'mutant')
+
+    p_spec, t_spec = _fit_specimens(y[wt_rows], groups.iloc[wt_rows], y[mut_rows], groups.iloc[mut_rows])
+
+    p_all = np.concatenate([p_line, p_spec.ravel()])
+    t_all = np.concatenate([t_line, t_spec.ravel()])
+
+    return p_all.astype(np.float32), t_all.astype(np.float32)
+
+
+def _predictors(groups: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """
+    The columns of the design matrix for groups. As R's lm, genotype is treatment coded with its levels in sorted
+    order, so its coefficient is the effect of the second level ('wildtype')
+    """
+    columns = {'(Intercept)': np.ones(len(groups))}
+
+    levels = np.unique(groups['genotype'])
+    if len(levels) > 1:
+        columns['genotype'] = (groups['genotype'].values == levels[1]).astype(np.float64)
+
+    for name in groups.columns.drop('genotype'):
+        columns[name] = groups[name].values.astype(np.float64)
+
+    return columns
+
+
+def _design_matrix(groups: pd.DataFrame) -> Tuple[np.ndarray, List[str]]:
+    """
+    Make the design matrix, dropping predictors that are linearly dependent on earlier ones as R's pivoting does
+
+    Returns
+    -------
+    The design matrix and the names of its columns
+    """
+    x = []
+    names = []
+
+    for name, col in _predictors(groups).items():
+        candidate = np.column_stack(x + [col])
+        if np.linalg.matrix_rank(candidate, tol=RANK_TOLERANCE * np.abs(candidate).max()) == candidate.shape[1]:
+            x.append(col)
+            names.append(name)
+
+    return np.column_stack(x), names
+
+
+def _least_squares(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit every column of y to the full rank design matrix x
+
+    Returns
+    -------
+    The coefficients, the inverse of the R factor of x (R^-1 R^-T = (X'X)^-1), and the residual variance of each column
+    """
+    n, k = x.shape
+
+    # Factor the design matrix once. As lm, use QR rather than the normal equations
+    q, r = np.linalg.qr(x)
+    r_inv = linalg.solve_triangular(r, np.eye(k))
+    beta = r_inv @ (q.T @ y)
+
+    residuals = y - x @ beta
+    resvar = np.einsum('ij,ij->j', residuals, residuals) / (n - k)
+
+    return beta, r_inv, resvar
+
+
+def _fit_genotype(y: np.ndarray, groups: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit y ~ genotype (+ staging) for every column of y and get the p-value and t-statistic of the genotype effect.
+    The returned t-statistic is for the first genotype level ('mutant')
+    """
+    x, names = _design_matrix(groups)
+    df = x.shape[0] - x.shape[1]
+
+    if 'genotype' not in names or df < 1:
+        nan = np.full(y.shape[1], np.nan)
+        return nan, nan
+
+    g = names.index('genotype')
+    beta, r_inv, resvar = _least_squares(x, y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = beta[g] / np.sqrt((r_inv[g] @ r_inv[g]) * resvar)
+    p = 2 * stats.t.sf(np.abs(t), df)
+
+    # The coefficient is the effect of 'wildtype', so flip the sign to get it for mutant
+    return p, -t
+
+
+def _fit_specimens(y_wt: np.ndarray, wt_groups: pd.DataFrame, y_mut: np.ndarray, mut_groups: pd.DataFrame
+                   ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the genotype p-value and t-statistic of each mutant fitted with all the wild types, as lmFast.R does for each
+    mutant with lm(y[c(wt_rows, mutant_row), ] ~ genotype + staging).
+
+    Adding one mutant row and its own genotype coefficient to the wild type model is a rank-one update, and the
+    mutant is then fitted exactly. So every specimen-level model has the residuals and residual variance s^2 of the
+    wild type only fit, and the genotype effect is the mutant's prediction error, with
+        t = (y_m - x_m b_wt) / sqrt(s^2 (1 + x_m (X_wt'X_wt)^-1 x_m'))
+    on the same degrees of freedom. The wild type fit is done once, so the cost is O(voxels * specimens) rather than
+    O(mutants * voxels * specimens)
+
+    Returns
+    -------
+    (mutants, columns of y) arrays of p-values and t-statistics for the mutant genotype
+    """
+    num_mut = len(mut_groups)
+
+    # The model without the genotype term, as staging is aliased in the specimen-level model if it is in this one
+    x, names = _design_matrix(wt_groups) if len(wt_groups) else (np.empty((0, 1)), ['(Intercept)'])
+    df = x.shape[0] - x.shape[1]
+
+    if df < 1:
+        nan = np.full((num_mut, y_wt.shape[1]), np.nan)
+        return nan, nan
+
+    beta, r_inv, resvar = _least_squares(x, y_wt)
+
+    mut_predictors = _predictors(mut_groups)
+    x_mut = np.column_stack([mut_predictors[name] for name in names])
+
+    return _prediction_error(x_mut, y_mut, beta, r_inv @ r_inv.T, resvar, df)
+
+
+def _prediction_error(x_mut: np.ndarray, y_mut: np.ndarray, beta: np.ndarray, xtx_inv: np.ndarray,
+                      resvar: np.ndarray, df: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The p-values and t-statistics of each mutant's prediction error from the wild type model (see _fit_specimens)
+    """
+    # The mutants' leverage in the wild type model: x_m (X'X)^-1 x_m'
+    leverage = np.einsum('ij,jk,ik->i', x_mut, xtx_inv, x_mut)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (y_mut - x_mut @ beta) / np.sqrt((1 + leverage)[:, None] * resvar[None, :])
+    p = 2 * stats.t.sf(np.abs(t), df)
+
+    return p, t
+
+
+def lm_baseline(baseline, data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bool = False,
+                use_staging: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    lm_numpy for mutant data, with the wild types given by their stored sufficient statistics rather than their data.
+
+    The line-level model's X'X, X'Y and Y'Y are the wild type ones plus those of the mutants, so the wild type data
+    is not needed. The specimen-level fits only need the wild type model, as in _fit_specimens.
+
+    Parameters
+    ----------
+    baseline
+        baseline_store.BaselineStatistics for the same data points as data
+    data
+        columns: data points
+        rows: mutants
+    info
+        As lm_r. Only the mutant rows are used
+    Other parameters and returns as lm_numpy
+    """
+    if boxcox:
+        raise NotImplementedError('boxcox is not implemented in lmFast.R either')
+
+    y_mut = np.abs(np.asarray(data, dtype=np.float64))
+
+    predictors = ['genotype', 'staging'] if use_staging else ['genotype']
+    mut_groups = info.loc[info['genotype'] == 'mutant', predictors]
+    wt_groups = baseline.info()[predictors]
+
+    if len(mut_groups) != len(y_mut):
+        raise ValueError('There should be a row of data for each mutant in info')
+
+    # Line level
+    groups = pd.concat([wt_groups, mut_groups])
+    x, names = _design_matrix(groups)
+    df = x.shape[0] - x.shape[1]
+
+    if 'genotype' not in names or df < 1:
+        p_line = t_line = np.full(y_mut.shape[1], np.nan)
+    else:
+        x_mut = x[len(wt_groups):]
+        xty = baseline.xty[[_BASELINE_ROWS[name] for name in names]] + x_mut.T @ y_mut
+        yty = baseline.yty + np.einsum('ij,ij->j', y_mut, y_mut)
+        beta, xtx_inv, resvar = _solve_normal_equations(x.T @ x, xty, yty, df)
+
+        g = names.index('genotype')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_line = -beta[g] / np.sqrt(xtx_inv[g, g] * resvar)  # For mutant, as _fit_genotype
+        p_line = 2 * stats.t.sf(np.abs(t_line), df)
+
+    # Specimen level
+    x_wt, names = _design_matrix(wt_groups)
+    df = x_wt.shape[0] - x_wt.shape[1]
+
+    if df < 1:
+        p_spec = t_spec = np.full(y_mut.shape, np.nan)
+    else:
+        xty = baseline.xty[[_BASELINE_ROWS[name] for name in names]]
+        beta, xtx_inv, resvar = _solve_normal_equations(x_wt.T @ x_wt, xty, baseline.yty, df)
+
+        mut_predictors = _predictors(mut_groups)
+        x_mut = np.column_stack([mut_predictors[name] for name in names])
+        p_spec, t_spec = _prediction_error(x_mut, y_mut, beta, xtx_inv, resvar, df)
+
+    p_all = np.concatenate([p_line, p_spec.ravel()])
+    t_all = np.concatenate([t_line, t_spec.ravel()])
+
+    return p_all.astype(np.float32), t_all.astype(np.float32)
+
+
+def _solve_normal_equations(xtx: np.ndarray, xty: np.ndarray, yty: np.ndarray, df: int
+                            ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit from the cross products rather than the data
+
+    Returns
+    -------
+    The coefficients, (X'X)^-1 and the residual variance of each column
+    """
+    xtx_inv = np.linalg.inv(xtx)
+    beta = xtx_inv @ xty
+
+    # RSS = Y'Y - b'X'Y. Clip the rounding error of near perfect fits
+    rss = np.maximum(yty - np.einsum('ij,ij->j', beta, xty), 0)
+
+    return beta, xtx_inv, rss / df
+
+
 def _numpy_to_dat(mat: np.ndarray, outfile: str):
     """
-    Convert a numpy array to a binary file for reading in by R
+    Convert a numpy array to a binary file for reading in by R: the dimensions as two integers followed by the data
+    as column-major float64
 
     Parameters
     ----------
@@ -126,17 +389,12 @@ def _numpy_to_dat(mat: np.ndarray, outfile: str):
 
 
     """
-    # mat = mat.as_matrix()
-    # create a binary file
     with open(outfile, 'wb') as binfile:
-    # and write out two integers with the row and column dimension
-
+        # write out two integers with the row and column dimension
         header = struct.pack('2I', mat.shape[0], mat.shape[1])
         binfile.write(header)
-        # then loop over columns and write each
-        for i in range(mat.shape[1]):
-            data = struct.pack('%id' % mat.shape[0], *mat[:, i])
-            binfile.write(data)
+        # then all the columns in one go. The transpose of a C-ordered array is column-major
+        np.ascontiguousarray(np.asarray(mat, dtype=np.float64).T).tofile(binfile)
 
 
 def lm_sm(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=False, use_staging: bool=True):
@@ -181,3 +439,10 @@ def lm_sm(data: np.ndarray, info: pd.DataFrame, plot_dir:Path=None, boxcox:bool=
     t_all = np.negative(np.array(tvals))  # The tvaue for genotype[T.mut] is what we want
 
     return p_all, t_all
+
+
+# The stats_runner options in the stats config
+STATS_RUNNERS = {
+    'R': lm_r,
+    'numpy': lm_numpy
+}
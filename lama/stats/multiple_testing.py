@@ -0,0 +1,80 @@
+"""
+False discovery rate correction, in-process and vectorised, replacing the Rscript call to p.adjust (r_padjust.R).
+
+p_adjust works along the last axis, so all the specimens of a line can be corrected in one call on a
+(specimens, data points) array.
+
+Methods
+-------
+BH
+    Benjamini-Hochberg, as R's p.adjust(p, method='BH')
+BY
+    Benjamini-Yekutieli, as R's p.adjust(p, method='BY'). Valid under any dependence between the tests
+storey
+    Storey's q-values: BH scaled by the estimated proportion of true nulls pi0 = #(p >= lambda) / (m (1 - lambda)),
+    as the qvalue package's qvalue(p, lambda=lambda_)
+"""
+
+import numpy as np
+
+FDR_METHODS = ['BH', 'BY', 'storey']
+
+# The lambda used to estimate pi0 for the storey method
+DEFAULT_STOREY_LAMBDA = 0.5
+
+
+def p_adjust(pvals: np.ndarray, method: str = 'BH', axis: int = -1,
+             lambda_: float = DEFAULT_STOREY_LAMBDA) -> np.ndarray:
+    """
+    Correct p-values for multiple testing
+
+    Parameters
+    ----------
+    pvals
+        The p-values. Each 1D slice along axis is corrected separately
+    method
+        One of FDR_METHODS
+    axis
+        The axis along which the tests are
+    lambda_
+        The pi0 estimation threshold for the storey method
+
+    Returns
+    -------
+    float64 q-values of the same shape as pvals. NaN p-values are left as NaN and not counted as tests, as R does
+    """
+    if method not in FDR_METHODS:
+        raise ValueError(f'{method} is not a valid FDR method. Must be one of {FDR_METHODS}')
+
+    p = np.moveaxis(np.asarray(pvals, dtype=np.float64), axis, -1)
+
+    order = np.argsort(p, axis=-1)  # NaNs are sorted last
+    p_sorted = np.take_along_axis(p, order, axis=-1)
+
+    nan = np.isnan(p_sorted)
+    num_tests = np.sum(~nan, axis=-1, keepdims=True)
+    rank = np.arange(1, p.shape[-1] + 1)
+
+    q = p_sorted * num_tests / rank
+
+    if method == 'BY':
+        # q *= sum(1 / i) for i up to the number of tests. Index 0 is for slices with no tests
+        harmonic = np.concatenate([[1.0], np.cumsum(1 / rank)])
+        q *= harmonic[num_tests]
+
+    # q(i) = min over j >= i of q(j). NaNs are at the end, and must not take part in the minimum
+    q[nan] = np.inf
+    q = np.minimum.accumulate(q[..., ::-1], axis=-1)[..., ::-1]
+    q = np.minimum(q, 1)
+
+    if method == 'storey':
+        with np.errstate(invalid='ignore'):
+            pi0 = np.sum(p_sorted >= lambda_, axis=-1, keepdims=True) / (num_tests * (1 - lambda_))
+        q *= np.minimum(pi0, 1)
+
+    q[nan] = np.nan
+
+    result = np.empty_like(q)
+    np.put_along_axis(result, order, q, axis=-1)
+
+    return np.moveaxis(result, -1, axis)
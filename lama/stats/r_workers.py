@@ -0,0 +1,215 @@
+"""
+A pool of long-lived Rscript processes that run the LAMA R scripts, rather than starting R for every call.
+
+Each worker runs rscripts/r_worker.R and takes jobs (a script and its command line arguments) over stdin. When a
+job is done the worker writes a DONE or ERROR line to stdout. The scripts are unchanged and still exchange data
+through files. These are put in EXCHANGE_DIR, the system temporary directory unless changed with set_exchange_dir.
+A tmpfs such as /dev/shm saves the disk I/O, but must be big enough for a chunk of data (specimens * points * 8 bytes).
+
+Workers are started on first use, up to the number set with set_num_workers, and are shut down at exit. With 0
+workers, each call starts its own Rscript process as before.
+
+Examples
+--------
+    r_workers.set_num_workers(2)
+    r_workers.set_exchange_dir('/dev/shm')
+    r_workers.run_rscript(LM_SCRIPT, [data_file, groups_file, ...])  # Raises subprocess.CalledProcessError on failure
+"""
+
+import atexit
+import os
+import queue
+import subprocess as sub
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Union
+
+from logzero import logger as logging
+
+from lama import common
+
+R_WORKER_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'r_worker.R')
+
+DONE = 'LAMA_R_WORKER_DONE'
+ERROR = 'LAMA_R_WORKER_ERROR'
+
+# Where to put the files exchanged with R. See set_exchange_dir
+EXCHANGE_DIR = tempfile.gettempdir()
+
+DEFAULT_NUM_WORKERS = 1
+
+
+class RWorker:
+    """
+    A single Rscript process running r_worker.R
+    """
+    def __init__(self):
+        self.process = sub.Popen(['Rscript', R_WORKER_SCRIPT], stdin=sub.PIPE, stdout=sub.PIPE,
+                                 universal_newlines=True, bufsize=1)
+
+    def run(self, script: str, args: List[str]) -> str:
+        """
+        Run script with args and wait for it to finish
+
+        Returns
+        -------
+        Whatever the script printed
+
+        Raises
+        ------
+        subprocess.CalledProcessError if the script failed or R exited
+        """
+        cmd = [str(script)] + [str(x) for x in args]
+
+        if any('\t' in x or '\n' in x for x in cmd):
+            raise ValueError(f'R worker arguments cannot contain tabs or newlines: {cmd}')
+
+        self.process.stdin.write('\t'.join(cmd) + '\n')
+        self.process.stdin.flush()
+
+        output = []
+
+        for line in self.process.stdout:
+            line = line.rstrip('\n')
+
+            if line == DONE:
+                return '\n'.join(output)
+
+            if line.startswith(ERROR):
+                raise sub.CalledProcessError(1, ['Rscript'] + cmd, output='\n'.join(output),
+                                             stderr=line[len(ERROR):].strip())
+            output.append(line)
+
+        # stdout closed before the job finished
+        raise sub.CalledProcessError(self.process.wait(), ['Rscript'] + cmd, output='\n'.join(output))
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive:
+            try:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (OSError, sub.TimeoutExpired):
+                self.process.kill()
+
+
+class RWorkerPool:
+    """
+    Up to num_workers RWorkers, each running one job at a time. Safe to use from multiple threads
+    """
+    def __init__(self, num_workers: int = DEFAULT_NUM_WORKERS):
+        self.num_workers = num_workers
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _get_worker(self) -> RWorker:
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            with self._lock:
+                if len(self._workers) < self.num_workers:
+                    worker = RWorker()
+                    self._workers.append(worker)
+                    logging.info(f'Started R worker {len(self._workers)}/{self.num_workers}')
+                    return worker
+
+            # Wait for a worker to be free. Check again periodically in case one exits and can be replaced
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def run(self, script: str, args: List[str]) -> str:
+        """
+        Run a job on the next free worker. See RWorker.run
+        """
+        worker = self._get_worker()
+
+        try:
+            return worker.run(script, args)
+        finally:
+            if worker.alive:
+                self._idle.put(worker)
+            else:
+                # Let a new worker be started in its place
+                logging.warning('An R worker exited')
+                with self._lock:
+                    self._workers.remove(worker)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers = []
+            self._idle = queue.Queue()
+
+
+_pool = RWorkerPool()
+atexit.register(lambda: _pool.close())
+
+
+def set_num_workers(num_workers: int):
+    """
+    Set the number of R workers. 0 to start a new Rscript process for each call
+    """
+    global _pool
+
+    if num_workers != _pool.num_workers:
+        _pool.close()
+        _pool = RWorkerPool(num_workers)
+
+
+def num_workers() -> int:
+    return _pool.num_workers
+
+
+def set_exchange_dir(exchange_dir: Union[str, Path] = None):
+    """
+    Set the directory the files exchanged with R are written to. None for the system temporary directory
+    """
+    global EXCHANGE_DIR
+
+    if exchange_dir is None:
+        EXCHANGE_DIR = tempfile.gettempdir()
+    elif not os.access(exchange_dir, os.W_OK):
+        raise OSError(f'Cannot write R exchange files to {exchange_dir}')
+    else:
+        EXCHANGE_DIR = str(exchange_dir)
+
+
+def remove_exchange_files(*paths: str):
+    """
+    Remove the files exchanged with an R script, ignoring any that were not written
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def run_rscript(script: Union[str, Path], args: List[str]) -> str:
+    """
+    Run an R script on a worker, or in its own Rscript process if there are no workers
+
+    Returns
+    -------
+    Whatever the script printed
+
+    Raises
+    ------
+    subprocess.CalledProcessError if the script failed
+    """
+    if _pool.num_workers < 1:
+        return sub.check_output(['Rscript', str(script)] + [str(x) for x in args], universal_newlines=True)
+
+    return _pool.run(str(script), args)
@@ -0,0 +1,184 @@
+"""
+Persist the wild type (baseline) sufficient statistics of the voxel-wise linear models.
+
+lmFast.R and linear_model.lm_numpy fit |y| ~ genotype (+ staging) to every voxel. The wild type contribution to those
+fits is fully described by, for each voxel, X'Y and Y'Y of the wild types, plus the wild type design matrix (which
+only depends on their staging). Once these have been computed, new lines and specimens can be analysed by adding
+the mutants' own contributions (see linear_model.lm_baseline) without reloading, blurring or normalising the
+baseline images.
+
+A store file is made for each combination of stats type, baseline ids and staging, mask, blur FWHM, voxel size and
+normalisation. Any change to these gives a new key, so the statistics are recomputed and stored next to the old
+ones. The baseline images themselves are not hashed: if baselines are re-registered under the same ids, delete the
+store directory.
+
+Examples
+--------
+    key = store_key(stats_type='jacobians', staging=wt_staging, mask=mask, blur_fwhm=100, voxel_size=14)
+    baseline = load(store_dir / store_file_name('jacobians', key), key)
+    if baseline is None:
+        baseline = BaselineStatistics.from_data(wt_data, wt_staging)
+        baseline.save(store_dir / store_file_name('jacobians', key), key)
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+from logzero import logger as logging
+
+from lama.utilities.config_checksum import md5
+
+# Increment if the contents of the store files change
+STORE_VERSION = 1
+
+
+class BaselineStatistics:
+    """
+    The per-voxel sufficient statistics of the wild type absolute values
+
+    Attributes
+    ----------
+    ids
+        The baseline specimen ids
+    staging
+        The staging value of each baseline
+    xty
+        (2, data points): the sum of |y| and the sum of staging * |y| over the baselines. These are the rows of X'Y
+        for the intercept and staging columns of the wild type design matrix
+    yty
+        (data points): the sum of y^2 over the baselines
+    reference
+        The normaliser reference (eg. the mean intensity of the baselines), or None
+    """
+    def __init__(self, ids: List[str], staging: np.ndarray, xty: np.ndarray, yty: np.ndarray,
+                 reference: Union[float, None] = None):
+        self.ids = [str(x) for x in ids]
+        self.staging = np.asarray(staging, dtype=np.float64)
+        self.xty = xty
+        self.yty = yty
+        self.reference = reference
+
+    @classmethod
+    def from_data(cls, data: List[np.ndarray], staging: pd.DataFrame, reference: Union[float, None] = None):
+        """
+        Accumulate the statistics one baseline at a time, so the baselines don't need stacking into one array
+
+        Parameters
+        ----------
+        data
+            The masked 1D data of each baseline
+        staging
+            Indexed by baseline id, in the same order as data, with a staging column
+        reference
+            See BaselineStatistics
+        """
+        if len(data) != len(staging):
+            raise ValueError('There must be a staging value for each baseline')
+
+        xty = np.zeros((2, len(data[0])))
+        yty = np.zeros(len(data[0]))
+
+        for y, s in zip(data, staging['staging'].values):
+            y = np.abs(np.asarray(y, dtype=np.float64))
+            xty[0] += y
+            xty[1] += s * y
+            yty += y * y
+
+        return cls(list(staging.index), staging['staging'].values, xty, yty, reference)
+
+    @property
+    def n(self) -> int:
+        return len(self.ids)
+
+    def info(self) -> pd.DataFrame:
+        """
+        The baselines' rows of LineData.info
+        """
+        return pd.DataFrame({'staging': self.staging, 'genotype': 'wildtype'}, index=self.ids)
+
+    def chunk(self, start: int, end: int):
+        """
+        The statistics of data points start to end, matching a chunk from LineData.chunks. Arrays are views
+        """
+        return BaselineStatistics(self.ids, self.staging, self.xty[:, start: end], self.yty[start: end],
+                                  self.reference)
+
+    def save(self, path: Path, key: str):
+        """
+        Write the statistics to an npz file. The file is written to a temporary name first so an interrupted run
+        doesn't leave a truncated store behind
+        """
+        tmp_path = path.with_name(f'{path.name}.tmp')
+
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, key=key, version=STORE_VERSION, ids=np.array(self.ids), staging=self.staging,
+                     xty=self.xty, yty=self.yty,
+                     reference=np.nan if self.reference is None else self.reference)
+
+        os.replace(tmp_path, path)
+        logging.info(f'Baseline statistics of {self.n} specimens saved to {path}')
+
+
+def load(path: Path, key: str) -> Union[BaselineStatistics, None]:
+    """
+    Load stored baseline statistics
+
+    Returns
+    -------
+    None if there is no store file or it was made for different inputs
+    """
+    if not path.is_file():
+        return None
+
+    with np.load(path) as npz:
+        if str(npz['key']) != key or int(npz['version']) != STORE_VERSION:
+            logging.warning(f'Baseline store {path} does not match the current inputs. It will be recomputed')
+            return None
+
+        reference = float(npz['reference'])
+
+        baseline = BaselineStatistics(list(npz['ids']), npz['staging'], npz['xty'], npz['yty'],
+                                      None if np.isnan(reference) else reference)
+
+    logging.info(f'Baseline statistics of {baseline.n} specimens loaded from {path}')
+    return baseline
+
+
+def store_key(stats_type: str, staging: pd.DataFrame, mask: np.ndarray, blur_fwhm: float, voxel_size: float,
+              **extra) -> str:
+    """
+    Make a key from everything that determines the stored statistics
+
+    Parameters
+    ----------
+    stats_type
+        jacobians, intensity etc
+    staging
+        Indexed by baseline id, in the order their data is read, with a staging column
+    mask
+        The 3D mask
+    blur_fwhm, voxel_size
+        The blurring applied to each baseline
+    extra
+        Any other options that change the data (eg. data folder, normalisation)
+    """
+    mask = np.ascontiguousarray(mask != 0)
+
+    data = {
+        'stats_type': stats_type,
+        'ids': [str(x) for x in staging.index],
+        'staging': [float(x) for x in staging['staging']],
+        'mask': [hashlib.md5(mask.tobytes()).hexdigest(), list(mask.shape)],
+        'blur_fwhm': float(blur_fwhm),
+        'voxel_size': float(voxel_size),
+        'extra': extra
+    }
+    return md5(data)
+
+
+def store_file_name(stats_type: str, key: str) -> str:
+    return f'{stats_type}_baseline_{key}.npz'
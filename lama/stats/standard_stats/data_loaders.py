@@ -33,6 +33,8 @@ import toml
 from lama import common
 from lama.img_processing.misc import blur
 from lama.paths import specimen_iterator
+from lama.stats.standard_stats import baseline_store
+from lama.stats.standard_stats.baseline_store import BaselineStatistics
 
 import os
 import gc
@@ -58,7 +60,8 @@ class LineData:
                  mask: np.ndarray = None,
                  outdirs = None,
                  cluster_data = None,
-                 normalise: Callable = None):
+                 normalise: Callable = None,
+                 baseline: BaselineStatistics = None):
         """
         Holds the input data to be used in the stats tests
         Parameters
@@ -84,6 +87,9 @@ class LineData:
             The input paths used to generate the data
             [0] Wildtype
             [1] mutants
+        baseline
+            If not None, stored statistics of the wild types. data then only has the mutant rows, although info
+            still has all the specimens
 
         """
         self.data = data
@@ -94,10 +100,13 @@ class LineData:
         self.outdirs = None
         self.size = np.prod(shape)
         self.mask = mask
+        self.baseline = baseline
 
         logging.info(f"Create line data '{self.line}'")
 
-        if len(data) != len(info):
+        num_baseline_rows = baseline.n if baseline else 0
+
+        if len(data) + num_baseline_rows != len(info):
             raise ValueError
 
     def mutant_ids(self):
@@ -211,6 +220,9 @@ class LineData:
         
         if self.mask is not None: 
             self.mask = None
+
+        if self.baseline is not None:
+            self.baseline = None
         
         gc.collect()
         
@@ -279,6 +291,9 @@ class DataLoader:
 
         self.normaliser = None
 
+        # Directory of wild type statistics (see baseline_store). None to always use the baseline data
+        self.baseline_store = None
+
         self.blur_fwhm = config.get('blur', DEFAULT_FWHM)
         self.voxel_size = config.get('voxel_size', DEFAULT_VOXEL_SIZE)
         self.memmap = memmap
@@ -390,19 +405,40 @@ class DataLoader:
         if self.baseline_ids:
             wt_paths, wt_staging = self.filter_specimens(self.baseline_ids, wt_paths, wt_staging)
 
-        logging.info('loading baseline data')
-        wt_vols = self._read(wt_paths)
+        baseline = None
 
-        if self.normaliser:
-            self.normaliser.add_reference(wt_vols)
+        if self.baseline_store:
+            store_file, store_key = self._baseline_store_file(wt_staging)
+            baseline = baseline_store.load(store_file, store_key)
 
-            # ->temp bodge to get mask in there
-            self.normaliser.mask = self.mask
-            # <-bodge
-            self.normaliser.normalise(wt_vols)
+        if baseline:
+            # The wild type data is not needed, only the normaliser reference to apply to the mutants
+            if self.normaliser:
+                self.normaliser.reference_mean = baseline.reference
+                self.normaliser.mask = self.mask
 
-        # Make a 2D array of the WT data
-        masked_wt_data = [x.ravel() for x in wt_vols]
+            masked_wt_data = []
+        else:
+            logging.info('loading baseline data')
+            wt_vols = self._read(wt_paths)
+
+            if self.normaliser:
+                self.normaliser.add_reference(wt_vols)
+
+                # ->temp bodge to get mask in there
+                self.normaliser.mask = self.mask
+                # <-bodge
+                self.normaliser.normalise(wt_vols)
+
+            # Make a 2D array of the WT data
+            masked_wt_data = [x.ravel() for x in wt_vols]
+
+            if self.baseline_store:
+                # Store the statistics for the next run. The lines are then analysed from them here too
+                baseline = BaselineStatistics.from_data(masked_wt_data, wt_staging,
+                                                        getattr(self.normaliser, 'reference_mean', None))
+                baseline.save(store_file, store_key)
+                masked_wt_data = []
 
         mut_metadata = self._get_metadata(self.mut_dir, self.lines_to_process)
 
@@ -444,9 +480,18 @@ class DataLoader:
 
             # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
 
-            input_ = LineData(data, staging, line, self.shape, (wt_paths, mut_paths), self.mask)
+            input_ = LineData(data, staging, line, self.shape, (wt_paths, mut_paths), self.mask, baseline=baseline)
             yield input_
 
+    def _baseline_store_file(self, wt_staging: pd.DataFrame) -> Tuple[Path, str]:
+        """
+        Get the store file and key for the baselines with the current settings
+        """
+        key = baseline_store.store_key(self.datatype, wt_staging, self.mask, self.blur_fwhm, self.voxel_size,
+                                       data_folder=[self.data_folder_name, self.data_sub_folder],
+                                       normalise=self.config.get('normalise'))
+        return self.baseline_store / baseline_store.store_file_name(self.datatype, key), key
+
 
 class VoxelDataLoader(DataLoader):
     """
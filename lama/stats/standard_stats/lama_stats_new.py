@@ -19,11 +19,11 @@ import logzero
 import gc
 
 from lama.common import cfg_load
-from lama.stats.standard_stats.stats_objects import Stats, OrganVolume
+from lama.stats.standard_stats.stats_objects import Stats, OrganVolume, FDR_RUNNERS
 from lama.stats.standard_stats.data_loaders import DataLoader, load_mask, LineData, JacobianDataLoader
 from lama.stats.standard_stats.results_writer import ResultsWriter
 from lama import common
-from lama.stats import linear_model
+from lama.stats import linear_model, r_workers
 from lama.elastix import PROPAGATE_CONFIG
 from lama.elastix.propagate_volumes import PropagateHeatmap
 from lama.img_processing.normalise import Normaliser
@@ -85,6 +85,11 @@ def run(config_path: Path,
     label_map_file = target_dir / stats_config.get('label_map')
     label_map = common.LoadImage(label_map_file).array
 
+    # Long-lived R processes for the R stats_runner and fdr_runner
+    r_workers.set_num_workers(stats_config.get('r_workers', r_workers.DEFAULT_NUM_WORKERS))
+    r_exchange_dir = stats_config.get('r_exchange_dir')
+    r_workers.set_exchange_dir(config_path.parent / r_exchange_dir if r_exchange_dir else None)
+
     memmap = stats_config.get('memmap')
     if memmap:
         logging.info('Memory mapping input data')
@@ -97,6 +102,12 @@ def run(config_path: Path,
     if mutant_file:
         mutant_file = config_path.parent / mutant_file
 
+    store_dir = stats_config.get('baseline_store')
+    if store_dir:
+        store_dir = config_path.parent / store_dir
+        store_dir.mkdir(parents=True, exist_ok=True)
+        logging.info(f'Using baseline statistics store {store_dir}')
+
     # Run each data class through the pipeline.
     for stats_type in stats_config['stats_types']:
 
@@ -111,6 +122,10 @@ def run(config_path: Path,
         loader = loader_class(wt_dir, mut_dir, mask, stats_config, label_info_file, lines_to_process=lines_to_process,
                               baseline_file=baseline_file, mutant_file=mutant_file, memmap=memmap)
 
+        # Organ volumes are few enough to always fit from the data
+        if stats_type != 'organ_volumes':
+            loader.baseline_store = store_dir
+
         # Only affects organ vol loader.
         if not stats_config.get('normalise_organ_vol_to_mask'):
             loader.norm_to_mask_volume_on = False
@@ -148,7 +163,9 @@ def run(config_path: Path,
                 stats_class = Stats.factory(stats_type)
                 stats_obj = stats_class(line_input_data, stats_type, stats_config.get('use_staging', True))
       
-                stats_obj.stats_runner = linear_model.lm_r
+                stats_obj.stats_runner = linear_model.STATS_RUNNERS[stats_config.get('stats_runner', 'R')]
+                stats_obj.fdr_method = stats_config.get('fdr_method', 'BH')
+                stats_obj.fdr_runner = FDR_RUNNERS[stats_config.get('fdr_runner', 'numpy')]
                 stats_obj.run_stats()
       
                 logging.info('Statistical analysis finished.')
@@ -176,7 +193,8 @@ def run(config_path: Path,
                         logging.info('Propogating the heatmaps back onto the input images ')
                         line_heatmap = writer.line_heatmap
                         line_reg_dir = mut_dir / 'output' / line_id
-                        invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data)
+                        invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data,
+                                        stats_config.get('propagation_backend', 'transformix'))
                         logging.info('Finished writing heatmaps.')
  
                 logging.info(f"Finished processing line: {line_id} - All done")                  
@@ -193,7 +211,8 @@ def run(config_path: Path,
 def invert_heatmaps(heatmap: Path,
                     stats_outdir: Path,
                     reg_outdir: Path,
-                    input_: LineData):
+                    input_: LineData,
+                    backend: str = 'transformix'):
     """
     Invert the stats heatmaps from a single line back onto inputs or registered volumes
 
@@ -205,6 +224,8 @@ def invert_heatmaps(heatmap: Path,
         Has paths for data locations
     outdir
         Where to put the inverted heatmaps
+    backend
+        'transformix' or 'sitk'. See propagate_volumes.Propagate
 
     Returns
     -------
@@ -218,5 +239,5 @@ def invert_heatmaps(heatmap: Path,
         # Should not have to specify the path to the inv config again
         invert_config = reg_outdir / str(spec_id) / 'output' / 'inverted_transforms' / PROPAGATE_CONFIG
 
-        inv = PropagateHeatmap(invert_config, heatmap, inverted_heatmap_dir)
+        inv = PropagateHeatmap(invert_config, heatmap, inverted_heatmap_dir, backend=backend)
         inv.run()
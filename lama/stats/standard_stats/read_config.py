@@ -9,6 +9,8 @@ import numbers
 from pathlib import Path
 from addict import Dict
 
+from lama.stats import multiple_testing
+
 
 def validate(config: Dict):
     """
@@ -94,6 +96,32 @@ def validate(config: Dict):
             'required': False,
             'validate': [bool_]
         },
+        'propagation_backend': {
+            'required': False,
+            'validate': [options, ['transformix', 'sitk']]
+        },
+        'stats_runner': {
+            'required': False,
+            'validate': [options, ['R', 'numpy']]  # numpy: fit the linear models without calling R
+        },
+        'fdr_method': {
+            'required': False,
+            'validate': [options, multiple_testing.FDR_METHODS]
+        },
+        'fdr_runner': {
+            'required': False,
+            'validate': [options, ['numpy', 'R']]  # R: p.adjust, for BH only
+        },
+        'r_workers': {
+            'required': False,
+            'validate': [num, 0]  # Number of long-lived R processes. 0 to start R for each call
+        },
+        'r_exchange_dir': {
+            'required': False,
+            # Directory for the data files passed to and from R. Defaults to the system temporary directory. A tmpfs
+            # such as /dev/shm avoids disk I/O but must fit a chunk of data (specimens * points * 8 bytes)
+            'validate': [lambda x: isinstance(x, str)]
+        },
         'normalise': {
             'required': False
         },
@@ -105,6 +133,12 @@ def validate(config: Dict):
             'required': False,
             'validate': [path]
         },
+        'baseline_store': {
+            'required': False,
+            # Directory to keep the baseline statistics in between runs. The linear models are then fitted from the
+            # stored statistics in-process, so stats_runner must be numpy
+            'validate': [lambda x: isinstance(x, str)]
+        },
         'mutant_ids': {
             'required': False,
             'validate': [path]
@@ -136,3 +170,6 @@ def validate(config: Dict):
                 v[0](data)
             else:
                 v[0](data, v[1])
+
+    if config.get('baseline_store') and config.get('stats_runner', 'R') != 'numpy':
+        raise ValueError('baseline_store fits the linear models without R. Set stats_runner: numpy to use it')
@@ -8,9 +8,9 @@ I thought that each data type might need it's own subclass, however the differen
 """
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import subprocess as sub
 import tempfile
-import os
 from pathlib import Path
 
 import numpy as np
@@ -20,6 +20,7 @@ import pandas as pd
 
 
 from lama import common
+from lama.stats import linear_model, multiple_testing, r_workers
 from lama.stats.standard_stats.data_loaders import LineData
 
 RSCRIPT_FDR = common.lama_root_dir / 'stats' / 'rscripts' / 'r_padjust.R'
@@ -48,6 +49,8 @@ class Stats:
         self.stats_type_ = stats_type
         self.stats_runner = None
         self.use_staging = use_staging
+        self.fdr_method = 'BH'  # See multiple_testing.FDR_METHODS
+        self.fdr_runner = fdr
 
         # The final results will be stored in these attributes
         self.line_qvals = None
@@ -81,6 +84,12 @@ class Stats:
 
         info = self.input_.info
 
+        # Stored wild type statistics, in which case the data chunks only have the mutants
+        baseline = self.input_.baseline
+        if baseline:
+            logging.info(f'Using stored statistics for the {baseline.n} baselines')
+        chunk_start = 0
+
         num_chunks = self.input_.get_num_chunks(log=True)
 
         for i, data_chunk in enumerate(self.input_.chunks()):
@@ -90,7 +99,13 @@ class Stats:
 
             current_chunk_size = data_chunk.shape[1]  # Final chunk may not be same size
 
-            p_all, t_all = self.stats_runner(data_chunk, info, use_staging=self.use_staging)
+            if baseline:
+                p_all, t_all = linear_model.lm_baseline(baseline.chunk(chunk_start, chunk_start + current_chunk_size),
+                                                        data_chunk, info, use_staging=self.use_staging)
+            else:
+                p_all, t_all = self.stats_runner(data_chunk, info, use_staging=self.use_staging)
+
+            chunk_start += current_chunk_size
 
             # Convert all NANs in the pvalues to 1.0. Need to check that this is appropriate
             p_all[np.isnan(p_all)] = 1.0
@@ -122,17 +137,20 @@ class Stats:
 
         self.line_pvalues = line_pvals_array
 
-        self.line_qvals = fdr(line_pvals_array)
+        self.line_qvals = self.fdr_runner(line_pvals_array, self.fdr_method)
 
         self.line_tstats = line_tvals_array
 
-        # Join up the results chunks for the specimen-level analysis. Do FDR correction on the pvalues
+        # Join up the results chunks for the specimen-level analysis. Do FDR correction on the pvalues of all the
+        # specimens at once
         self.specimen_results = addict.Dict()
 
+        spec_ids = list(specimen_pvals.keys())
+        spec_pvals_array = np.array([np.hstack(specimen_pvals[id_]) for id_ in spec_ids])
+        spec_qvals_array = self.fdr_runner(spec_pvals_array, self.fdr_method) if spec_ids else []
+
         try:
-            for id_, p in list(specimen_pvals.items()):
-                p = np.hstack(p)
-                q = fdr(p)
+            for id_, p, q in zip(spec_ids, spec_pvals_array, spec_qvals_array):
                 t = np.hstack(specimen_tstats[id_])
                 self.specimen_results[id_]['histogram'] = np.histogram(p, bins=100)[0]
                 self.specimen_results[id_]['q'] = q
@@ -157,46 +175,78 @@ class OrganVolume(Stats):
         super().__init__(*args)
 
 
-def fdr(pvals: np.ndarray) -> np.ndarray:
+def fdr(pvals: np.ndarray, method: str = 'BH') -> np.ndarray:
     """
-    Use R for FDR correction
+    FDR correction of a 1D array of p-values, or of each row of a 2D array
 
+    Parameters
     ----------
-    pvals: The p-values to be corrected
+    pvals
+        The p-values to be corrected
+    method
+        See multiple_testing.FDR_METHODS
 
     Returns
     -------
-    The corrected q-values
+    The float32 corrected q-values
     """
+    return multiple_testing.p_adjust(pvals, method).astype(np.float32)
 
-    qval_outfile = tempfile.NamedTemporaryFile().name
-    pval_file = tempfile.NamedTemporaryFile().name
 
-    try:
-        pvals.tofile(pval_file)
-    except IOError:
-        logging.error(f'Cannot save p-value file {pval_file}')
+def fdr_r(pvals: np.ndarray, method: str = 'BH') -> np.ndarray:
+    """
+    Use R's p.adjust (r_padjust.R) for BH FDR correction, on the R workers (see r_workers). fdr gives the same results
+    without R
+
+    Parameters
+    ----------
+    pvals
+        The p-values to be corrected. The rows of a 2D array are corrected separately, in parallel if there is more
+        than one R worker
+    method
+        Must be BH
+
+    Returns
+    -------
+    The float32 corrected q-values
+    """
+    if method != 'BH':
+        raise ValueError(f'Only BH FDR correction is done in R, not {method}')
+
+    if pvals.ndim == 2:
+        with ThreadPoolExecutor(max_workers=max(1, r_workers.num_workers())) as pool:
+            return np.array(list(pool.map(fdr_r, pvals)), dtype=np.float32).reshape(pvals.shape)
 
+    qval_outfile = tempfile.NamedTemporaryFile(dir=r_workers.EXCHANGE_DIR).name
+    pval_file = tempfile.NamedTemporaryFile(dir=r_workers.EXCHANGE_DIR).name
 
-    cmdFDR = ['Rscript',
-              str(RSCRIPT_FDR),
-              pval_file,
-              str(pvals.shape[0]),
-              qval_outfile
-              ]
+    args = [pval_file,
+            str(pvals.shape[0]),
+            qval_outfile
+            ]
 
     try:
-        sub.check_output(cmdFDR)
-    except sub.CalledProcessError as e:
-        logging.warn(f"R FDR calculation failed: {e}")
-        raise
+        try:
+            pvals.astype(np.float32).tofile(pval_file)  # r_padjust.R reads 4 byte floats
+        except IOError:
+            logging.error(f'Cannot save p-value file {pval_file}')
+
+        try:
+            r_workers.run_rscript(RSCRIPT_FDR, args)
+        except sub.CalledProcessError as e:
+            logging.warn(f"R FDR calculation failed: {e}")
+            raise
 
-    result = np.fromfile(qval_outfile, dtype=np.float64).astype(np.float32)
+        result = np.fromfile(qval_outfile, dtype=np.float64).astype(np.float32)
 
-    os.remove(qval_outfile)
-    os.remove(pval_file)
+    finally:
+        r_workers.remove_exchange_files(qval_outfile, pval_file)
 
     return result
 
 
-
+# The fdr_runner options in the stats config
+FDR_RUNNERS = {
+    'numpy': fdr,
+    'R': fdr_r
+}
@@ -0,0 +1,91 @@
+"""
+Test the population average engine against a numpy mean.
+Uses small synthetic volumes so does not need the test data.
+"""
+
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+from lama.img_processing import averaging
+
+
+@pytest.fixture
+def uint16_vols(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays, paths = [], []
+    for i in range(7):
+        # Values near the top of the range overflowed the old in-place uint16 sum
+        a = rng.integers(60000, 65535, (13, 9, 7), dtype=np.uint16)
+        img = sitk.GetImageFromArray(a)
+        img.SetSpacing((2.0, 2.0, 2.0))
+        img.SetOrigin((1.0, 2.0, 3.0))
+        path = tmp_path / f'{i}.nrrd'
+        sitk.WriteImage(img, str(path), True)
+        arrays.append(a)
+        paths.append(path)
+    return paths, np.rint(np.mean(arrays, axis=0)).astype(np.uint16)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'accumulator_dtype': np.float32, 'read_ahead': 0}])
+def test_mean(uint16_vols, kwargs):
+    paths, expected = uint16_vols
+    avg = averaging.mean(paths, **kwargs)
+
+    assert avg.GetPixelID() == sitk.sitkUInt16
+    assert avg.GetSpacing() == (2.0, 2.0, 2.0)
+    assert avg.GetOrigin() == (1.0, 2.0, 3.0)
+    assert np.array_equal(sitk.GetArrayFromImage(avg), expected)
+
+
+def test_mean_size_mismatch(uint16_vols, tmp_path):
+    paths, _ = uint16_vols
+    odd = tmp_path / 'odd.nrrd'
+    sitk.WriteImage(sitk.Image(3, 3, 3, sitk.sitkUInt16), str(odd))
+
+    with pytest.raises(ValueError):
+        averaging.mean(paths + [odd])
+
+
+@pytest.mark.parametrize('method', averaging.ROBUST_METHODS)
+def test_robust_average(uint16_vols, method, tmp_path):
+    from scipy import stats
+    from scipy.stats import mstats
+
+    paths, _ = uint16_vols
+    arrays = np.array([sitk.GetArrayFromImage(sitk.ReadImage(str(p))) for p in paths]).astype(np.float64)
+
+    if method == 'median':
+        expected = np.median(arrays, axis=0)
+    elif method == 'trimmed_mean':
+        expected = stats.trim_mean(arrays, 0.2, axis=0)
+    else:
+        expected = mstats.winsorize(arrays, limits=(0.2, 0.2), axis=0).mean(axis=0)
+
+    # Tiny memory budget forces single-slice slabs
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    avg = averaging.robust_average(paths, method, trim=0.2, max_memory=1, scratch_dir=scratch_dir)
+    assert not any(scratch_dir.iterdir())
+
+    assert avg.GetPixelID() == sitk.sitkUInt16
+    assert np.array_equal(sitk.GetArrayFromImage(avg), np.rint(expected).astype(np.uint16))
+
+
+def test_mean_from_partial_sums(uint16_vols, tmp_path):
+    paths, expected = uint16_vols
+    spec_paths = {p.stem: p for p in paths}
+    partials_dir = tmp_path / averaging.PARTIAL_SUMS_DIR
+
+    # Two workers share most of the specimens. The last one is not in any partial sum so must be read at merge time
+    workers = [averaging.PartialSum(partials_dir / 'w1.npz'), averaging.PartialSum(partials_dir / 'w2.npz')]
+    for i, p in enumerate(paths[:-1]):
+        workers[i % 2].add(p, p.stem)
+
+    # Integer volumes are summed exactly, in less space than float64
+    assert averaging.PartialSum.load(partials_dir / 'w1.npz').sum.dtype == np.uint32
+
+    avg = averaging.mean_from_partial_sums(partials_dir, spec_paths)
+
+    assert avg.GetPixelID() == sitk.sitkUInt16
+    assert np.array_equal(sitk.GetArrayFromImage(avg), expected)
@@ -0,0 +1,82 @@
+"""
+Test B-spline unfolding against the original per-control-point implementation, on a realistic grid
+"""
+
+import numpy as np
+import pytest
+
+from lama.elastix import folding
+from lama.elastix.transform_parameters import TransformParameterFile
+
+# A 28um embryo volume of ~ 400 * 300 * 250 voxels with a final grid spacing of 8 voxels
+GRID_SIZE = (53, 41, 35)
+GRID_SPACING = (8.0, 8.0, 8.0)
+
+TP = '''(Transform "BSplineTransform")
+(NumberOfParameters {n})
+(TransformParameters 0)
+(InitialTransformParameterFileName "NoInitialTransform")
+(HowToCombineTransforms "Compose")
+(GridSize {grid_size})
+(GridIndex 0 0 0)
+(GridSpacing {grid_spacing})
+(GridOrigin 0 0 0)
+'''
+
+
+def _loop_condition_1(coefs):
+    return np.apply_along_axis(np.all, 1, np.abs(coefs) < 1 / folding.K3)
+
+
+def _loop_correct(coefs):
+    return [np.array(c) / np.linalg.norm(c) * (1 / folding.A3) for c in coefs]
+
+
+@pytest.fixture
+def coefs():
+    # Displacements of up to a few voxels, so a good number of control points need correcting
+    rng = np.random.default_rng(0)
+    return rng.normal(0, 2.0, (int(np.prod(GRID_SIZE)), 3))
+
+
+@pytest.fixture
+def tp_path(tmp_path, coefs):
+    path = tmp_path / 'TransformParameters.0.txt'
+    path.write_text(TP.format(n=coefs.size, grid_size=' '.join(map(str, GRID_SIZE)),
+                              grid_spacing=' '.join(map(str, GRID_SPACING))))
+    tp = TransformParameterFile.read(path)
+    tp.coefficients = coefs
+    tp.write()
+    return path
+
+
+def test_matches_loop_implementation(coefs):
+    scaled = coefs / GRID_SPACING
+    assert np.array_equal(folding.condition_1(scaled), _loop_condition_1(scaled))
+
+    bad = ~folding.is_injective(scaled)
+    assert 0 < bad.sum() < len(scaled)
+    assert np.allclose(folding.correct(scaled[bad]), _loop_correct(scaled[bad]))
+
+
+def test_iterative_unfolding(tp_path, tmp_path):
+    # Without iterating, rounding to the written precision leaves some points just outside the bound
+    single = tmp_path / 'single_pass.txt'
+    folding.unfold_bsplines(tp_path, single)
+    assert not np.all(folding.is_injective(TransformParameterFile.read(single).coefficients / GRID_SPACING))
+
+    out = tmp_path / 'unfolded.txt'
+    folding.unfold_bsplines(tp_path, out, iterative=True)
+
+    # Check the coefficients as written, at the precision they are written with
+    written = TransformParameterFile.read(out).coefficients / GRID_SPACING
+    assert np.all(folding.is_injective(written))
+
+    original = TransformParameterFile.read(tp_path).coefficients / GRID_SPACING
+    good = folding.is_injective(original)
+    assert np.allclose(written[good], original[good], atol=1e-6)
+
+
+def test_unfolding_full_grid(tp_path):
+    unfolded = folding.unfold_bsplines(tp_path, iterative=True)
+    assert np.all(folding.is_injective(unfolded / GRID_SPACING))
@@ -0,0 +1,106 @@
+"""
+Test numerical inversion of transforms
+"""
+
+import numpy as np
+import SimpleITK as sitk
+
+from lama.elastix import invert_fields, transform_engine
+from lama.elastix.transform_parameters import TransformParameterFile
+from lama.tests.test_transform_engine import _make_chain, SPACING, ORIGIN
+
+
+def _smooth_field(shape, amplitude):
+    """
+    A displacement field of up to amplitude, that is zero at the edges
+    """
+    nz, ny, nx = shape
+    z, y, x = np.mgrid[0:nz, 0:ny, 0:nx] / (np.array(shape)[:, None, None, None] - 1)
+    bump = np.sin(np.pi * x) * np.sin(np.pi * y) * np.sin(np.pi * z)
+    u = amplitude * np.stack([bump * np.sin(2 * np.pi * y),
+                              bump * np.sin(2 * np.pi * z),
+                              bump * np.sin(2 * np.pi * x)], axis=-1)
+    img = sitk.GetImageFromArray(u.astype(np.float32), isVector=True)
+    img.SetSpacing(SPACING)
+    img.SetOrigin(ORIGIN)
+    return img
+
+
+def test_invert_displacement_field():
+    field = _smooth_field((24, 28, 32), amplitude=4.0)
+
+    # Small slabs so the field is inverted in several parallel pieces
+    inverse, error, iterations = invert_fields.invert_displacement_field(field, threads=3, block_points=2000)
+
+    tolerance = invert_fields.DEFAULT_TOLERANCE * min(SPACING)
+    assert 0 < iterations < invert_fields.DEFAULT_MAX_ITERATIONS
+    assert sitk.GetArrayFromImage(error).max() <= tolerance
+
+    # Check the reported error: T(T^-1(y)) = y
+    forward = transform_engine.DisplacementFieldTransform(field)
+    backward = transform_engine.DisplacementFieldTransform(inverse)
+    size = np.array(field.GetSize())
+    points = transform_engine.grid_points(size, np.array(SPACING), np.array(ORIGIN), np.eye(3), 0, size[2])
+    roundtrip = forward.transform(backward.transform(points)[0])[0]
+    assert np.linalg.norm(roundtrip - points, axis=1).max() <= tolerance * 1.001
+
+
+def test_displacement_field_transform(tmp_path):
+    field = _smooth_field((10, 12, 14), amplitude=2.0)
+    sitk.WriteImage(field, str(tmp_path / 'field.nrrd'))
+
+    tp_path = tmp_path / 'TransformParameters.0.txt'
+    tp_path.write_text('(Transform "DeformationFieldTransform")\n'
+                       '(DeformationFieldFileName "field.nrrd")\n'  # Relative to the parameter file
+                       '(DeformationFieldInterpolationOrder 1)\n')
+    tform = transform_engine.load_transform(TransformParameterFile.read(tp_path))
+
+    # Points off the grid, including some outside it which are not moved
+    rng = np.random.default_rng(0)
+    points = np.array(ORIGIN) + rng.uniform(-3, 22, (500, 3))
+    mapped, jac = tform.transform(points)
+
+    reference = tform.to_sitk()
+    expected = np.array([reference.TransformPoint(p.tolist()) for p in points])
+    assert np.allclose(mapped, expected, atol=1e-5)
+
+    eps = 1e-5
+    numerical = np.stack([(tform.transform(points + eps * e)[0] - tform.transform(points - eps * e)[0]) / (2 * eps)
+                          for e in np.eye(3)], axis=-1)
+    assert np.allclose(jac, numerical, atol=1e-4)
+
+
+def test_invert_transform_file(tmp_path):
+    bspline_tp, composite = _make_chain(tmp_path, grid_size=(10, 10, 10))
+
+    # The Euler stage alone is inverted exactly
+    tp, report = invert_fields.invert_transform_file(tmp_path / 'euler.txt', tmp_path)
+    assert report['method'] == 'analytic'
+    tp.write(tmp_path / 'inverse_euler.txt')
+
+    euler = composite.GetNthTransform(2)
+    inverse = transform_engine.load_transform_chain(tmp_path / 'inverse_euler.txt')
+    points = np.random.default_rng(0).uniform(0, 20, (100, 3))
+    roundtrip = np.array([euler.TransformPoint(p.tolist()) for p in inverse.transform_points(points)[0]])
+    assert np.allclose(roundtrip, points, atol=1e-4)
+
+    # The chain of Euler, affine and B-spline is inverted numerically
+    tp, report = invert_fields.invert_transform_file(bspline_tp, tmp_path, threads=2)
+    assert report['method'] == 'fixed_point'
+    assert report['mean_error'] <= report['p99_error'] <= report['max_error']
+    assert tp.initial_transform is None
+    assert 'GridSize' not in tp
+
+    tp['ResultImagePixelType'] = 'unsigned char'
+    tp.write(tmp_path / 'inverse.txt')
+
+    # The inverse can be used by the in-process resampler
+    labels = np.zeros((16, 18, 20), np.uint8)
+    labels[4:12, 4:14, 4:16] = 1
+    label_img = sitk.GetImageFromArray(labels)
+    label_img.SetSpacing(SPACING)
+    label_img.SetOrigin(ORIGIN)
+
+    result = transform_engine.resample(label_img, tmp_path / 'inverse.txt')
+    assert result.GetPixelID() == sitk.sitkUInt8
+    assert sitk.GetArrayFromImage(result).sum() > 0
@@ -0,0 +1,42 @@
+"""
+Test how lama_job_runner decides whether to start another job on a node
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from lama.scripts import lama_job_runner
+from lama.work_queue import WorkQueue, PENDING, FAILED
+
+GB = 1e9
+
+
+class _Estimator:
+    def estimate(self):
+        return 4 * GB
+
+
+@pytest.mark.parametrize('num_running, admit', [(1, True), (2, False)])
+def test_can_admit_with_memory_limit(monkeypatch, num_running, admit):
+    # The limit is a constant, so the memory the running jobs use has to be taken off it
+    monkeypatch.setenv('MEMORY_LIMIT', str(int(10 * GB)))
+    monkeypatch.setattr(lama_job_runner, 'process_tree_rss', lambda pid: 4 * GB)  # Jobs at their peak
+
+    running = {f'job_{i}': SimpleNamespace(pid=i) for i in range(num_running)}
+    assert lama_job_runner._can_admit(running, threads=1, cores=64, estimator=_Estimator()) is admit
+
+
+@pytest.mark.parametrize('exitcode, status', [(1, PENDING), (-9, PENDING), (lama_job_runner.JOB_FAILED, FAILED)])
+def test_job_process_exit(tmp_path, exitcode, status):
+    queue = WorkQueue(tmp_path / 'jobs.db')
+    queue.add_tasks(lama_job_runner.JOB_STAGE, ['job_1'])
+    job = queue.claim(lama_job_runner.JOB_STAGE, 'w1')
+
+    if exitcode == lama_job_runner.JOB_FAILED:
+        # As run_job records a failure before exiting
+        queue.fail(lama_job_runner.JOB_STAGE, job, 'w1', 'failed', retry=False)
+
+    # A crash (1 is an uncaught exception) or kill before anything was recorded puts the job back to be retried
+    lama_job_runner._job_process_exited(queue, job, 'w1', exitcode)
+    assert queue.tasks(lama_job_runner.JOB_STAGE)['status'][0] == status
@@ -0,0 +1,128 @@
+"""
+Test the numpy linear model engine against statsmodels and, if R is installed, lmFast.R
+"""
+
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.formula.api as smf
+
+from lama.stats import linear_model
+from lama.stats.standard_stats import baseline_store
+
+NUM_WT = 20
+NUM_MUT = 4
+
+
+def _line_data(num_points, seed=0):
+    rng = np.random.default_rng(seed)
+    n = NUM_WT + NUM_MUT
+    info = pd.DataFrame({'genotype': ['wildtype'] * NUM_WT + ['mutant'] * NUM_MUT,
+                         'staging': rng.normal(100, 10, n),
+                         'line': 'line_1'},
+                        index=[f'wt_{i}' for i in range(NUM_WT)] + [f'mut_{i}' for i in range(NUM_MUT)])
+    # Data depending on staging, with a mutant effect on some points
+    data = 0.05 * info['staging'].values[:, None] + rng.normal(0, 1, (n, num_points))
+    data[NUM_WT:, : num_points // 4] += 2
+    return data, info
+
+
+def _statsmodels(data, info, formula):
+    p, t = [], []
+    df = info.copy()
+    for col in range(data.shape[1]):
+        df['y'] = np.abs(data[:, col])
+        fit = smf.ols(f'y ~ {formula}', data=df).fit()
+        p.append(fit.pvalues['genotype[T.wildtype]'])
+        t.append(-fit.tvalues['genotype[T.wildtype]'])
+    return np.array(p), np.array(t)
+
+
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_matches_statsmodels(use_staging):
+    data, info = _line_data(50)
+    data[:, 0] = 0  # An all-zero column gives NaN, as it does in R
+
+    p, t = linear_model.lm_numpy(data, info, use_staging=use_staging)
+    assert p.dtype == t.dtype == np.float32
+    assert len(p) == len(t) == data.shape[1] * (NUM_MUT + 1)
+
+    formula = 'genotype + staging' if use_staging else 'genotype'
+
+    # Line level, then each mutant with all the wild types
+    expected = [_statsmodels(data, info, formula)]
+    for i in range(NUM_MUT):
+        rows = list(range(NUM_WT)) + [NUM_WT + i]
+        expected.append(_statsmodels(data[rows], info.iloc[rows], formula))
+    exp_p = np.concatenate([e[0] for e in expected])
+    exp_t = np.concatenate([e[1] for e in expected])
+
+    assert np.isnan(t[0]) and np.isnan(p[0])
+    valid = ~np.isnan(exp_t)
+    assert np.allclose(p[valid], exp_p[valid], rtol=1e-4, atol=1e-7)
+    assert np.allclose(t[valid], exp_t[valid], rtol=1e-4, atol=1e-5)
+
+    # The mutant effect is positive
+    assert np.all(t[1: data.shape[1] // 4] > 0)
+
+
+def test_aliased_staging():
+    # Constant staging is dropped from the model, as R does
+    data, info = _line_data(10)
+    info['staging'] = 1.0
+
+    p, t = linear_model.lm_numpy(data, info, use_staging=True)
+    p_no_staging, t_no_staging = linear_model.lm_numpy(data, info, use_staging=False)
+    assert np.allclose(t, t_no_staging)
+    assert np.allclose(p, p_no_staging)
+
+
+def test_specimen_fits_match_refitting():
+    data, info = _line_data(10_000, seed=1)
+    info.iloc[NUM_WT, info.columns.get_loc('staging')] = 150  # A mutant with high leverage
+    y = np.abs(data)
+    groups = info[['genotype', 'staging']]
+    wt, mut = slice(0, NUM_WT), slice(NUM_WT, None)
+
+    p, t = linear_model._fit_specimens(y[wt], groups.iloc[wt], y[mut], groups.iloc[mut])
+
+    for i in range(NUM_MUT):
+        rows = list(range(NUM_WT)) + [NUM_WT + i]
+        p_refit, t_refit = linear_model._fit_genotype(y[rows], groups.iloc[rows])
+        assert np.allclose(p[i], p_refit)
+        assert np.allclose(t[i], t_refit)
+
+
+@pytest.mark.parametrize('use_staging', [True, False])
+def test_baseline_statistics_match_data(tmp_path, use_staging):
+    data, info = _line_data(1000, seed=2)
+    data[:, 0] = 0
+
+    # Store the wild type statistics, then fit the mutants against them in two chunks, as Stats.run_stats does
+    wt_staging = info.iloc[:NUM_WT][['staging']]
+    key = baseline_store.store_key('jacobians', wt_staging, np.ones((4, 4, 4)), 100, 14)
+    store_file = tmp_path / baseline_store.store_file_name('jacobians', key)
+    baseline_store.BaselineStatistics.from_data(list(data[:NUM_WT]), wt_staging).save(store_file, key)
+
+    assert baseline_store.load(store_file, 'another key') is None
+    baseline = baseline_store.load(store_file, key)
+
+    expected_p, expected_t = linear_model.lm_numpy(data, info, use_staging=use_staging)
+
+    for start, end in [(0, 600), (600, 1000)]:
+        p, t = linear_model.lm_baseline(baseline.chunk(start, end), data[NUM_WT:, start: end], info,
+                                        use_staging=use_staging)
+        columns = np.concatenate([np.arange(start, end) + i * data.shape[1] for i in range(NUM_MUT + 1)])
+        assert np.allclose(p, expected_p[columns], rtol=1e-4, atol=1e-7, equal_nan=True)
+        assert np.allclose(t, expected_t[columns], rtol=1e-4, atol=1e-5, equal_nan=True)
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='R is not installed')
+def test_matches_r():
+    data, info = _line_data(200)
+    p_r, t_r = linear_model.lm_r(data, info)
+    p, t = linear_model.lm_numpy(data, info)
+    assert np.allclose(p, p_r, rtol=1e-4, atol=1e-7, equal_nan=True)
+    assert np.allclose(t, t_r, rtol=1e-4, atol=1e-5, equal_nan=True)
@@ -0,0 +1,67 @@
+"""
+Test the in-process FDR correction against statsmodels and, if R is installed, r_padjust.R
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+from statsmodels.stats.multitest import multipletests
+
+from lama.stats import multiple_testing
+from lama.stats.standard_stats import stats_objects
+
+
+def _pvals(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    p = rng.uniform(0, 1, shape)
+    # Some signal and some ties, as from float32 p-values
+    p[..., : p.shape[-1] // 10] *= 1e-3
+    p[..., -5:] = p[..., -6:-5]
+    return p
+
+
+@pytest.mark.parametrize('method, sm_method', [('BH', 'fdr_bh'), ('BY', 'fdr_by')])
+def test_matches_statsmodels(method, sm_method):
+    p = _pvals(2000)
+    q = multiple_testing.p_adjust(p, method)
+    assert np.allclose(q, multipletests(p, method=sm_method)[1], rtol=1e-12)
+
+
+def test_known_values():
+    # From R: p.adjust(c(0.01, 0.04, 0.03, 0.2), 'BH') and 'BY'
+    p = np.array([0.01, 0.04, 0.03, 0.2])
+    assert np.allclose(multiple_testing.p_adjust(p, 'BH'), [0.04, 0.05333333, 0.05333333, 0.2])
+    assert np.allclose(multiple_testing.p_adjust(p, 'BY'), [0.08333333, 0.1111111, 0.1111111, 0.4166667])
+
+    # pi0 = 2 / (4 * 0.5)
+    assert np.allclose(multiple_testing.p_adjust(np.array([0.01, 0.02, 0.6, 0.9]), 'storey'),
+                       [0.04, 0.04, 0.8, 0.9])
+
+
+def test_rows_and_nans():
+    p = _pvals((5, 1000))
+    p[2, ::7] = np.nan
+
+    for method in multiple_testing.FDR_METHODS:
+        q = multiple_testing.p_adjust(p, method)
+        assert q.shape == p.shape
+
+        for row in range(len(p)):
+            valid = ~np.isnan(p[row])
+            expected = np.full(p.shape[1], np.nan)
+            expected[valid] = multiple_testing.p_adjust(p[row, valid], method)
+            assert np.allclose(q[row], expected, equal_nan=True)
+
+        # Columns as tests
+        assert np.allclose(multiple_testing.p_adjust(p.T, method, axis=0), q.T, equal_nan=True)
+
+    # The storey q-values are no larger than BH
+    valid = ~np.isnan(p)
+    assert np.all(multiple_testing.p_adjust(p, 'storey')[valid] <= multiple_testing.p_adjust(p, 'BH')[valid])
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='R is not installed')
+def test_matches_r():
+    p = _pvals(5000).astype(np.float32)
+    assert np.allclose(stats_objects.fdr(p), stats_objects.fdr_r(p), rtol=1e-6)
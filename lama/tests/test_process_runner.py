@@ -0,0 +1,43 @@
+"""
+Test the shared elastix/transformix process runner using small python commands
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+from lama.elastix.process_runner import ProcessRunner
+
+
+def test_output_streamed_to_log(tmp_path):
+    runner = ProcessRunner()
+    log = tmp_path / 'python_stdout.log'
+    result = runner.run([sys.executable, '-c', 'for i in range(10000): print(i)'], log_file=log)
+
+    assert result.returncode == 0
+    assert log.read_text().split() == [str(i) for i in range(10000)]
+    assert result.output_tail.splitlines()[-1] == '9999'
+
+
+def test_failure_raises(tmp_path):
+    runner = ProcessRunner()
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        runner.run([sys.executable, '-c', 'print("bad"); raise SystemExit(3)'])
+    assert e.value.returncode == 3
+    assert 'bad' in e.value.output
+
+    result = runner.run([sys.executable, '-c', 'raise SystemExit(3)'], check=False)
+    assert result.returncode == 3
+
+
+def test_timeout_and_retry():
+    runner = ProcessRunner(timeout=0.5, retries=1)
+    start = time.time()
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.run([sys.executable, '-c', 'import time; time.sleep(30)'])
+    assert time.time() - start < 10
+
+    result = runner.run([sys.executable, '-c', 'import time; time.sleep(30)'], check=False)
+    assert result.timed_out and result.attempts == 2
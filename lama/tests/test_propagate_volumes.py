@@ -0,0 +1,188 @@
+"""
+Test propagating label maps and heatmaps in-process with the SimpleITK backend
+"""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import yaml
+
+from lama.elastix import PROPAGATE_CONFIG, PROPAGATE_LABEL_TRANFORM, PROPAGATE_IMAGE_TRANSFORM
+from lama.elastix.propagate_volumes import (PropagateLabelMap, PropagateHeatmap, PropagatePackedLabelMap,
+                                            run_propagations, chain_tforms, PROPAGATION_DONE)
+from lama.elastix.transform_parameters import TransformParameterFile
+from lama.tests.test_transform_engine import _make_chain, SIZE, SPACING, ORIGIN
+
+
+@pytest.fixture
+def propagation_dir(tmp_path):
+    """
+    An inverted_transforms-like directory with a BSpline and an affine stage for one specimen. Returns the config path
+    and the SimpleITK transform the stages should be equivalent to
+    """
+    chain_dir = tmp_path / 'chain'
+    chain_dir.mkdir()
+    bspline_tp, composite = _make_chain(chain_dir)
+
+    # Use the affine and BSpline transforms of the test chain as two stages, dropping the Euler. The BSpline stage
+    # is the first in the propagation order and its initial transform is set by chain_tforms
+    affine_tp = TransformParameterFile.read(bspline_tp).initial_transform
+
+    root = tmp_path / 'inverted_transforms'
+    for specimen_id, shift in [('specimen_1', 0), ('specimen_2', 2.0)]:
+        for stage, tp_path in [('deformable', bspline_tp), ('affine', affine_tp)]:
+            for name, pixel_type in [(PROPAGATE_LABEL_TRANFORM, 'unsigned char'), (PROPAGATE_IMAGE_TRANSFORM, 'float')]:
+                tp = TransformParameterFile.read(tp_path)
+                tp['ResultImagePixelType'] = pixel_type
+                tp.initial_transform = None  # As _modify_inverted_tform_file
+                if stage == 'affine':
+                    # Give specimen_2 a different transform so that mixing them up would be noticed
+                    tp.parameters[-3] += shift
+                out = root / stage / specimen_id / name
+                out.parent.mkdir(parents=True, exist_ok=True)
+                tp.write(out)
+
+    config_path = root / PROPAGATE_CONFIG
+    with open(config_path, 'w') as fh:
+        yaml.dump({'label_propagation_order': ['deformable', 'affine']}, fh)
+
+    return config_path, composite
+
+
+def _input_image(tmp_path, arr, name):
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing(SPACING)
+    img.SetOrigin(ORIGIN)
+    path = tmp_path / name
+    sitk.WriteImage(img, str(path))
+    return img, path
+
+
+def test_propagate_label_map(propagation_dir, tmp_path):
+    config_path, composite = propagation_dir
+
+    labels = np.zeros(SIZE[::-1], dtype=np.uint8)
+    labels[4:12, 3:15, 5:15] = 1
+    labels[6:10, 6:12, 8:12] = 2
+    label_img, label_path = _input_image(tmp_path, labels, 'labels.nrrd')
+
+    # The Euler transform of the test chain is not part of the propagation stages
+    composite = sitk.CompositeTransform([composite.GetNthTransform(i) for i in range(2)])
+    expected = sitk.Resample(label_img, label_img, composite, sitk.sitkNearestNeighbor, 0)
+
+    outdir = tmp_path / 'inverted_labels'
+    outdir.mkdir()
+    PropagateLabelMap(config_path, label_path, outdir, threads=2, backend='sitk').run()
+
+    result = sitk.ReadImage(str(outdir / 'specimen_1' / 'specimen_1.nrrd'))
+    assert result.GetPixelID() == sitk.sitkUInt8
+    assert np.array_equal(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected))
+    assert 0 < (sitk.GetArrayFromImage(result) == 2).sum()
+
+
+def test_propagate_heatmap(propagation_dir, tmp_path):
+    config_path, composite = propagation_dir
+
+    heatmap = np.random.default_rng(0).normal(size=SIZE[::-1]).astype(np.float32)
+    heatmap_img, heatmap_path = _input_image(tmp_path, heatmap, 'heatmap.nrrd')
+
+    composite = sitk.CompositeTransform([composite.GetNthTransform(i) for i in range(2)])
+    expected = sitk.Resample(heatmap_img, heatmap_img, composite, sitk.sitkLinear, 0)
+
+    outdir = tmp_path / 'inverted_heatmaps'
+    outdir.mkdir()
+    PropagateHeatmap(config_path, heatmap_path, outdir, backend='sitk').run()
+
+    result = sitk.ReadImage(str(outdir / 'specimen_1' / 'specimen_1.nrrd'))
+    assert result.GetPixelID() == sitk.sitkFloat32
+    assert np.allclose(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected), atol=1e-5)
+
+
+def test_run_propagations(propagation_dir, tmp_path):
+    config_path, _ = propagation_dir
+
+    labels = np.zeros(SIZE[::-1], dtype=np.uint8)
+    labels[4:12, 3:15, 5:15] = 1
+    _, label_path = _input_image(tmp_path, labels, 'labels.nrrd')
+    _, mask_path = _input_image(tmp_path, (labels > 0).astype(np.uint8), 'mask.nrrd')
+
+    propagators = []
+    for name, path in [('labels', label_path), ('masks', mask_path)]:
+        outdir = tmp_path / name
+        outdir.mkdir()
+        propagators.append(PropagateLabelMap(config_path, path, outdir, backend='sitk'))
+
+    run_propagations(propagators, max_parallel=3, threads=4)
+
+    for p in propagators:
+        assert (p.out_dir / PROPAGATION_DONE).is_file()
+        results = [sitk.GetArrayFromImage(sitk.ReadImage(str(p.out_dir / s / f'{s}.nrrd')))
+                   for s in ['specimen_1', 'specimen_2']]
+        # Each specimen used its own transforms
+        assert not np.array_equal(*results)
+
+    # A failure in one propagator stops only its own done file being written
+    for p in propagators:
+        (p.out_dir / PROPAGATION_DONE).unlink()
+    label_path.unlink()
+
+    with pytest.raises(RuntimeError):
+        run_propagations(propagators, max_parallel=3, threads=4)
+
+    assert not (propagators[0].out_dir / PROPAGATION_DONE).is_file()
+    assert (propagators[1].out_dir / PROPAGATION_DONE).is_file()
+
+
+def test_chain_tforms_missing_specimen(propagation_dir, tmp_path):
+    config_path, _ = propagation_dir
+    root = config_path.parent
+    config = yaml.safe_load(config_path.read_text())
+
+    (root / 'affine' / 'specimen_2' / PROPAGATE_LABEL_TRANFORM).unlink()
+
+    # Another specimen's transform must not be used in its place
+    with pytest.raises(FileNotFoundError, match='specimen_2'):
+        chain_tforms(root, tmp_path, PROPAGATE_LABEL_TRANFORM, config, 'specimen_2')
+
+    assert chain_tforms(root, tmp_path, PROPAGATE_LABEL_TRANFORM, config, 'specimen_1').is_file()
+
+
+@pytest.mark.parametrize('max_label', [20, 200, 1000])
+def test_packed_propagation_matches_separate(propagation_dir, tmp_path, max_label):
+    config_path, _ = propagation_dir
+
+    rng = np.random.default_rng(0)
+    dtype = np.uint8 if max_label < 256 else np.uint16
+    labels = np.zeros(SIZE[::-1], dtype=dtype)
+    labels[2:14, 2:16, 2:18] = rng.integers(1, max_label + 1, (12, 14, 16))
+    mask = np.zeros(SIZE[::-1], dtype=np.uint8)
+    mask[1:13, 4:17, 3:19] = 1
+    _, label_path = _input_image(tmp_path, labels, 'labels.nrrd')
+    _, mask_path = _input_image(tmp_path, mask, 'mask.nrrd')
+
+    separate = []
+    for name, path in [('labels', label_path), ('masks', mask_path)]:
+        outdir = tmp_path / name
+        outdir.mkdir()
+        p = PropagateLabelMap(config_path, path, outdir, backend='sitk')
+        # Don't truncate labels over 255 for the comparison
+        p.tform_replacements['ResultImagePixelType'] = 'unsigned short'
+        separate.append(p)
+    run_propagations(separate, max_parallel=2)
+
+    packed_labels, packed_masks = tmp_path / 'packed_labels', tmp_path / 'packed_masks'
+    packed_labels.mkdir()
+    packed = PropagatePackedLabelMap(config_path, label_path, mask_path, packed_labels, packed_masks, backend='sitk')
+    run_propagations([packed], max_parallel=2)
+
+    for specimen_id in ['specimen_1', 'specimen_2']:
+        for separate_dir, packed_dir in [(tmp_path / 'labels', packed_labels), (tmp_path / 'masks', packed_masks)]:
+            expected = sitk.GetArrayFromImage(sitk.ReadImage(str(separate_dir / specimen_id / f'{specimen_id}.nrrd')))
+            result = sitk.ReadImage(str(packed_dir / specimen_id / f'{specimen_id}.nrrd'))
+            assert np.array_equal(sitk.GetArrayFromImage(result), expected)
+
+        label_img = sitk.ReadImage(str(packed_labels / specimen_id / f'{specimen_id}.nrrd'))
+        assert label_img.GetPixelID() == (sitk.sitkUInt8 if dtype == np.uint8 else sitk.sitkUInt16)
+
+    assert (packed_labels / PROPAGATION_DONE).is_file()
+    assert (packed_masks / PROPAGATION_DONE).is_file()
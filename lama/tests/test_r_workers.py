@@ -0,0 +1,108 @@
+"""
+Test the R worker pool. The protocol is tested with a stand-in for Rscript, and the LAMA R scripts if R is installed
+"""
+
+import os
+import shutil
+import struct
+import subprocess as sub
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from lama.stats import linear_model, r_workers
+from lama.stats.standard_stats import stats_objects
+from lama.tests.test_linear_model import _line_data
+
+# Runs jobs as r_worker.R does. The 'script' says what to do
+FAKE_RSCRIPT = '''#!{python}
+import os, sys
+for line in sys.stdin:
+    script, *args = line.rstrip('\\n').split('\\t')
+    if script == 'exit':
+        sys.exit(3)
+    if script == 'fail':
+        print('{error} something went wrong', flush=True)
+        continue
+    print(os.getpid(), *args)
+    print('{done}', flush=True)
+'''
+
+
+@pytest.fixture
+def fake_rscript(tmp_path, monkeypatch):
+    rscript = tmp_path / 'Rscript'
+    rscript.write_text(FAKE_RSCRIPT.format(python=sys.executable, done=r_workers.DONE, error=r_workers.ERROR))
+    rscript.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path), prepend=os.pathsep)
+    yield
+    r_workers.set_num_workers(r_workers.DEFAULT_NUM_WORKERS)
+    r_workers.set_exchange_dir(None)
+
+
+def test_worker_pool(fake_rscript):
+    r_workers.set_num_workers(2)
+
+    with ThreadPoolExecutor(4) as pool:
+        outputs = list(pool.map(lambda i: r_workers.run_rscript('script.R', [i, '']), range(20)))
+
+    # The jobs were shared by two processes, and the empty argument was kept
+    assert {out.split()[1] for out in outputs} == {str(i) for i in range(20)}
+    assert len({out.split()[0] for out in outputs}) == 2
+    assert all(out.endswith(' ') for out in outputs)
+
+    with pytest.raises(sub.CalledProcessError, match='something went wrong|non-zero'):
+        r_workers.run_rscript('fail', [])
+
+    # A worker that exits is replaced
+    with pytest.raises(sub.CalledProcessError):
+        r_workers.run_rscript('exit', [])
+    assert r_workers.run_rscript('script.R', ['after'])
+
+
+def test_exchange_files_removed_on_failure(fake_rscript, tmp_path):
+    exchange_dir = tmp_path / 'exchange'
+    exchange_dir.mkdir()
+    r_workers.set_exchange_dir(exchange_dir)
+    r_workers.set_num_workers(1)
+
+    # The stand-in Rscript writes no results
+    data, info = _line_data(20)
+    with pytest.raises(FileNotFoundError):
+        linear_model.lm_r(data, info)
+    with pytest.raises(FileNotFoundError):
+        stats_objects.fdr_r(np.full(10, 0.5))
+
+    assert not any(exchange_dir.iterdir())
+
+
+def test_numpy_to_dat(tmp_path):
+    mat = np.random.default_rng(0).normal(size=(7, 5)).astype(np.float32)
+    linear_model._numpy_to_dat(mat, tmp_path / 'data.dat')
+
+    # The format lmFast.R reads: the dimensions, then each column in turn
+    expected = struct.pack('2I', *mat.shape) + b''.join(struct.pack('7d', *mat[:, i]) for i in range(5))
+    assert (tmp_path / 'data.dat').read_bytes() == expected
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='R is not installed')
+def test_r_scripts_on_workers():
+    data, info = _line_data(200)
+
+    r_workers.set_num_workers(0)
+    p_expected, t_expected = linear_model.lm_r(data, info)
+    q_expected = stats_objects.fdr_r(p_expected)
+
+    r_workers.set_num_workers(2)
+    try:
+        for _ in range(2):
+            p, t = linear_model.lm_r(data, info)
+            assert np.array_equal(p, p_expected, equal_nan=True)
+            assert np.array_equal(t, t_expected, equal_nan=True)
+
+        q = stats_objects.fdr_r(np.stack([p_expected] * 3))
+        assert np.array_equal(q, np.stack([q_expected] * 3))
+    finally:
+        r_workers.set_num_workers(r_workers.DEFAULT_NUM_WORKERS)
@@ -0,0 +1,73 @@
+"""
+Test the elastix job scheduler
+"""
+
+import pytest
+
+from lama.elastix import scheduler
+
+
+def test_parse_elastix_time(tmp_path):
+    log = tmp_path / 'elastix.log'
+    log.write_text('Time spent in resolution 0: 10.0 s.\nTotal time elapsed: 1h 2m 3.5s.\n')
+    assert scheduler.parse_elastix_time(log) == pytest.approx(3723.5)
+
+    log.write_text('Total time elapsed: 12.3 s.\n')
+    assert scheduler.parse_elastix_time(log) == pytest.approx(12.3)
+
+    log.write_text('elastix crashed\n')
+    assert scheduler.parse_elastix_time(log) is None
+    assert scheduler.parse_elastix_time(tmp_path / 'missing.log') is None
+
+
+def test_estimate_durations(tmp_path):
+    dirs = []
+    for name, transform, log in [('rigid', 'EulerTransform', 'Total time elapsed: 20.0s.'),
+                                 ('deformable', 'BSplineTransform', 'Total time elapsed: 200.0s.'),
+                                 ('deformable_no_log', 'BSplineTransform', None)]:
+        d = tmp_path / name
+        d.mkdir()
+        (d / 'TransformParameters.0.txt').write_text(f'(Transform "{transform}")\n')
+        if log:
+            (d / 'elastix.log').write_text(log + '\n')
+        dirs.append(d)
+
+    assert scheduler.estimate_duration(dirs[2]) == scheduler.TRANSFORM_WEIGHTS['BSplineTransform']
+
+    rigid, deformable, no_log = scheduler.estimate_durations(dirs, threads=1)
+    assert (rigid, deformable) == (20.0, 200.0)
+    # The weight is converted to seconds using the logged jobs: 220s / 11 weight units
+    assert no_log == pytest.approx(200.0)
+
+    # Logged times are converted to single-thread times
+    rigid_4_threads = scheduler.estimate_durations(dirs[:1], threads=4)[0]
+    assert rigid_4_threads == pytest.approx(20 / (0.2 + 0.8 / 4))
+
+
+def test_lpt_makespan():
+    assert scheduler.lpt_makespan([5, 4, 3, 3, 3], 2) == 10
+    assert scheduler.lpt_makespan([5, 4, 3], 5) == 5
+    assert scheduler.lpt_makespan([1, 1, 1, 1], 1) == 4
+
+
+def test_plan_jobs():
+    # Many equal jobs: run as many at once as there are cores, as threads don't scale perfectly
+    plan = scheduler.plan_jobs([10] * 32, cores=8)
+    assert (plan.processes, plan.threads) == (8, 1)
+
+    # One job: give it all the threads
+    plan = scheduler.plan_jobs([100], cores=8)
+    assert (plan.processes, plan.threads) == (1, 8)
+
+    # Longest jobs are started first
+    durations = [1, 50, 1, 1, 20]
+    plan = scheduler.plan_jobs(durations, cores=4)
+    assert plan.order[:2] == [1, 4]
+    assert plan.processes * plan.threads <= 4
+
+    # The chosen plan is no worse than the old fixed 8 processes with all the threads each on a 4 core machine
+    oversubscribed = scheduler.lpt_makespan([d * 8 / 4 for d in durations], 8)  # 8 * 4 threads on 4 cores
+    assert plan.makespan <= oversubscribed
+
+    assert scheduler.plan_jobs([10] * 32, cores=8, max_processes=2).processes == 2
+    assert scheduler.plan_jobs([], cores=8).order == []
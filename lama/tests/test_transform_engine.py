@@ -0,0 +1,161 @@
+"""
+Test the in-process transform engine against SimpleITK's implementation of the same transforms, finite differences of
+the displacement field and, if it is installed, transformix
+"""
+
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from lama.elastix import transform_engine
+
+SIZE = (20, 18, 16)  # x, y, z
+SPACING = (1.5, 1.0, 2.0)
+ORIGIN = (-3.0, 2.0, 1.0)
+
+GRID_SIZE = (8, 8, 8)
+GRID_SPACING = (6.0, 5.0, 7.0)
+GRID_ORIGIN = (-12.0, -8.0, -13.0)
+
+
+def _fmt(values):
+    return ' '.join(f'{v:.10f}' if isinstance(v, float) else str(v) for v in values)
+
+
+def _write_tp(path, transform, params, extra, initial='NoInitialTransform'):
+    lines = [f'(Transform "{transform}")',
+             f'(NumberOfParameters {len(params)})',
+             f'(TransformParameters {_fmt(params)})',
+             f'(InitialTransformParameterFileName "{initial}")',
+             '(HowToCombineTransforms "Compose")',
+             '(FixedImageDimension 3)',
+             '(MovingImageDimension 3)',
+             f'(Size {_fmt(SIZE)})',
+             '(Index 0 0 0)',
+             f'(Spacing {_fmt(SPACING)})',
+             f'(Origin {_fmt(ORIGIN)})',
+             '(Direction 1 0 0 0 1 0 0 0 1)',
+             '(UseDirectionCosines "true")',
+             '(ResultImagePixelType "float")',
+             '(ResultImageFormat "nrrd")',
+             '(ResampleInterpolator "FinalBSplineInterpolator")',
+             '(FinalBSplineInterpolationOrder 3)',
+             '(Resampler "DefaultResampler")',
+             '(DefaultPixelValue 0)',
+             '(CompressResultImage "false")'] + extra
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def _make_chain(tmp_path, grid_size=GRID_SIZE):
+    """
+    An Euler -> Affine -> BSpline chain and the equivalent SimpleITK composite transform
+    """
+    rng = np.random.default_rng(0)
+
+    euler_params = [0.05, -0.03, 0.1, 1.0, -0.5, 0.8]
+    center = [10.0, 9.0, 16.0]
+    euler_tp = tmp_path / 'euler.txt'
+    _write_tp(euler_tp, 'EulerTransform', euler_params, [f'(CenterOfRotationPoint {_fmt(center)})'])
+
+    affine_params = [1.05, 0.02, -0.01, 0.03, 0.97, 0.02, -0.02, 0.01, 1.02, 0.5, 0.3, -0.4]
+    affine_tp = tmp_path / 'affine.txt'
+    _write_tp(affine_tp, 'AffineTransform', affine_params, [f'(CenterOfRotationPoint {_fmt(center)})'],
+              initial=euler_tp.name)  # Relative path, as resolved against the tp file's directory
+
+    n = int(np.prod(grid_size))
+    bspline_params = rng.normal(0, 1.0, 3 * n)
+    bspline_tp = tmp_path / 'bspline.txt'
+    _write_tp(bspline_tp, 'BSplineTransform', bspline_params,
+              [f'(GridSize {_fmt(grid_size)})', '(GridIndex 0 0 0)', f'(GridSpacing {_fmt(GRID_SPACING)})',
+               f'(GridOrigin {_fmt(GRID_ORIGIN)})', '(GridDirection 1 0 0 0 1 0 0 0 1)',
+               '(BSplineTransformSplineOrder 3)', '(UseCyclicTransform "false")'],
+              initial=str(affine_tp))
+
+    euler = sitk.Euler3DTransform(center, *euler_params[:3], euler_params[3:])
+    affine = sitk.AffineTransform(affine_params[:9], affine_params[9:], center)
+    bspline = sitk.BSplineTransform(3, 3)
+    bspline.SetFixedParameters(list(grid_size) + list(GRID_ORIGIN) + list(GRID_SPACING) + [1, 0, 0, 0, 1, 0, 0, 0, 1])
+    bspline.SetParameters(bspline_params.tolist())
+
+    # SimpleITK composite transforms apply the last added transform first
+    composite = sitk.CompositeTransform(3)
+    composite.AddTransform(bspline)
+    composite.AddTransform(affine)
+    composite.AddTransform(euler)
+
+    return bspline_tp, composite
+
+
+@pytest.fixture
+def chain(tmp_path):
+    # Part of the image is outside the valid region of the B-spline grid
+    return _make_chain(tmp_path)
+
+
+def test_matches_sitk(chain):
+    tp, composite = chain
+    disp, jac = transform_engine.deformation_and_jacobian(tp, block_points=1000)  # Force several blocks
+
+    assert disp.GetSize() == SIZE
+    assert np.allclose(disp.GetSpacing(), SPACING)
+    assert np.allclose(disp.GetOrigin(), ORIGIN)
+
+    expected_disp = sitk.TransformToDisplacementField(composite, sitk.sitkVectorFloat64, SIZE, ORIGIN, SPACING)
+    assert np.allclose(sitk.GetArrayFromImage(disp), sitk.GetArrayFromImage(expected_disp), atol=1e-4)
+
+    # The jacobian determinant of the composite at a few points
+    jac_arr = sitk.GetArrayFromImage(jac)
+    for index in [(0, 0, 0), (5, 7, 3), (19, 17, 15), (10, 3, 12)]:
+        point = np.array(jac.TransformIndexToPhysicalPoint(index))
+        eps = 1e-4
+        columns = [(np.array(composite.TransformPoint(point + eps * e)) -
+                    np.array(composite.TransformPoint(point - eps * e))) / (2 * eps) for e in np.eye(3)]
+        expected = np.linalg.det(np.stack(columns, axis=1))
+        assert jac_arr[index[::-1]] == pytest.approx(expected, rel=1e-3)
+
+
+def test_jacobian_matches_finite_differences(tmp_path):
+    # The B-spline is not smooth at the edge of its valid region, so use a grid that covers the whole image
+    tp, _ = _make_chain(tmp_path, grid_size=(10, 10, 10))
+    disp, jac = transform_engine.deformation_and_jacobian(tp)
+
+    disp_arr = sitk.GetArrayFromImage(disp).astype(np.float64)
+    jac_arr = sitk.GetArrayFromImage(jac)
+
+    # Finite differences of the displacement on the voxel grid. Gradient arrays are in z, y, x order
+    grads = [np.gradient(disp_arr[..., i], *SPACING[::-1]) for i in range(3)]
+    j = np.empty(disp_arr.shape[:3] + (3, 3))
+    for i in range(3):
+        for k in range(3):
+            j[..., i, k] = grads[i][2 - k] + (i == k)
+    fd_jac = np.linalg.det(j)
+
+    # Central differences are only second order accurate so compare loosely, away from the edges
+    interior = (slice(1, -1),) * 3
+    assert np.allclose(jac_arr[interior], fd_jac[interior], rtol=0.05, atol=0.02)
+
+
+def test_unsupported_transform(tmp_path):
+    tp = tmp_path / 'tp.txt'
+    _write_tp(tp, 'WeightedCombinationTransform', [1.0], [])
+    with pytest.raises(NotImplementedError):
+        transform_engine.deformation_and_jacobian(tp)
+
+
+@pytest.mark.skipif(shutil.which('transformix') is None, reason='transformix is not installed')
+def test_matches_transformix(chain, tmp_path):
+    tp, _ = chain
+    out = tmp_path / 'transformix_out'
+    out.mkdir()
+    subprocess.check_output(['transformix', '-tp', str(tp), '-out', str(out), '-def', 'all', '-jac', 'all'])
+
+    disp, jac = transform_engine.deformation_and_jacobian(tp)
+
+    expected_disp = sitk.GetArrayFromImage(sitk.ReadImage(str(out / 'deformationField.nrrd')))
+    expected_jac = sitk.GetArrayFromImage(sitk.ReadImage(str(out / 'spatialJacobian.nrrd')))
+
+    assert np.allclose(sitk.GetArrayFromImage(disp), expected_disp, atol=1e-3)
+    assert np.allclose(sitk.GetArrayFromImage(jac), expected_jac, atol=1e-3)
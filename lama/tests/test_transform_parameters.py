@@ -0,0 +1,118 @@
+"""
+Test reading and writing elastix transform parameter files
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from lama.elastix import transform_parameters
+from lama.elastix.transform_parameters import TransformParameterFile
+from lama.elastix.folding import unfold_bsplines
+
+BSPLINE_TP = '''(Transform "BSplineTransform")
+(NumberOfParameters 24)
+(TransformParameters {params})
+(InitialTransformParameterFileName "NoInitialTransform")
+(UseBinaryFormatForTransformationParameters "false")
+(HowToCombineTransforms "Compose")
+
+// Image specific
+(FixedImageDimension 3)
+(Size 100 120 80)
+(Spacing 1.0000000000 1.0000000000 1.0000000000)
+(ResultImagePixelType "float")
+
+// BSplineTransform specific
+(GridSize 2 2 2)
+(GridSpacing 8.0000000000 10.0000000000 12.0000000000)
+(GridOrigin -8.0000000000 -10.0000000000 -12.0000000000)
+'''
+
+
+@pytest.fixture
+def tp_path(tmp_path):
+    params = ' '.join(f'{x:.6f}' for x in np.arange(24) * 0.1)
+    path = tmp_path / 'TransformParameters.0.txt'
+    path.write_text(BSPLINE_TP.format(params=params))
+    return path
+
+
+def test_read(tp_path):
+    tp = TransformParameterFile.read(tp_path)
+
+    assert tp.transform == 'BSplineTransform'
+    assert tp['Size'] == [100, 120, 80]
+    assert tp['GridSpacing'] == [8.0, 10.0, 12.0]
+    assert tp['UseBinaryFormatForTransformationParameters'] == ['false']
+    assert tp.get('Missing') is None
+    assert tp.initial_transform is None
+
+    assert np.allclose(tp.parameters, np.arange(24) * 0.1)
+    # All the x coefficients come first in the file
+    assert tp.coefficients.shape == (8, 3)
+    assert np.allclose(tp.coefficients[:, 0], np.arange(8) * 0.1)
+    assert np.allclose(tp.coefficients[:, 2], np.arange(16, 24) * 0.1)
+
+
+def test_unmodified_write_is_identical(tp_path, tmp_path):
+    out = tmp_path / 'out.txt'
+    TransformParameterFile.read(tp_path).write(out)
+    assert out.read_text() == tp_path.read_text()
+
+
+def test_cached_write_is_identical(tmp_path):
+    # Values that the modified-parameter precision would truncate
+    path = tmp_path / 'TransformParameters.0.txt'
+    path.write_text(BSPLINE_TP.format(params=' '.join(['0.0123456789 -0.000000123'] * 12)))
+    transform_parameters._cache.clear()
+
+    # The first read parses the file and the second comes from the cache
+    for out in [tmp_path / 'first.txt', tmp_path / 'second.txt']:
+        TransformParameterFile.read(path).write(out)
+        assert out.read_bytes() == path.read_bytes()
+
+
+def test_modify(tp_path, tmp_path):
+    tp = TransformParameterFile.read(tp_path)
+    tp.initial_transform = tmp_path / 'affine.txt'
+    tp['ResultImagePixelType'] = 'unsigned char'
+    tp['FinalBSplineInterpolationOrder'] = 0
+    tp.coefficients = tp.coefficients * 2
+    tp.write()
+
+    text = tp_path.read_text()
+    assert f'(InitialTransformParameterFileName "{tmp_path / "affine.txt"}")' in text
+    assert '(ResultImagePixelType "unsigned char")' in text
+    assert '(FinalBSplineInterpolationOrder 0)' in text
+
+    # No temporary files left behind
+    assert sorted(os.listdir(tmp_path)) == ['TransformParameters.0.txt']
+
+    tp2 = TransformParameterFile.read(tp_path)
+    assert np.allclose(tp2.parameters, np.arange(24) * 0.2)
+    assert tp2.initial_transform == tmp_path / 'affine.txt'
+
+
+def test_cache(tp_path):
+    transform_parameters._cache.clear()
+
+    tp = TransformParameterFile.read(tp_path)
+    assert str(tp_path.resolve()) in transform_parameters._cache
+
+    # Modifying a returned object must not change the cached parameters
+    tp.parameters[:] = 0
+    assert np.allclose(TransformParameterFile.read(tp_path).parameters, np.arange(24) * 0.1)
+
+    # Writing the file invalidates the cache entry
+    tp.write()
+    assert np.allclose(TransformParameterFile.read(tp_path).parameters, 0)
+
+
+def test_unfold_without_folding_keeps_coefficients(tp_path, tmp_path):
+    out = tmp_path / 'unfolded.txt'
+    coefs = unfold_bsplines(tp_path, out)
+
+    assert np.allclose(coefs, TransformParameterFile.read(tp_path).coefficients)
+    assert np.allclose(TransformParameterFile.read(out).parameters, np.arange(24) * 0.1)
@@ -0,0 +1,125 @@
+"""
+Test the SQLite work queue used by the distributed job runners
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+
+import pytest
+
+from lama.work_queue import WorkQueue, WorkQueueException, DONE, FAILED, RUNNING
+from lama.registration_pipeline.parallel_average import run_stage
+
+
+def _claim_all(db_path, worker):
+    queue = WorkQueue(db_path)
+    claimed = []
+    while True:
+        task = queue.claim('stage', worker)
+        if task is None:
+            return claimed
+        claimed.append(task)
+        queue.complete('stage', task, worker)
+
+
+def _claim_and_hang(db_path, lease_seconds):
+    # A worker that claims a task, keeps its lease alive and never finishes
+    queue = WorkQueue(db_path, lease_seconds=lease_seconds)
+    task = queue.claim('stage', 'doomed_worker')
+    with queue.lease('stage', task, 'doomed_worker'):
+        time.sleep(60)
+
+
+def test_claims_are_exclusive(tmp_path):
+    db = tmp_path / 'queue.db'
+    ids = [str(i) for i in range(200)]
+    WorkQueue(db).add_tasks('stage', ids)
+
+    with ProcessPoolExecutor(4) as pool:
+        results = list(pool.map(_claim_all, [db] * 4, [f'w{i}' for i in range(4)]))
+
+    claimed = [t for r in results for t in r]
+    assert sorted(claimed) == sorted(ids)
+    assert WorkQueue(db).counts('stage')[DONE] == len(ids)
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.db', lease_seconds=0.2, max_attempts=2)
+    queue.add_tasks('stage', ['a'])
+
+    assert queue.claim('stage', 'dead_worker') == 'a'
+    assert queue.claim('stage', 'w2') is None  # Still leased
+
+    time.sleep(0.3)
+    assert queue.claim('stage', 'w2') == 'a'
+    assert not queue.heartbeat('stage', 'a', 'dead_worker')
+
+    # w2 also dies. That was the last attempt so the stage fails rather than waiting forever
+    time.sleep(0.3)
+    assert queue.claim('stage', 'w3') is None
+    assert queue.counts('stage')[FAILED] == 1
+    with pytest.raises(WorkQueueException):
+        queue.wait_for_stage('stage')
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.db', lease_seconds=0.3)
+    queue.add_tasks('stage', ['a'])
+
+    task = queue.claim('stage', 'w1')
+    with queue.lease('stage', task, 'w1'):
+        time.sleep(0.8)
+        assert queue.claim('stage', 'w2') is None
+    assert queue.complete('stage', task, 'w1')
+
+    assert queue.wait_for_stage('stage', timeout=1)
+
+
+def test_wait_for_stage_timeout(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.db')
+    queue.add_tasks('stage', ['a'])
+    assert not queue.wait_for_stage('stage', timeout=0.2, min_interval=0.05)
+
+
+def test_batch_claim_and_release(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.db')
+    queue.add_tasks('stage', ['a', 'b', 'c'])
+
+    assert queue.claim_batch('stage', 'w1', 2) == ['a', 'b']
+    queue.complete('stage', 'a', 'w1')
+    queue.release('stage', ['b'], 'w1')
+
+    assert queue.claim_batch('stage', 'w2', 5) == ['b', 'c']
+    queue.fail('stage', 'b', 'w2', 'error', retry=False)
+    queue.complete('stage', 'c', 'w2')
+
+    counts = queue.counts('stage')
+    assert counts[DONE] == 2 and counts[FAILED] == 1
+
+    host_stats = queue.host_stats('stage')
+    assert host_stats['done'].sum() == 2
+    assert queue.progress('stage')['eta_s'] == 0
+
+
+def test_stage_barrier_survives_dead_worker(tmp_path):
+    db = tmp_path / 'queue.db'
+    queue = WorkQueue(db, lease_seconds=0.5)
+    queue.add_tasks('stage', ['a', 'b', 'c'])
+
+    doomed = multiprocessing.get_context('spawn').Process(target=_claim_and_hang, args=(db, 0.5))
+    doomed.start()
+    while queue.counts('stage')[RUNNING] == 0:
+        time.sleep(0.05)
+
+    # Kill the worker mid-stage, while it holds a live lease
+    doomed.kill()
+    doomed.join()
+
+    done = []
+    start = time.time()
+    run_stage(queue, 'stage', 'survivor', done.append)
+
+    assert sorted(done) == ['a', 'b', 'c']
+    assert queue.counts('stage')[DONE] == 3
+    assert time.time() - start < 10
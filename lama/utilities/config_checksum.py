@@ -1,9 +1,73 @@
 """
 Get a checksum for the contents of a config file. This can be used to make sure unforseen errors creeep into config
+
+Also used to make content-addressed keys for registration results so that a matching result from a previous run can be
+reused instead of re-registering (see TargetBasedRegistration.resume)
 """
 import hashlib
 import json
-from typing import Dict
+import os
+from pathlib import Path
+from typing import Dict, Union
+from threading import Lock
+
+# Hashes of image files keyed by (path, mtime, size). The fixed image and mask are shared by every specimen in a stage
+_file_hash_cache = {}
+_file_hash_lock = Lock()
+
+CHUNK_SIZE = 2 ** 22
+
 
 def md5(data: Dict) -> str:
-    return hashlib.md5(json.dumps(data, sort_keys=True)).hexdigest()
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_md5(path: Union[str, Path]) -> str:
+    """
+    Get the md5 of a file's contents. The file is read in chunks so large volumes are not held in memory.
+    Results are cached until the file is modified
+    """
+    stat = os.stat(path)
+    cache_key = (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+
+    with _file_hash_lock:
+        if cache_key in _file_hash_cache:
+            return _file_hash_cache[cache_key]
+
+    h = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _file_hash_lock:
+        _file_hash_cache[cache_key] = digest
+
+    return digest
+
+
+def registration_checksum(moving: Path, fixed: Path, fixed_mask: Union[Path, None], elx_params: str, **extra) -> str:
+    """
+    Make a key for a single registration from everything that determines its result
+
+    Parameters
+    ----------
+    moving
+        The moving image
+    fixed
+        The fixed image
+    fixed_mask
+        The fixed mask or None
+    elx_params
+        The text of the elastix parameter file (as generated by run_lama.generate_elx_parameters)
+    extra
+        Any other options that change the registration output (eg. fix_folding)
+    """
+    data = {
+        'moving': file_md5(moving),
+        'fixed': file_md5(fixed),
+        'fixed_mask': file_md5(fixed_mask) if fixed_mask else None,
+        'elx_params': elx_params,
+        'extra': extra
+    }
+    return md5(data)
@@ -0,0 +1,431 @@
+"""
+A file-backed work queue for running jobs from several nodes over a shared filesystem.
+
+The queue is a single SQLite database. There is no server: every worker opens the file, and claims are made atomic by
+taking SQLite's write lock (BEGIN IMMEDIATE) before selecting and updating a task.
+
+A claimed task has a lease. While the work runs, a heartbeat thread extends the lease. If a node dies its leases expire
+and the tasks are handed to other workers, so a stage no longer stalls waiting for a specimen that will never finish.
+Each task is run by one worker at a time, so specimens are no longer picked up twice.
+
+Notes
+-----
+The database uses the DELETE journal mode. WAL mode needs shared memory between processes and does not work
+on NFS, which is where these queues usually live.
+
+Waiting for a stage to finish (a barrier) polls one row count with exponential backoff. Without a server there is no
+way to push a notification to other hosts, but the backoff keeps the load on the shared filesystem small.
+
+Examples
+--------
+    queue = WorkQueue(output_dir / 'work_queue.db')
+    queue.add_tasks('affine', spec_ids)
+
+    while True:
+        spec_id = queue.claim('affine', worker_id)
+        if spec_id is None:
+            break
+        with queue.lease('affine', spec_id, worker_id):
+            register(spec_id)
+        queue.complete('affine', spec_id, worker_id)
+
+    queue.wait_for_stage('affine')
+"""
+
+import sqlite3
+import threading
+import time
+import random
+import socket
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Union, Dict, List
+from datetime import timedelta
+
+from logzero import logger as logging
+import pandas as pd
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+class WorkQueueException(Exception):
+    pass
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}_{os.getpid()}'
+
+
+class WorkQueue:
+    def __init__(self, db_path: Union[str, Path],
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 lock_timeout: float = 120):
+        """
+        Parameters
+        ----------
+        db_path
+            The SQLite file. Created if it does not exist
+        lease_seconds
+            How long a claim lasts without a heartbeat before the task can be given to another worker
+        max_attempts
+            A task that has been claimed this many times without completing is marked as failed
+        lock_timeout
+            Seconds to wait for another worker's write lock before giving up
+        """
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock_timeout = lock_timeout
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=DELETE')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    stage TEXT NOT NULL,
+                    task_id TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    started REAL,
+                    finished REAL,
+                    error TEXT,
+                    host TEXT,
+                    PRIMARY KEY (stage, task_id))
+            """)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(tasks)')]
+            if 'host' not in columns:  # Queues made before per-host stats were added
+                conn.execute('ALTER TABLE tasks ADD COLUMN host TEXT')
+
+    @contextmanager
+    def _connect(self):
+        # A new connection per operation keeps the queue usable from the heartbeat thread, and means no lock
+        # is held between calls
+        conn = sqlite3.connect(str(self.db_path), timeout=self.lock_timeout, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A write transaction. BEGIN IMMEDIATE takes the database write lock up front so that the select and update in a
+        claim cannot interleave with another worker's
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+
+    def add_tasks(self, stage: str, task_ids: Iterable[str]):
+        """
+        Add tasks to a stage. Tasks that already exist are left as they are, so every worker can call this at startup
+        """
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO tasks (stage, task_id) VALUES (?, ?)',
+                             [(stage, str(t)) for t in task_ids])
+
+    def claim(self, stage: str, worker: str) -> Union[str, None]:
+        """
+        Claim the next task in a stage. Pending tasks are given out first, then running tasks whose lease has
+        expired (their worker has probably died).
+
+        Returns
+        -------
+        The task id or None if there is nothing left to claim
+        """
+        claimed = self.claim_batch(stage, worker, 1)
+        return claimed[0] if claimed else None
+
+    def claim_batch(self, stage: str, worker: str, n: int) -> List[str]:
+        """
+        Claim up to n tasks in one transaction. This cuts lock traffic when there are many workers. The leases on all
+        the claimed tasks are kept alive by lease(stage, None, worker), and tasks that are not going to be run
+        should be given back with release()
+
+        Returns
+        -------
+        The claimed task ids. Empty if there is nothing left to claim
+        """
+        now = time.time()
+
+        with self._transaction() as conn:
+            self._fail_exhausted(conn, stage, now)
+
+            rows = conn.execute("""
+                SELECT task_id, status, worker FROM tasks
+                WHERE stage = ? AND (status = ? OR (status = ? AND lease_expires < ?))
+                ORDER BY status = ?, rowid
+                LIMIT ?
+            """, (stage, PENDING, RUNNING, now, RUNNING, n)).fetchall()
+
+            for task_id, status, old_worker in rows:
+
+                if status == RUNNING:
+                    logging.warning(f'Lease on {stage}/{task_id} held by {old_worker} expired. Reassigning to {worker}')
+
+                conn.execute("""
+                    UPDATE tasks SET status = ?, worker = ?, host = ?, lease_expires = ?, attempts = attempts + 1,
+                                     started = ?, finished = NULL
+                    WHERE stage = ? AND task_id = ?
+                """, (RUNNING, worker, socket.gethostname(), now + self.lease_seconds, now, stage, task_id))
+
+        return [row[0] for row in rows]
+
+    def start(self, stage: str, task_id: str, worker: str):
+        """
+        Record that work on a claimed task has started. Only needed for batched claims, where a task can wait
+        in a worker's batch for some time after it is claimed
+        """
+        with self._transaction() as conn:
+            conn.execute('UPDATE tasks SET started = ? WHERE stage = ? AND task_id = ? AND worker = ?',
+                         (time.time(), stage, task_id, worker))
+
+    def release(self, stage: str, task_ids: Iterable[str], worker: str):
+        """
+        Give claimed tasks that have not been started back to the queue without using up an attempt
+        """
+        with self._transaction() as conn:
+            conn.executemany("""
+                UPDATE tasks SET status = ?, worker = NULL, host = NULL, lease_expires = NULL, started = NULL,
+                                 attempts = attempts - 1
+                WHERE stage = ? AND task_id = ? AND worker = ? AND status = ?
+            """, [(PENDING, stage, t, worker, RUNNING) for t in task_ids])
+
+    def _fail_exhausted(self, conn, stage: str, now: float):
+        # Expired tasks that have used all their attempts are not retried again
+        conn.execute("""
+            UPDATE tasks SET status = ?, error = 'lease expired after max attempts'
+            WHERE stage = ? AND status = ? AND lease_expires < ? AND attempts >= ?
+        """, (FAILED, stage, RUNNING, now, self.max_attempts))
+
+    def heartbeat(self, stage: str, task_id: Union[str, None], worker: str) -> bool:
+        """
+        Extend the lease on a task. If task_id is None, extend the leases on all of the worker's tasks in the stage
+
+        Returns
+        -------
+        False if the worker no longer holds the task (or any tasks)
+        """
+        with self._transaction() as conn:
+            if task_id is None:
+                cur = conn.execute("""
+                    UPDATE tasks SET lease_expires = ?
+                    WHERE stage = ? AND worker = ? AND status = ?
+                """, (time.time() + self.lease_seconds, stage, worker, RUNNING))
+                return cur.rowcount > 0
+
+            cur = conn.execute("""
+                UPDATE tasks SET lease_expires = ?
+                WHERE stage = ? AND task_id = ? AND worker = ? AND status = ?
+            """, (time.time() + self.lease_seconds, stage, task_id, worker, RUNNING))
+            return cur.rowcount == 1
+
+    @contextmanager
+    def lease(self, stage: str, task_id: Union[str, None], worker: str):
+        """
+        Keep the lease on a task alive with a background heartbeat while the with block runs.
+        If task_id is None, the leases on all the worker's tasks in the stage are kept alive
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    if not self.heartbeat(stage, task_id, worker):
+                        logging.warning(f'{worker} lost the lease on {stage}/{task_id}')
+                        return
+                except sqlite3.Error as e:
+                    # A busy or briefly unavailable shared filesystem. Try again on the next beat
+                    logging.warning(f'Heartbeat for {stage}/{task_id} failed: {e}')
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, stage: str, task_id: str, worker: str) -> bool:
+        """
+        Mark a task as done.
+
+        Returns
+        -------
+        False if the lease had been lost to another worker. The task is still marked as done, as the work was finished
+        """
+        with self._transaction() as conn:
+            owner = conn.execute('SELECT worker FROM tasks WHERE stage = ? AND task_id = ?',
+                                 (stage, task_id)).fetchone()
+            conn.execute("""
+                UPDATE tasks SET status = ?, finished = ?, lease_expires = NULL, error = NULL
+                WHERE stage = ? AND task_id = ?
+            """, (DONE, time.time(), stage, task_id))
+
+        return owner is not None and owner[0] == worker
+
+    def fail(self, stage: str, task_id: str, worker: str, error: str = '', retry: bool = True):
+        """
+        Give up a claimed task. It goes back to pending unless it has used all of its attempts or retry is False
+        """
+        max_attempts = self.max_attempts if retry else 0
+
+        with self._transaction() as conn:
+            conn.execute("""
+                UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                                 lease_expires = NULL, finished = ?, error = ?
+                WHERE stage = ? AND task_id = ? AND worker = ? AND status = ?
+            """, (max_attempts, FAILED, PENDING, time.time(), str(error), stage, task_id, worker, RUNNING))
+
+    def counts(self, stage: str) -> Dict[str, int]:
+        """
+        Get the number of tasks in each status for a stage
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM tasks WHERE stage = ? GROUP BY status',
+                                (stage, )).fetchall()
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def tasks(self, stage: str) -> pd.DataFrame:
+        """
+        Get all the tasks in a stage, in the order they were added
+        """
+        with self._connect() as conn:
+            return pd.read_sql_query("""
+                SELECT task_id, status, worker, host, attempts, started, finished, lease_expires, error FROM tasks
+                WHERE stage = ? ORDER BY rowid
+            """, conn, params=(stage, ))
+
+    def host_stats(self, stage: str) -> pd.DataFrame:
+        """
+        Per-host statistics for a stage: the number of tasks in each status and the mean duration of done tasks
+        """
+        df = self.tasks(stage)
+        df = df[df.host.notnull()]
+
+        stats = pd.crosstab(df.host, df.status)
+        for status in (RUNNING, DONE, FAILED):
+            if status not in stats:
+                stats[status] = 0
+        stats = stats[[RUNNING, DONE, FAILED]]
+
+        done = df[df.status == DONE]
+        stats['mean_duration_s'] = (done.finished - done.started).groupby(done.host).mean()
+        stats['last_finished'] = pd.to_datetime(done.groupby('host').finished.max(), unit='s').dt.round('s')
+
+        return stats
+
+    def progress(self, stage: str, window: float = 3600) -> Dict:
+        """
+        Get the number of tasks in each status along with the recent throughput and an estimated time to finish
+
+        Parameters
+        ----------
+        window
+            Throughput is measured over tasks finished in the last window seconds. If none finished in that time, it is
+            measured over the whole run
+
+        Returns
+        -------
+        dict with the counts from counts() plus 'throughput_per_hour' and 'eta_s' (None if they cannot be estimated)
+        """
+        df = self.tasks(stage)
+        counts = self.counts(stage)
+
+        done = df[df.status == DONE]
+        now = time.time()
+        throughput = None
+
+        if len(done):
+            recent = done[done.finished >= now - window]
+            if len(recent):
+                # If the run is younger than the window, measure over the run
+                elapsed = min(window, now - df.started.min())
+                throughput = len(recent) / elapsed * 3600 if elapsed > 0 else None
+            else:
+                elapsed = done.finished.max() - df.started.min()
+                throughput = len(done) / elapsed * 3600 if elapsed > 0 else None
+
+        remaining = counts[PENDING] + counts[RUNNING]
+        eta = remaining / throughput * 3600 if throughput else None
+
+        return dict(counts, throughput_per_hour=throughput, eta_s=eta)
+
+    def status_report(self, stage: str) -> str:
+        progress = self.progress(stage)
+        total = sum(progress[x] for x in (PENDING, RUNNING, DONE, FAILED))
+
+        lines = [f'{stage}: {progress[DONE]}/{total} done, {progress[RUNNING]} running, {progress[PENDING]} pending, '
+                 f'{progress[FAILED]} failed']
+
+        if progress['throughput_per_hour']:
+            lines.append(f"Throughput: {progress['throughput_per_hour']:.1f} jobs/hour")
+        if progress['eta_s'] is not None:
+            lines.append(f"ETA: {timedelta(seconds=int(progress['eta_s']))}")
+
+        host_stats = self.host_stats(stage)
+        if len(host_stats):
+            lines.append('')
+            lines.append(host_stats.to_string())
+
+        return '\n'.join(lines)
+
+    def wait_for_stage(self, stage: str, timeout: float = None, min_interval: float = 1,
+                       max_interval: float = 30) -> bool:
+        """
+        Block until every task in a stage is done.
+
+        Parameters
+        ----------
+        timeout
+            Give up after this many seconds. None waits indefinitely
+        min_interval, max_interval
+            The poll interval starts at min_interval and doubles (with jitter) up to max_interval
+
+        Returns
+        -------
+        True if the stage is done, False on timeout
+
+        Raises
+        ------
+        WorkQueueException if any task in the stage has failed
+        """
+        start = time.time()
+        interval = min_interval
+
+        while True:
+            counts = self.counts(stage)
+
+            if counts[FAILED]:
+                raise WorkQueueException(f'{counts[FAILED]} tasks in stage {stage} failed')
+
+            if counts[PENDING] == 0 and counts[RUNNING] == 0:
+                return True
+
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+
+            sleep = interval * random.uniform(0.8, 1.2)
+            if timeout is not None:
+                sleep = min(sleep, max(0, timeout - (time.time() - start)))
+            time.sleep(sleep)
+            interval = min(interval * 2, max_interval)
@@ -15,7 +15,8 @@ setup(
     packages=find_packages(exclude=("dev")),
     package_data={'': ['current_commit',
                        'stats/rscripts/lmFast.R',
-                       'stats/rscripts/r_padjust.R']},  # Puts it in the wheel dist. MANIFEST.in gets it in source dist
+                       'stats/rscripts/r_padjust.R',
+                       'stats/rscripts/r_worker.R']},  # Puts it in the wheel dist. MANIFEST.in gets it in source dist
     include_package_data=True,
     install_requires=[
         'appdirs',